@@ -0,0 +1,27 @@
+"""add priority to Measurement
+
+Revision ID: 4c2e8f1a9b7d
+Revises: dfb29dfa2345
+Create Date: 2026-10-18 09:42:11.318205
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "4c2e8f1a9b7d"
+down_revision = "dfb29dfa2345"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "measurement",
+        sa.Column("priority", sa.Integer(), server_default="0", nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_column("measurement", "priority")
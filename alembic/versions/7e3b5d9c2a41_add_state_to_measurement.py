@@ -0,0 +1,90 @@
+"""add state, start_time and end_time to Measurement
+
+Revision ID: 7e3b5d9c2a41
+Revises: 4c2e8f1a9b7d
+Create Date: 2026-10-18 14:27:53.604112
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7e3b5d9c2a41"
+down_revision = "4c2e8f1a9b7d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "measurement",
+        sa.Column(
+            "state",
+            sa.Enum(
+                "AgentFailure",
+                "Canceled",
+                "Created",
+                "Finished",
+                "Ongoing",
+                name="measurementagentstate",
+                native_enum=False,
+            ),
+            server_default="Created",
+            nullable=False,
+        ),
+    )
+    op.add_column("measurement", sa.Column("start_time", sa.DateTime(), nullable=True))
+    op.add_column("measurement", sa.Column("end_time", sa.DateTime(), nullable=True))
+    # Same aggregation as `iris.commons.models.measurement.update_measurements_query`.
+    op.execute(
+        """
+        UPDATE measurement
+        SET state = aggregates.state,
+            start_time = aggregates.start_time,
+            end_time = aggregates.end_time
+        FROM (
+            SELECT
+                measurement.uuid,
+                CASE
+                    WHEN count(DISTINCT measurement_agent.state) = 1
+                        THEN min(measurement_agent.state)
+                    WHEN coalesce(
+                        bool_and(
+                            measurement_agent.state
+                            IN ('AgentFailure', 'Canceled', 'Finished')
+                        ),
+                        true
+                    )
+                        THEN 'Finished'
+                    ELSE 'Ongoing'
+                END AS state,
+                CASE
+                    WHEN count(measurement_agent.start_time)
+                        = count(measurement_agent.agent_uuid)
+                        THEN min(measurement_agent.start_time)
+                END AS start_time,
+                CASE
+                    WHEN count(measurement_agent.end_time)
+                        = count(measurement_agent.agent_uuid)
+                        THEN max(measurement_agent.end_time)
+                END AS end_time
+            FROM measurement
+            LEFT JOIN measurement_agent
+                ON measurement.uuid = measurement_agent.measurement_uuid
+            GROUP BY measurement.uuid
+        ) AS aggregates
+        WHERE measurement.uuid = aggregates.uuid
+        """
+    )
+    op.alter_column("measurement", "state", server_default=None)
+    op.create_index(
+        op.f("ix_measurement_state"), "measurement", ["state"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_measurement_state"), table_name="measurement")
+    op.drop_column("measurement", "end_time")
+    op.drop_column("measurement", "start_time")
+    op.drop_column("measurement", "state")
@@ -1,14 +1,63 @@
 import asyncio
 import os
+import re
 import shlex
 import signal
-from asyncio.subprocess import create_subprocess_shell
+from asyncio.subprocess import PIPE, create_subprocess_shell
+from collections.abc import AsyncIterable, AsyncIterator, Awaitable, Callable
+from datetime import datetime
+from importlib.util import find_spec
 from logging import LoggerAdapter
 from pathlib import Path
+from time import monotonic
 
 from iris.agent.settings import AgentSettings
-from iris.commons.models import MeasurementRoundRequest
+from iris.commons.models import MeasurementRoundRequest, ProbingProgress, ResultsFormat
 from iris.commons.redis import Redis
+from iris.commons.utils import cancel_task, gather_or_cancel
+
+# Arrow types of the columns written by caracal.
+# ClickHouse converts them to the types of the results table on insertion,
+# e.g. the IP addresses are kept as strings and parsed by ClickHouse.
+RESULTS_COLUMNS = {
+    "capture_timestamp": "uint32",
+    "probe_protocol": "uint8",
+    "probe_src_addr": "string",
+    "probe_dst_addr": "string",
+    "probe_src_port": "uint16",
+    "probe_dst_port": "uint16",
+    "probe_ttl": "uint8",
+    "quoted_ttl": "uint8",
+    "reply_src_addr": "string",
+    "reply_protocol": "uint8",
+    "reply_icmp_type": "uint8",
+    "reply_icmp_code": "uint8",
+    "reply_ttl": "uint8",
+    "reply_size": "uint16",
+    "reply_mpls_labels": "string",
+    "rtt": "uint16",
+    "round": "uint8",
+}
+
+# The statistics logged by caracal, as named in `ProbingStatistics`.
+PROBING_STATISTICS = [
+    "probes_read",
+    "packets_sent",
+    "packets_failed",
+    "filtered_low_ttl",
+    "filtered_high_ttl",
+    "filtered_prefix_excl",
+    "filtered_prefix_not_incl",
+    "packets_received",
+    "packets_received_invalid",
+    "pcap_received",
+    "pcap_dropped",
+    "pcap_interface_dropped",
+]
+STATISTICS_ALIASES = {
+    "filtered_lo_ttl": "filtered_low_ttl",
+    "filtered_hi_ttl": "filtered_high_ttl",
+}
 
 
 async def caracal_backend(
@@ -18,11 +67,14 @@ async def caracal_backend(
     redis: Redis,
     probes_filepath: Path,
     results_filepath: Path,
+    probes_stream: AsyncIterable[bytes] | None = None,
+    results_sink: Callable[[AsyncIterable[bytes]], Awaitable] | None = None,
 ) -> dict | None:
     """
     This is the default and reference backend for Iris.
     It uses `caracal <https://github.com/dioptra-io/caracal>`_ for sending the probes.
     """
+    statistics: dict[str, int] = {}
 
     prober = asyncio.create_task(
         probe(
@@ -33,21 +85,26 @@ async def caracal_backend(
             request.round.number,
             request.batch_size,
             request.probing_rate,
+            probes_stream,
+            results_sink,
+            statistics,
         )
     )
 
-    watcher = asyncio.create_task(
-        watch_cancellation(
-            redis,
-            request.measurement_uuid,
-            settings.AGENT_UUID,
-            settings.AGENT_STOPPER_REFRESH,
-        )
+    reporter = asyncio.create_task(
+        report_progress(redis, settings, request, statistics)
     )
 
-    done, pending = await asyncio.wait(
-        [prober, watcher], return_when=asyncio.FIRST_COMPLETED
+    watcher = asyncio.create_task(
+        watch_cancellation(redis, request.measurement_uuid, settings.AGENT_UUID)
     )
+
+    try:
+        done, pending = await asyncio.wait(
+            [prober, watcher], return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        await cancel_task(reporter)
     if watcher in done:
         # Measurement was cancelled
         prober.cancel()
@@ -56,17 +113,69 @@ async def caracal_backend(
     return prober.result()
 
 
-async def watch_cancellation(
+async def report_progress(
     redis: Redis,
-    measurement_uuid: str,
-    agent_uuid: str,
-    interval: float,
-) -> bool:
-    """Kill the prober process if the measurement request is deleted."""
+    settings: AgentSettings,
+    request: MeasurementRoundRequest,
+    statistics: dict[str, int],
+) -> None:
+    """
+    Publish the probing progress to Redis every `AGENT_PROGRESS_INTERVAL` seconds,
+    from the `statistics` last logged by caracal.
+    """
+    interval = settings.AGENT_PROGRESS_INTERVAL
+    probing_rate = max_probing_rate(settings, request.probing_rate)
+    last_time, last_sent = monotonic(), 0
     while True:
-        if not await redis.get_request(measurement_uuid, agent_uuid):
-            return True
         await asyncio.sleep(interval)
+        now, sent = monotonic(), statistics.get("packets_sent", 0)
+        progress = ProbingProgress(
+            round=request.round,
+            time=datetime.utcnow(),
+            probing_rate=probing_rate,
+            sending_rate=max(sent - last_sent, 0) / (now - last_time),
+            **{
+                name: statistics.get(name, 0)
+                for name in ProbingProgress.__fields__
+                if name in PROBING_STATISTICS
+            },
+        )
+        await redis.set_measurement_progress(
+            request.measurement_uuid,
+            settings.AGENT_UUID,
+            progress,
+            max(int(10 * interval), 1),
+        )
+        last_time, last_sent = now, sent
+
+
+async def watch_cancellation(
+    redis: Redis, measurement_uuid: str, agent_uuid: str
+) -> bool:
+    """Kill the prober process if the measurement request is deleted."""
+    await redis.wait_request_deletion(measurement_uuid, agent_uuid)
+    return True
+
+
+def max_probing_rate(settings: AgentSettings, probing_rate: int | None) -> int:
+    """Cap the probing rate if superior to the maximum probing rate."""
+    if probing_rate and probing_rate <= settings.AGENT_MAX_PROBING_RATE:
+        return probing_rate
+    return settings.AGENT_MAX_PROBING_RATE
+
+
+def parse_statistics(line: str) -> dict[str, int]:
+    """
+    Parse the `name=value` statistics logged by caracal.
+    >>> parse_statistics("[info] probes_read=10 filtered_lo_ttl=1 packets_sent=9")
+    {'probes_read': 10, 'filtered_low_ttl': 1, 'packets_sent': 9}
+    >>> parse_statistics("[info] Probing rate: 100")
+    {}
+    """
+    return {
+        STATISTICS_ALIASES.get(name, name): int(value)
+        for name, value in re.findall(r"(\w+)=(\d+)", line)
+    }
 
 
 async def probe(
@@ -77,24 +186,32 @@ async def probe(
     round_number: int,
     batch_size: int | None,
     probing_rate: int,
+    probes_stream: AsyncIterable[bytes] | None = None,
+    results_sink: Callable[[AsyncIterable[bytes]], Awaitable] | None = None,
+    statistics: dict[str, int] | None = None,
 ) -> dict:
-    """Probing interface."""
-    # Cap the probing rate if superior to the maximum probing rate
-    measurement_probing_rate = (
-        probing_rate
-        if probing_rate and probing_rate <= settings.AGENT_MAX_PROBING_RATE
-        else settings.AGENT_MAX_PROBING_RATE
-    )
+    """
+    Probing interface.
+    If `probes_stream` is specified, the probes are read from it instead of
+    `probes_filepath`, whose suffix still tells if they are compressed.
+    Likewise, if `results_sink` is specified, it is called with the stream of
+    results, as they are produced, instead of writing them to `results_filepath`.
+    The `statistics` are updated in place as caracal logs them.
+    """
+    statistics = {} if statistics is None else statistics
+    measurement_probing_rate = max_probing_rate(settings, probing_rate)
 
+    input_path = "" if probes_stream else shlex.quote(str(probes_filepath))
     if probes_filepath.suffix == ".zst":
-        input_cmd = f"zstd -cd {shlex.quote(str(probes_filepath))}"
+        input_cmd = f"zstd -cd {input_path}"
     else:
-        input_cmd = f"cat {shlex.quote(str(probes_filepath))}"
+        input_cmd = f"cat {input_path}"
 
+    output_path = "" if results_sink else f"> {shlex.quote(str(results_filepath))}"
     if results_filepath.suffix == ".zst":
-        output_cmd = f"zstd -c > {shlex.quote(str(results_filepath))}"
+        output_cmd = f"zstd -c {output_path}"
     else:
-        output_cmd = f"tee > {shlex.quote(str(results_filepath))}"
+        output_cmd = f"tee {output_path}"
 
     caracal_cmd = [
         "caracal",
@@ -116,26 +233,129 @@ async def probe(
     cmd = f"{input_cmd} | {' '.join(caracal_cmd)} | {output_cmd}"
     logger.info("Running %s", cmd)
 
-    process = await create_subprocess_shell(cmd, preexec_fn=os.setsid)
+    # With `pipefail`, the exit status is non-zero if any command of the pipeline
+    # fails, and not only the last one (i.e. the compression of the results).
+    process = await create_subprocess_shell(
+        f"set -o pipefail; {cmd}",
+        executable="/bin/bash",
+        stdin=PIPE if probes_stream else None,
+        stdout=PIPE if results_sink else None,
+        stderr=PIPE,
+        preexec_fn=os.setsid,
+    )
     try:
-        await process.wait()
-    except asyncio.CancelledError:
+        tasks: list[Awaitable] = [
+            process.wait(),
+            read_statistics(process, logger, statistics),
+        ]
+        if probes_stream:
+            tasks.append(write_stdin(process, probes_stream))
+        if results_sink:
+            tasks.append(results_sink(read_stdout(process)))
+        await gather_or_cancel(*tasks)
+    except (asyncio.CancelledError, Exception) as e:
         logger.info("Terminating pid %s", process.pid)
         os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+        if not isinstance(e, asyncio.CancelledError):
+            raise
+    else:
+        # The results of a prober which crashed are incomplete.
+        if process.returncode:
+            raise RuntimeError(f"The prober exited with status {process.returncode}")
 
-    # These statistics have been lost when migrating from pycaracal to caracal.
-    # TODO: Re-implement them.
-    return {
-        "probes_read": 0,
-        "packets_sent": 0,
-        "packets_failed": 0,
-        "filtered_low_ttl": 0,
-        "filtered_high_ttl": 0,
-        "filtered_prefix_excl": 0,
-        "filtered_prefix_not_incl": 0,
-        "packets_received": 0,
-        "packets_received_invalid": 0,
-        "pcap_received": 0,
-        "pcap_dropped": 0,
-        "pcap_interface_dropped": 0,
-    }
+    return {name: statistics.get(name, 0) for name in PROBING_STATISTICS}
+
+
+async def read_statistics(
+    process: asyncio.subprocess.Process,
+    logger: LoggerAdapter,
+    statistics: dict[str, int],
+) -> None:
+    """
+    Forward the standard error of `process` to the logger, and update
+    `statistics` with the (cumulative) statistics logged by caracal.
+    """
+    assert process.stderr
+    while line := await process.stderr.readline():
+        text = line.decode(errors="replace").rstrip()
+        logger.info(text)
+        statistics.update(parse_statistics(text))
+
+
+async def write_stdin(
+    process: asyncio.subprocess.Process, stream: AsyncIterable[bytes]
+) -> None:
+    """
+    Write `stream` to the standard input of `process`. The stream is only read
+    as fast as the process consumes it, since `drain` waits for the pipe buffer
+    to be flushed.
+    """
+    assert process.stdin
+    try:
+        async for chunk in stream:
+            process.stdin.write(chunk)
+            await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # The process exited before reading all of its input.
+        pass
+    finally:
+        process.stdin.close()
+
+
+async def read_stdout(
+    process: asyncio.subprocess.Process, size: int = 2**20
+) -> AsyncIterator[bytes]:
+    """Yield the standard output of `process` in chunks of at most `size` bytes."""
+    assert process.stdout
+    while chunk := await process.stdout.read(size):
+        yield chunk
+
+
+def supported_results_formats() -> list[ResultsFormat]:
+    """The Parquet format requires the `pyarrow` dependency (`parquet` extra)."""
+    formats = [ResultsFormat.CSV]
+    if find_spec("pyarrow"):
+        formats.append(ResultsFormat.Parquet)
+    return formats
+
+
+def csv_to_parquet(
+    csv_filepath: Path, parquet_filepath: Path, *, block_size: int = 2**26
+) -> None:
+    """
+    Convert caracal's (compressed) CSV output to a zstd-compressed Parquet file.
+    The file is converted by blocks of `block_size` bytes of CSV, each block
+    being written as a Parquet row group.
+    """
+    import pyarrow as pa
+    from pyarrow import csv, parquet
+
+    compression = "zstd" if csv_filepath.suffix == ".zst" else None
+    column_types = {name: pa.type_for_alias(t) for name, t in RESULTS_COLUMNS.items()}
+    with pa.input_stream(str(csv_filepath), compression=compression) as stream:
+        reader = csv.open_csv(
+            stream,
+            read_options=csv.ReadOptions(block_size=block_size),
+            convert_options=csv.ConvertOptions(column_types=column_types),
+        )
+        with parquet.ParquetWriter(
+            str(parquet_filepath), reader.schema, compression="zstd"
+        ) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+
+
+async def convert_results(
+    results_filepath: Path, results_format: ResultsFormat, logger: LoggerAdapter
+) -> Path:
+    """Convert the results file to the requested format, if needed."""
+    if results_format == ResultsFormat.Parquet:
+        parquet_filepath = results_filepath.with_name(
+            results_filepath.name.replace(".csv.zst", ".parquet")
+        )
+        logger.info("Convert results file to %s", parquet_filepath)
+        await asyncio.get_running_loop().run_in_executor(
+            None, csv_to_parquet, results_filepath, parquet_filepath
+        )
+        return parquet_filepath
+    return results_filepath
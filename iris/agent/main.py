@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import shutil
 import socket
 import time
 
@@ -7,10 +8,12 @@ from redis import asyncio as aioredis
 import psutil
 
 from iris import __version__
+from iris.agent.backend import max_probing_rate, supported_results_formats
 from iris.agent.pipeline import outer_pipeline
 from iris.agent.settings import AgentSettings
 from iris.agent.ttl import find_exit_ttl_with_mtr
-from iris.commons.dependencies import get_redis_context
+from iris.commons.dependencies import close_pools, get_redis_context
+from iris.commons.limiter import RateBudget
 from iris.commons.logger import Adapter, base_logger
 from iris.commons.models import AgentParameters, AgentState
 from iris.commons.redis import Redis
@@ -32,9 +35,46 @@ async def heartbeat(agent_uuid: str, redis: Redis) -> None:
 
 
 async def consumer(redis: Redis, storage: Storage, settings: AgentSettings):
-    """Consume tasks from the queue and run measurements."""
+    """
+    Consume tasks from the queue and run up to `AGENT_CONCURRENCY` measurements
+    concurrently, sharing `AGENT_MAX_PROBING_RATE` between them.
+    """
+    # Each round is probed at 1 pps at least.
+    concurrency = min(settings.AGENT_CONCURRENCY, settings.AGENT_MAX_PROBING_RATE)
+    budget = RateBudget(settings.AGENT_MAX_PROBING_RATE, concurrency)
+    running: set[str] = set()
+    await asyncio.gather(
+        *[
+            consumer_slot(redis, storage, settings, budget, running)
+            for _ in range(concurrency)
+        ]
+    )
+
+
+async def consumer_slot(
+    redis: Redis,
+    storage: Storage,
+    settings: AgentSettings,
+    budget: RateBudget,
+    running: set[str],
+):
+    """
+    Run one measurement at a time, excluding those run by the other slots.
+    A failed measurement is logged and retried later, so that it does not
+    interrupt the measurements of the other slots.
+    """
     while True:
-        request = await redis.get_random_request(settings.AGENT_UUID)
+        request = await redis.get_next_request(
+            settings.AGENT_UUID,
+            settings.AGENT_QUEUE_POLICY,
+            interval=settings.AGENT_QUEUE_TIMEOUT,
+            exclude=running,
+            usage_half_life=settings.AGENT_QUEUE_USAGE_HALF_LIFE,
+        )
+        if request.measurement_uuid in running:
+            # Another slot picked the same request in the meantime.
+            continue
+        running.add(request.measurement_uuid)
         logger = Adapter(
             base_logger,
             dict(
@@ -43,10 +83,34 @@ async def consumer(redis: Redis, storage: Storage, settings: AgentSettings):
                 agent_uuid=settings.AGENT_UUID,
             ),
         )
-        await redis.set_agent_state(settings.AGENT_UUID, AgentState.Working)
-        await outer_pipeline(settings, request, logger, redis, storage)
-        await redis.set_agent_state(settings.AGENT_UUID, AgentState.Idle)
-        await redis.delete_request(request.measurement_uuid, settings.AGENT_UUID)
+        probing_rate = budget.acquire(max_probing_rate(settings, request.probing_rate))
+        logger.info("Allotted probing rate: %s", probing_rate)
+        try:
+            await redis.set_agent_state(settings.AGENT_UUID, AgentState.Working)
+            await outer_pipeline(
+                settings,
+                request.copy(update={"probing_rate": probing_rate}),
+                logger,
+                redis,
+                storage,
+            )
+            # The worker may have requested the next round in the meantime.
+            await redis.delete_request(
+                request.measurement_uuid, settings.AGENT_UUID, request.round
+            )
+            failed = False
+        except Exception:
+            # The other slots keep probing, and the request stays in the queue.
+            logger.exception("Measurement failed")
+            failed = True
+        finally:
+            budget.release(probing_rate)
+            running.discard(request.measurement_uuid)
+        if not running:
+            await redis.set_agent_state(settings.AGENT_UUID, AgentState.Idle)
+        if failed:
+            # Do not retry the request right away if it fails persistently.
+            await asyncio.sleep(settings.AGENT_QUEUE_TIMEOUT)
 
 
 async def main(settings=AgentSettings()):
@@ -56,13 +120,20 @@ async def main(settings=AgentSettings()):
         base_logger, dict(component="agent", agent_uuid=settings.AGENT_UUID)
     )
     storage = Storage(settings, logger)
-    async with get_redis_context(settings, logger) as redis:
-        await main_with_deps(logger, redis, settings, storage)
+    try:
+        async with get_redis_context(settings, logger) as redis:
+            await main_with_deps(logger, redis, settings, storage)
+    finally:
+        await close_pools()
+        await storage.close()
 
 
 async def main_with_deps(
     logger: Adapter, redis: Redis, settings: AgentSettings, storage: Storage
 ):
+    # Remove the files left by a previous run.
+    shutil.rmtree(settings.AGENT_RESULTS_DIR_PATH, ignore_errors=True)
+    shutil.rmtree(settings.AGENT_TARGETS_DIR_PATH, ignore_errors=True)
     settings.AGENT_RESULTS_DIR_PATH.mkdir(parents=True, exist_ok=True)
     settings.AGENT_TARGETS_DIR_PATH.mkdir(parents=True, exist_ok=True)
 
@@ -84,6 +155,8 @@ async def main_with_deps(
     tasks = []
     try:
         await redis.set_agent_state(settings.AGENT_UUID, AgentState.Idle)
+        # Index the requests queued before the introduction of the queue policies.
+        await redis.index_requests(settings.AGENT_UUID)
         await redis.set_agent_parameters(
             settings.AGENT_UUID,
             AgentParameters(
@@ -103,6 +176,7 @@ async def main_with_deps(
                 min_ttl=settings.AGENT_MIN_TTL,
                 max_probing_rate=settings.AGENT_MAX_PROBING_RATE,
                 tags=settings.AGENT_TAGS.split(","),
+                results_formats=supported_results_formats(),
             ),
         )
 
@@ -1,13 +1,32 @@
 """Measurement interface."""
+import asyncio
+import json
 import shutil
+from collections.abc import AsyncIterable
 from datetime import datetime
+from functools import partial
 from logging import LoggerAdapter
+from pathlib import Path
+from uuid import uuid4
 
-from iris.agent.backend import caracal_backend
+from zstandard import ZstdCompressor
+
+from iris.agent.backend import caracal_backend, convert_results
 from iris.agent.settings import AgentSettings
-from iris.commons.models import MeasurementRoundRequest, ProbingStatistics
+from iris.commons.filesplit import split_lines
+from iris.commons.models import (
+    MeasurementRoundRequest,
+    ProbingStatistics,
+    ResultsFormat,
+)
 from iris.commons.redis import Redis
-from iris.commons.storage import Storage, results_key
+from iris.commons.storage import (
+    Storage,
+    StreamUpload,
+    results_chunk_key,
+    results_key,
+    results_manifest_key,
+)
 
 
 async def outer_pipeline(
@@ -25,52 +44,182 @@ async def outer_pipeline(
         settings.AGENT_RESULTS_DIR_PATH / request.measurement_uuid
     )
     measurement_results_path.mkdir(exist_ok=True)
-
-    results_filepath = measurement_results_path / results_key(request.round)
-
-    logger.info("Download CSV probe file locally")
-    probes_filepath = await storage.download_file_to(
-        storage.measurement_agent_bucket(request.measurement_uuid, settings.AGENT_UUID),
-        request.probe_filename,
-        settings.AGENT_TARGETS_DIR_PATH,
+    measurement_targets_path = (
+        settings.AGENT_TARGETS_DIR_PATH / request.measurement_uuid
     )
+    measurement_targets_path.mkdir(exist_ok=True)
 
-    logger.info("Probe file: %s", request.probe_filename)
-    logger.info("%s", request.round)
-    logger.info("Requested probing rate: %s", request.probing_rate)
+    try:
+        results_filepath = measurement_results_path / results_key(request.round)
 
-    probing_start_time = datetime.utcnow()
-    prober_statistics = await caracal_backend(
-        settings, request, logger, redis, probes_filepath, results_filepath
-    )
-
-    if prober_statistics:
-        logger.info("Upload probing statistics to Redis")
-        statistics = ProbingStatistics(
-            round=request.round,
-            start_time=probing_start_time,
-            end_time=datetime.utcnow(),
-            **prober_statistics,
-        )
-        await redis.set_measurement_stats(
-            request.measurement_uuid, settings.AGENT_UUID, statistics
+        bucket = storage.measurement_agent_bucket(
+            request.measurement_uuid, settings.AGENT_UUID
         )
+        key = results_key(request.round, request.results_format)
+        results_sink = None
+        chunks: list[str] | None = None
+        uploads: list[StreamUpload] = []
+        # The results are converted to Parquet after probing, so only CSV is streamed.
+        if (
+            settings.AGENT_RESULTS_CHUNK_LINES
+            and request.results_format == ResultsFormat.CSV
+        ):
+            logger.info("Upload results chunks into S3")
+            # The results are compressed chunk by chunk.
+            results_filepath = results_filepath.with_suffix("")
+            key = results_manifest_key(request.round)
+            chunks = []
+            # The round is probed again if the agent fails before the end of the round,
+            # the worker only keeps the chunks of the attempt listed in the manifest.
+            attempt = uuid4().hex[:8]
+            results_sink = partial(
+                upload_results_chunks,
+                settings,
+                request,
+                redis,
+                storage,
+                measurement_results_path,
+                attempt,
+                chunks,
+            )
+        elif (
+            settings.AGENT_RESULTS_STREAMING
+            and request.results_format == ResultsFormat.CSV
+        ):
+            logger.info("Stream results file into S3")
+            results_sink = partial(upload_results_stream, storage, bucket, key, uploads)
 
-        logger.info("Upload results file into S3")
-        await storage.upload_file(
-            storage.measurement_agent_bucket(
-                request.measurement_uuid, settings.AGENT_UUID
-            ),
-            results_key(request.round),
+        probes_stream = None
+        if settings.AGENT_PROBES_STREAMING:
+            logger.info("Stream CSV probe file")
+            probes_filepath = measurement_targets_path / request.probe_filename
+            probes_stream = storage.iter_file(bucket, request.probe_filename)
+        else:
+            logger.info("Download CSV probe file locally")
+            probes_filepath = await storage.download_file_to(
+                bucket, request.probe_filename, measurement_targets_path
+            )
+
+        logger.info("Probe file: %s", request.probe_filename)
+        logger.info("%s", request.round)
+        logger.info("Requested probing rate: %s", request.probing_rate)
+
+        probing_start_time = datetime.utcnow()
+        prober_statistics = await caracal_backend(
+            settings,
+            request,
+            logger,
+            redis,
+            probes_filepath,
             results_filepath,
+            probes_stream,
+            results_sink,
         )
-    else:
-        logger.warning("Measurement canceled")
 
-    logger.info("Empty local results directory")
-    shutil.rmtree(settings.AGENT_RESULTS_DIR_PATH)
-    settings.AGENT_RESULTS_DIR_PATH.mkdir()
+        if prober_statistics:
+            logger.info("Upload probing statistics to Redis")
+            statistics = ProbingStatistics(
+                round=request.round,
+                start_time=probing_start_time,
+                end_time=datetime.utcnow(),
+                **prober_statistics,
+            )
+            await redis.set_measurement_stats(
+                request.measurement_uuid, settings.AGENT_UUID, statistics
+            )
+
+            if chunks is not None:
+                logger.info("Upload results manifest into S3 (%s chunks)", len(chunks))
+                manifest_filepath = measurement_results_path / key
+                manifest_filepath.write_text(
+                    json.dumps({"attempt": attempt, "chunks": chunks})
+                )
+                await storage.upload_file(bucket, key, manifest_filepath)
+            elif uploads:
+                logger.info("Complete the upload of the results file into S3")
+                await storage.complete_stream_upload(bucket, key, uploads[0])
+            else:
+                results_filepath = await convert_results(
+                    results_filepath, request.results_format, logger
+                )
+                logger.info("Upload results file into S3")
+                await storage.upload_file(bucket, key, results_filepath)
+
+            await redis.notify_results(
+                request.measurement_uuid, settings.AGENT_UUID, key
+            )
+        else:
+            logger.warning("Measurement canceled")
+            for upload in uploads:
+                await storage.abort_stream_upload(bucket, key, upload)
+    finally:
+        # NOTE: The other measurements may be running concurrently,
+        # so we only remove the directories of the current one.
+        logger.info("Remove local measurement directories")
+        shutil.rmtree(measurement_results_path, ignore_errors=True)
+        shutil.rmtree(measurement_targets_path, ignore_errors=True)
+
+
+async def upload_results_stream(
+    storage: Storage,
+    bucket: str,
+    key: str,
+    uploads: list[StreamUpload],
+    stream: AsyncIterable[bytes],
+) -> None:
+    """
+    Upload the results as they are produced, and append the pending upload to
+    `uploads`. The upload is completed once the probing statistics are set,
+    otherwise the worker could find the results file and process the round
+    without them.
+    """
+    uploads.append(await storage.upload_stream_parts(bucket, key, stream))
+
+
+async def upload_results_chunks(
+    settings: AgentSettings,
+    request: MeasurementRoundRequest,
+    redis: Redis,
+    storage: Storage,
+    directory: Path,
+    attempt: str,
+    chunks: list[str],
+    stream: AsyncIterable[bytes],
+) -> None:
+    """
+    Split the results in chunks of `AGENT_RESULTS_CHUNK_LINES` lines and upload
+    each chunk while the next one is being probed, so that the worker can insert
+    it right away. Each chunk starts with the CSV header, and its key is appended
+    to `chunks`.
+    """
+    bucket = storage.measurement_agent_bucket(
+        request.measurement_uuid, settings.AGENT_UUID
+    )
+    loop = asyncio.get_running_loop()
+
+    def write_chunk(filepath: Path, data: bytes) -> None:
+        filepath.write_bytes(ZstdCompressor().compress(data))
+
+    async def upload_chunk(key: str, data: bytes) -> None:
+        filepath = directory / key
+        await loop.run_in_executor(None, write_chunk, filepath, data)
+        await storage.upload_file(bucket, key, filepath)
+        filepath.unlink()
+        await redis.notify_results(request.measurement_uuid, settings.AGENT_UUID, key)
 
-    logger.info("Empty local targets directory")
-    shutil.rmtree(settings.AGENT_TARGETS_DIR_PATH)
-    settings.AGENT_TARGETS_DIR_PATH.mkdir()
+    upload = None
+    try:
+        async for chunk in split_lines(
+            stream, settings.AGENT_RESULTS_CHUNK_LINES, header=True
+        ):
+            # Keep at most one chunk in flight.
+            if upload:
+                await upload
+            chunks.append(results_chunk_key(request.round, attempt, len(chunks)))
+            upload = asyncio.ensure_future(upload_chunk(chunks[-1], chunk))
+        if upload:
+            await upload
+    except BaseException:
+        if upload:
+            upload.cancel()
+        raise
@@ -5,6 +5,7 @@ from uuid import uuid4
 
 from pydantic import root_validator
 
+from iris.commons.models import QueuePolicy
 from iris.commons.settings import CommonSettings
 
 
@@ -16,16 +17,23 @@ class AgentSettings(CommonSettings):
 
     AGENT_UUID: str = str(uuid4())
     AGENT_UUID_FILE: Path | None = None
-    AGENT_MAX_PROBING_RATE: int = 1000  # pps
+    AGENT_MAX_PROBING_RATE: int = 1000  # pps, split when the concurrent rounds start
+    AGENT_CONCURRENCY: int = 1  # number of rounds probed concurrently
+    AGENT_QUEUE_POLICY: QueuePolicy = QueuePolicy.Random  # order of the requests
+    AGENT_QUEUE_TIMEOUT: float = 60  # seconds before re-scanning an empty queue
+    AGENT_QUEUE_USAGE_HALF_LIFE: float = 86400  # seconds, fair policy (0 = no decay)
     AGENT_MIN_TTL: int = -1  # A value < 0 will trigger `find_exit_ttl`
     AGENT_MIN_TTL_FIND_TARGET: str = "example.org"
     AGENT_RIPE_ATLAS_KEY: str = ""
     AGENT_TAGS: str = "all"  # comma-separated list of tags
 
+    AGENT_PROBES_STREAMING: bool = False  # probe while downloading the probes file
+    AGENT_RESULTS_STREAMING: bool = False  # upload the results while probing
+    AGENT_RESULTS_CHUNK_LINES: int = 0  # upload the results in chunks, 0 to disable
     AGENT_TARGETS_DIR_PATH: Path = Path("iris_data/agent/targets")
     AGENT_RESULTS_DIR_PATH: Path = Path("iris_data/agent/results")
 
-    AGENT_STOPPER_REFRESH: int = 1  # seconds
+    AGENT_PROGRESS_INTERVAL: float = 1  # seconds
 
     @root_validator
     def load_or_save_uuid(cls, values):
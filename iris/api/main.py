@@ -1,4 +1,6 @@
 """API Entrypoint."""
+from contextlib import asynccontextmanager
+
 import botocore.exceptions
 from fastapi import Depends, FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
@@ -11,11 +13,21 @@ from iris import __version__
 from iris.api import agents, maintenance, measurements, status, targets, users
 from iris.api.authentication import current_superuser
 from iris.api.settings import APISettings
+from iris.commons.dependencies import close_pools, dispose_engines, get_logger
+from iris.commons.storage import Storage
 
 
 def make_app(*args, settings: APISettings | None = None) -> FastAPI:
     settings = settings or APISettings()
 
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        # Close the connections shared by all the requests.
+        await Storage(settings, get_logger()).close()
+        await close_pools()
+        dispose_engines()
+
     app = FastAPI(
         title="🕸️ Iris",
         description="""
@@ -32,6 +44,7 @@ def make_app(*args, settings: APISettings | None = None) -> FastAPI:
             "displayRequestDuration": True,
             "tryItOutEnabled": True,
         },
+        lifespan=lifespan,
     )
 
     app.add_middleware(PrometheusMiddleware)
@@ -3,16 +3,16 @@ from datetime import datetime
 from uuid import UUID, uuid4
 
 from fastapi import APIRouter, Body, Depends, Response, status
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from iris.api.authentication import current_superuser
 from iris.api.measurements import assert_measurement_visibility, cancel_measurement
 from iris.api.settings import APISettings
 from iris.commons.clickhouse import ClickHouse
 from iris.commons.dependencies import (
+    get_async_session,
     get_clickhouse,
     get_redis,
-    get_session,
     get_settings,
     get_storage,
 )
@@ -95,11 +95,11 @@ async def delete_measurement(
     clickhouse: ClickHouse = Depends(get_clickhouse),
     user: User = Depends(current_superuser),
     redis: Redis = Depends(get_redis),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     settings: APISettings = Depends(get_settings),
     storage: Storage = Depends(get_storage),
 ):
-    measurement = Measurement.get(session, str(measurement_uuid))
+    measurement = await Measurement.get(session, str(measurement_uuid))
     assert_measurement_visibility(measurement, user, settings)
     # (1) Ensure that the measurement is not running anymore
     await cancel_measurement(
@@ -118,7 +118,7 @@ async def delete_measurement(
             targets_key(agent.measurement_uuid, agent.agent_uuid),
         )
         # (4) Delete measurement metadata
-        session.delete(agent)
-    session.delete(measurement)
-    session.commit()
+        await session.delete(agent)
+    await session.delete(measurement)
+    await session.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
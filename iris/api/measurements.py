@@ -1,15 +1,19 @@
 """Measurements operations."""
-import asyncio
 from datetime import datetime
 from uuid import UUID
 
 from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request, status
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from iris.api.authentication import current_active_user
 from iris.api.settings import APISettings
 from iris.api.validator import target_file_validator
-from iris.commons.dependencies import get_redis, get_session, get_settings, get_storage
+from iris.commons.dependencies import (
+    get_async_session,
+    get_redis,
+    get_settings,
+    get_storage,
+)
 from iris.commons.models import (
     Agent,
     Measurement,
@@ -89,7 +93,7 @@ async def get_measurements(
     offset: int = Query(0, ge=0),
     limit: int = Query(20, ge=0, le=200),
     user: User = Depends(current_active_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     if not only_mine and not user.is_superuser:
         raise HTTPException(
@@ -100,8 +104,8 @@ async def get_measurements(
     if tag:
         tags.append(tag)
     user_id = str(user.id) if only_mine else None
-    count = Measurement.count(session, state=state, tags=tags, user_id=user_id)
-    measurements = Measurement.all(
+    count = await Measurement.count(session, state=state, tags=tags, user_id=user_id)
+    measurements = await Measurement.all(
         session,
         state=state,
         tags=tags,
@@ -137,10 +141,16 @@ async def post_measurement(
     ),
     user: User = Depends(current_active_user),
     redis: Redis = Depends(get_redis),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     storage: Storage = Depends(get_storage),
     settings: APISettings = Depends(get_settings),
 ):
+    if measurement_body.priority and not user.is_superuser:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only superusers can set the priority of a measurement",
+        )
+
     active_agents = await redis.get_agents_by_uuid()
 
     agents: dict[str, MeasurementAgentCreate] = {}
@@ -180,9 +190,10 @@ async def post_measurement(
         user_id=str(user.id),
         tool=measurement_body.tool,
         tags=measurement_body.tags,
+        priority=measurement_body.priority,
     )
     session.add(measurement)
-    session.commit()
+    await session.commit()
 
     measurement_agents = [
         MeasurementAgent(
@@ -197,7 +208,7 @@ async def post_measurement(
         for agent in agents.values()
     ]
     session.add_all(measurement_agents)
-    session.commit()
+    await session.commit()
 
     for agent in agents.values():
         await storage.copy_file_to_bucket(
@@ -227,10 +238,10 @@ async def post_measurement(
 async def get_measurement(
     measurement_uuid: UUID,
     user: User = Depends(current_active_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     settings: APISettings = Depends(get_settings),
 ):
-    measurement = Measurement.get(session, str(measurement_uuid))
+    measurement = await Measurement.get(session, str(measurement_uuid))
     assert_measurement_visibility(measurement, user, settings)
     return MeasurementReadWithAgents.from_measurement(measurement)
 
@@ -251,13 +262,13 @@ async def patch_measurement(
         ],
     ),
     user: User = Depends(current_active_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     settings: APISettings = Depends(get_settings),
 ):
-    measurement = Measurement.get(session, str(measurement_uuid))
+    measurement = await Measurement.get(session, str(measurement_uuid))
     assert_measurement_visibility(measurement, user, settings)
     if tags := measurement_body.tags:
-        measurement.set_tags(session, tags)
+        await measurement.set_tags(session, tags)
     return await get_measurement(
         measurement_uuid=measurement_uuid,
         user=user,
@@ -275,11 +286,11 @@ async def get_measurement_agent_target(
     measurement_uuid: UUID,
     agent_uuid: UUID,
     user: User = Depends(current_active_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     settings: APISettings = Depends(get_settings),
     storage: Storage = Depends(get_storage),
 ):
-    measurement = Measurement.get(session, str(measurement_uuid))
+    measurement = await Measurement.get(session, str(measurement_uuid))
     assert_measurement_visibility(measurement, user, settings)
     target_file = await storage.get_file_no_retry(
         storage.archive_bucket(measurement.user_id),
@@ -297,22 +308,21 @@ async def cancel_measurement(
     measurement_uuid: UUID,
     user: User = Depends(current_active_user),
     redis: Redis = Depends(get_redis),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     settings: APISettings = Depends(get_settings),
 ):
-    measurement = Measurement.get(session, str(measurement_uuid))
+    measurement = await Measurement.get(session, str(measurement_uuid))
     assert_measurement_visibility(measurement, user, settings)
-    aws = [
-        cancel_measurement_agent(
+    # NOTE: The session cannot be used concurrently, so we cancel
+    # the measurement agents one by one.
+    for agent in measurement.agents:
+        await cancel_measurement_agent(
             measurement_uuid=UUID(agent.measurement_uuid),
             agent_uuid=UUID(agent.agent_uuid),
             user=user,
             redis=redis,
             session=session,
         )
-        for agent in measurement.agents
-    ]
-    await asyncio.gather(*aws)
     return await get_measurement(
         measurement_uuid=measurement_uuid,
         user=user,
@@ -331,9 +341,9 @@ async def cancel_measurement_agent(
     agent_uuid: UUID,
     user: User = Depends(current_active_user),
     redis: Redis = Depends(get_redis),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    measurement_agent = MeasurementAgent.get(
+    measurement_agent = await MeasurementAgent.get(
         session, str(measurement_uuid), str(agent_uuid)
     )
     assert_measurement_agent_visibility(measurement_agent, user)
@@ -341,5 +351,5 @@ async def cancel_measurement_agent(
     measurement_agent.state = MeasurementAgentState.Canceled
     measurement_agent.end_time = datetime.utcnow()
     session.add(measurement_agent)
-    session.commit()
+    await session.commit()
     return measurement_agent
@@ -18,3 +18,4 @@ class APISettings(CommonSettings):
     API_JWT_LIFETIME: int = 3600  # seconds
 
     API_READ_ONLY: bool = False
+    API_STATUS_BUCKETS_TTL: int = 60  # seconds, cache of the number of buckets
@@ -1,10 +1,16 @@
 from collections import Counter
 
-from aioboto3 import Session
 from fastapi import APIRouter, Depends
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from iris import __version__
-from iris.commons.dependencies import get_redis, get_session, get_storage
+from iris.api.settings import APISettings
+from iris.commons.dependencies import (
+    get_async_session,
+    get_redis,
+    get_settings,
+    get_storage,
+)
 from iris.commons.models import Measurement
 from iris.commons.models.status import Status
 from iris.commons.redis import Redis
@@ -16,18 +22,21 @@ router = APIRouter()
 @router.get("/", response_model=Status, summary="Get Iris status")
 async def get_status(
     redis: Redis = Depends(get_redis),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
+    settings: APISettings = Depends(get_settings),
     storage: Storage = Depends(get_storage),
 ):
     agents = await redis.get_agents()
     agents_by_state = Counter(a.state for a in agents)
-    buckets = await storage.get_measurement_buckets()
-    # TODO: Optimize this. Perform the aggregation in-db?
-    measurements = Measurement.all(session)
-    measurements_by_state = Counter(m.state for m in measurements)
+    # Listing the buckets is slow, so their number is cached.
+    buckets = await redis.get_buckets_count()
+    if buckets is None:
+        buckets = len(await storage.get_measurement_buckets())
+        await redis.set_buckets_count(buckets, settings.API_STATUS_BUCKETS_TTL)
+    measurements_by_state = await Measurement.count_by_state(session)
     return Status(
         agents=agents_by_state,
-        buckets=len(buckets),
+        buckets=buckets,
         measurements=measurements_by_state,
         version=__version__,
     )
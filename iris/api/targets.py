@@ -34,7 +34,7 @@ async def get_targets(
     storage: Storage = Depends(get_storage),
 ):
     """Get all target lists."""
-    targets = await storage.get_all_files_no_retry(storage.targets_bucket(str(user.id)))
+    targets = await storage.list_files_no_retry(storage.targets_bucket(str(user.id)))
     summaries = [TargetSummary.from_s3(target) for target in targets]
     return Paginated.from_results(request.url, summaries, len(summaries), offset, limit)
 
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, Query, Request
 from sqlalchemy import func, select
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from iris.api.authentication import (
     cookie_auth_backend,
@@ -8,7 +8,7 @@ from iris.api.authentication import (
     fastapi_users,
     jwt_auth_backend,
 )
-from iris.commons.dependencies import get_session
+from iris.commons.dependencies import get_async_session
 from iris.commons.models import Paginated, User, UserRead
 from iris.commons.models.user import UserCreate, UserUpdate
 
@@ -51,11 +51,11 @@ async def get_users(
     offset: int = Query(0, ge=0),
     limit: int = Query(20, ge=0, le=200),
     _user: User = Depends(current_superuser),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     count_query = select(func.count(User.id))
     user_query = select(User).offset(offset).limit(limit)
-    count = session.execute(count_query).one()[0]
-    users = session.execute(user_query).fetchall()
+    count = (await session.execute(count_query)).one()[0]
+    users = (await session.execute(user_query)).fetchall()
     users = [x[0] for x in users]
     return Paginated.from_results(request.url, users, count, offset, limit)
@@ -1,30 +1,100 @@
 import asyncio
 import os
-from collections.abc import Iterator
-from concurrent.futures import ThreadPoolExecutor
+import re
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime
+from ipaddress import IPv6Network
 from logging import LoggerAdapter
 from pathlib import Path
+from queue import Full, Queue
+from time import monotonic
 from typing import Any
+from weakref import WeakKeyDictionary
 
 from diamond_miner.queries import (
+    CountResultsPerPrefix,
     CreateTables,
     DropTables,
     InsertLinks,
     InsertPrefixes,
     Query,
+    ResultsQuery,
     StoragePolicy,
     links_table,
     prefixes_table,
     results_table,
 )
-from diamond_miner.subsets import subsets_for
+from diamond_miner.subsets import addr_to_network, n_items, split
+from diamond_miner.utilities import common_parameters
+from httpx import AsyncClient, Client, Limits, Timeout
 from pych_client import AsyncClickHouseClient, ClickHouseClient
+from pych_client.base import get_client_args
+from pych_client.exceptions import ClickHouseException
 
-from iris.commons.filesplit import split_compressed_file
+from iris.commons.filesplit import (
+    count_lines,
+    iter_compressed_file,
+    split_compressed_file,
+    split_offset,
+)
+from iris.commons.limiter import ConcurrencyLimiter, WeightedSemaphore
+from iris.commons.metrics import clickhouse_subset_rows, clickhouse_subsets_memory
+from iris.commons.models import Round
 from iris.commons.settings import CommonSettings, fault_tolerant
 
+# MEMORY_LIMIT_EXCEEDED and TOO_MANY_PARTS.
+OVERLOAD_ERROR_CODES = {241, 252}
+
+# The cost of smaller inserts is dominated by their fixed overhead,
+# so they are not used to adjust the insert concurrency.
+MIN_COST_SIZE = 2**26
+
+insert_limiters: dict[tuple[int, int, int], ConcurrencyLimiter] = {}
+insert_limiters_lock = threading.Lock()
+
+# The sync clients are shared by all the threads of the process, while the async
+# clients are bound to the event loop on which their connections were opened.
+clients: dict[tuple, ClickHouseClient] = {}
+async_clients: WeakKeyDictionary = WeakKeyDictionary()
+clients_lock = threading.Lock()
+
+
+def pooled_client_args(settings: CommonSettings) -> dict:
+    """Return the httpx client arguments for a pool of keep-alive connections."""
+    return {
+        **get_client_args(
+            **settings.clickhouse,
+            settings=None,
+            connect_timeout=settings.CLICKHOUSE_CONNECT_TIMEOUT,
+            read_write_timeout=settings.CLICKHOUSE_READ_WRITE_TIMEOUT,
+        ),
+        "limits": Limits(
+            max_connections=settings.CLICKHOUSE_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.CLICKHOUSE_MAX_CONNECTIONS,
+            keepalive_expiry=settings.CLICKHOUSE_KEEPALIVE_EXPIRY,
+        ),
+        # Wait for a free connection rather than failing when the pool is full.
+        "timeout": Timeout(
+            settings.CLICKHOUSE_CONNECT_TIMEOUT,
+            read=settings.CLICKHOUSE_READ_WRITE_TIMEOUT,
+            write=settings.CLICKHOUSE_READ_WRITE_TIMEOUT,
+            pool=None,
+        ),
+    }
+
+
+def pooled_client_key(settings: CommonSettings) -> tuple:
+    return (
+        *settings.clickhouse.values(),
+        settings.CLICKHOUSE_CONNECT_TIMEOUT,
+        settings.CLICKHOUSE_READ_WRITE_TIMEOUT,
+        settings.CLICKHOUSE_MAX_CONNECTIONS,
+        settings.CLICKHOUSE_KEEPALIVE_EXPIRY,
+    )
+
 
 def iter_file(file: str, *, read_size: int = 2**20) -> Iterator[bytes]:
     with open(file, "rb") as f:
@@ -35,26 +105,167 @@ def iter_file(file: str, *, read_size: int = 2**20) -> Iterator[bytes]:
             yield chunk
 
 
+def put_or_done(queue: Queue, item: Any, future: Future) -> bool:
+    """
+    Put an item in the queue of a consumer running in `future`.
+    Returns `False` if the consumer exited before the item could be enqueued.
+    """
+    while not future.done():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def is_overloaded(e: Exception) -> bool:
+    """Whether the exception indicates that the ClickHouse server is overloaded."""
+    if isinstance(e, ClickHouseException):
+        if m := re.search(r"Code: (\d+)", e.error):
+            return int(m.group(1)) in OVERLOAD_ERROR_CODES
+    return False
+
+
 def measurement_id(measurement_uuid: str, agent_uuid: str) -> str:
     return f"{measurement_uuid}__{agent_uuid}"
 
 
+def staging_table(measurement_id_: str, attempt: str) -> str:
+    """The table of the results chunks uploaded by an attempt of the agent."""
+    return f"{results_table(measurement_id_)}__{attempt}"
+
+
+def insert_table(measurement_uuid: str, agent_uuid: str, attempt: str | None) -> str:
+    measurement_id_ = measurement_id(measurement_uuid, agent_uuid)
+    if attempt:
+        return staging_table(measurement_id_, attempt)
+    return results_table(measurement_id_)
+
+
 @dataclass(frozen=True)
 class ClickHouse:
     settings: CommonSettings
     logger: LoggerAdapter
 
+    def client(self) -> ClickHouseClient:
+        """
+        Return the client shared by all the threads of the current process.
+        Its connections are kept alive between queries and must not be closed.
+        """
+        key = pooled_client_key(self.settings)
+        with clients_lock:
+            if key not in clients:
+                # The pych-client constructor does not accept the limits of the
+                # connections pool, so we replace its default httpx client.
+                client = ClickHouseClient(**self.settings.clickhouse)
+                client.client.close()
+                client.client = Client(**pooled_client_args(self.settings))
+                clients[key] = client
+            return clients[key]
+
+    async def async_client(self) -> AsyncClickHouseClient:
+        """
+        Return the async client shared by all the tasks of the current event loop.
+        Its connections are kept alive between queries and are closed by `close`.
+        """
+        key = pooled_client_key(self.settings)
+        loop = asyncio.get_running_loop()
+        with clients_lock:
+            loop_clients = async_clients.setdefault(loop, {})
+            if key in loop_clients:
+                return loop_clients[key]
+        # See `client` for the replacement of the httpx client.
+        client = AsyncClickHouseClient(**self.settings.clickhouse)
+        await client.client.aclose()
+        client.client = AsyncClient(**pooled_client_args(self.settings))
+        with clients_lock:
+            loop_clients = async_clients.setdefault(loop, {})
+            shared = loop_clients.setdefault(key, client)
+        # Another task may have created the client in the meantime.
+        if shared is not client:
+            await client.client.aclose()
+        return shared
+
+    async def close(self) -> None:
+        """Close the async connections opened on the current event loop."""
+        with clients_lock:
+            loop_clients = async_clients.pop(asyncio.get_running_loop(), {})
+        for client in loop_clients.values():
+            await client.client.aclose()
+
     @fault_tolerant
-    async def call(self, query: str, params: dict | None = None) -> list[dict]:
-        async with AsyncClickHouseClient(**self.settings.clickhouse) as client:
-            return await client.json(query, params)
+    async def call(
+        self, query: str, params: dict | None = None, *, timeout: int | None = None
+    ) -> list[dict]:
+        """
+        Run a query and return its result.
+        `timeout` limits the execution time of the query on the server (in seconds).
+        """
+        settings = {"max_execution_time": timeout} if timeout else None
+        client = await self.async_client()
+        return await client.json(query, params, settings=settings)
 
     @fault_tolerant
     async def execute(
         self, query: Query, measurement_id_: str, **kwargs: Any
     ) -> list[dict]:
-        with ClickHouseClient(**self.settings.clickhouse) as client:
-            return query.execute(client, measurement_id_, **kwargs)
+        return query.execute(self.client(), measurement_id_, **kwargs)
+
+    def insert_limiter(self) -> ConcurrencyLimiter:
+        """
+        Return the limiter on the number of concurrent inserts.
+        It is shared by all the measurement agents handled by the current process.
+        """
+        key = (
+            self.settings.CLICKHOUSE_INSERT_CONCURRENCY_INITIAL,
+            self.settings.CLICKHOUSE_INSERT_CONCURRENCY_MIN,
+            self.settings.CLICKHOUSE_INSERT_CONCURRENCY_MAX,
+        )
+        with insert_limiters_lock:
+            if key not in insert_limiters:
+                insert_limiters[key] = ConcurrencyLimiter(*key)
+            return insert_limiters[key]
+
+    def insert_data(self, query: str, data: Iterable[bytes]) -> None:
+        """
+        Run an INSERT query in the current thread and report its latency, or its
+        error, to the insert limiter. A slot must have been acquired beforehand.
+        The time spent waiting for `data` (e.g. for the dispatcher of a streaming
+        insert to feed the other queries) is not counted in the latency, so that
+        it reflects the time taken by the server to ingest the data.
+        """
+        limiter = self.insert_limiter()
+        size = 0
+        waiting = 0.0
+
+        def count(data: Iterable[bytes]) -> Iterator[bytes]:
+            nonlocal size, waiting
+            iterator = iter(data)
+            while True:
+                start = monotonic()
+                chunk = next(iterator, None)
+                waiting += monotonic() - start
+                if chunk is None:
+                    break
+                size += len(chunk)
+                yield chunk
+
+        start = monotonic()
+        try:
+            self.client().execute(query, data=count(data))
+        except Exception as e:
+            limiter.release(overloaded=is_overloaded(e))
+            raise
+        duration = monotonic() - start - waiting
+        limiter.release(cost=duration / size if size >= MIN_COST_SIZE else None)
+        self.logger.info(
+            "Inserted %s bytes in %.1fs (+%.1fs waiting, concurrency limit: %.1f)",
+            size,
+            duration,
+            waiting,
+            limiter.limit,
+        )
 
     async def create_tables(
         self,
@@ -85,11 +296,224 @@ class ClickHouse:
     async def drop_tables(self, measurement_uuid: str, agent_uuid: str) -> None:
         self.logger.info("Deleting tables")
         await self.execute(DropTables(), measurement_id(measurement_uuid, agent_uuid))
+        await self.drop_staging_tables(measurement_uuid, agent_uuid)
+
+    async def create_staging_table(
+        self, measurement_uuid: str, agent_uuid: str, attempt: str
+    ) -> None:
+        """Create the table of the results chunks uploaded by an attempt."""
+        measurement_id_ = measurement_id(measurement_uuid, agent_uuid)
+        await self.call(
+            "CREATE TABLE IF NOT EXISTS {staging:Identifier} AS {results:Identifier}",
+            params={
+                "staging": staging_table(measurement_id_, attempt),
+                "results": results_table(measurement_id_),
+            },
+        )
+
+    async def drop_staging_tables(self, measurement_uuid: str, agent_uuid: str) -> None:
+        """Drop the staging tables of all the attempts."""
+        prefix = staging_table(measurement_id(measurement_uuid, agent_uuid), "")
+        rows = await self.call(
+            """
+            SELECT name FROM system.tables
+            WHERE database = currentDatabase() AND startsWith(name, {prefix:String})
+            """,
+            params={"prefix": prefix},
+        )
+        for row in rows:
+            await self.call(
+                "DROP TABLE IF EXISTS {table:Identifier}",
+                params={"table": row["name"]},
+            )
+
+    async def commit_staging_table(
+        self, measurement_uuid: str, agent_uuid: str, attempt: str
+    ) -> None:
+        """
+        Move the results chunks of the attempt that completed the round into the
+        results table, and drop the chunks of the previous attempts, if any.
+        The parts are moved without being copied, so a retry does not insert them
+        twice.
+        """
+        measurement_id_ = measurement_id(measurement_uuid, agent_uuid)
+        await self.create_staging_table(measurement_uuid, agent_uuid, attempt)
+        # The tables are not partitioned, so all their parts are in partition "all".
+        await self.call(
+            """
+            ALTER TABLE {staging:Identifier}
+            MOVE PARTITION ID 'all' TO TABLE {results:Identifier}
+            """,
+            params={
+                "staging": staging_table(measurement_id_, attempt),
+                "results": results_table(measurement_id_),
+            },
+        )
+        await self.drop_staging_tables(measurement_uuid, agent_uuid)
+
+    async def insert_results(
+        self,
+        measurement_uuid: str,
+        agent_uuid: str,
+        results_filepath: Path,
+        *,
+        attempt: str | None = None,
+    ) -> None:
+        """
+        Insert results file into table, depending on its format.
+        If `attempt` is set, the results are inserted in its staging table.
+        """
+        if results_filepath.suffix == ".parquet":
+            await self.insert_parquet(
+                measurement_uuid, agent_uuid, results_filepath, attempt=attempt
+            )
+        else:
+            await self.insert_csv(
+                measurement_uuid, agent_uuid, results_filepath, attempt=attempt
+            )
+
+    async def insert_parquet(
+        self,
+        measurement_uuid: str,
+        agent_uuid: str,
+        parquet_filepath: Path,
+        *,
+        attempt: str | None = None,
+    ) -> None:
+        """
+        Insert Parquet file into table.
+        ClickHouse reads the row groups in parallel, so a single query is enough.
+        """
+        table = insert_table(measurement_uuid, agent_uuid, attempt)
+        query = f"INSERT INTO {table} FORMAT Parquet"
+
+        def insert() -> None:
+            self.insert_limiter().acquire()
+            self.insert_data(query, iter_file(str(parquet_filepath)))
+
+        await asyncio.get_running_loop().run_in_executor(None, insert)
 
     async def insert_csv(
-        self, measurement_uuid: str, agent_uuid: str, csv_filepath: Path
+        self,
+        measurement_uuid: str,
+        agent_uuid: str,
+        csv_filepath: Path,
+        *,
+        attempt: str | None = None,
     ) -> None:
         """Insert CSV file into table."""
+        if self.settings.CLICKHOUSE_STREAMING_INSERT:
+            await self.insert_csv_streaming(
+                measurement_uuid, agent_uuid, csv_filepath, attempt=attempt
+            )
+        else:
+            await self.insert_csv_split(
+                measurement_uuid, agent_uuid, csv_filepath, attempt=attempt
+            )
+
+    async def insert_csv_streaming(
+        self,
+        measurement_uuid: str,
+        agent_uuid: str,
+        csv_filepath: Path,
+        *,
+        attempt: str | None = None,
+    ) -> None:
+        """
+        Insert CSV file into table without writing intermediate files.
+        The file is decompressed once and its line-aligned chunks are dispatched
+        round-robin to concurrent INSERT queries through bounded queues.
+        Each query is closed after exactly `CLICKHOUSE_PARALLEL_CSV_MAX_LINE` lines
+        (or `CLICKHOUSE_PARALLEL_CSV_MAX_BYTES` bytes, if set).
+        The number of concurrent queries follows the insert limiter.
+        """
+        limiter = self.insert_limiter()
+        max_concurrency = self.settings.CLICKHOUSE_INSERT_CONCURRENCY_MAX
+        self.logger.info("Concurrency limit for inserts: %.1f", limiter.limit)
+
+        table = insert_table(measurement_uuid, agent_uuid, attempt)
+        query = f"INSERT INTO {table} FORMAT CSV"
+
+        def insert(queue: Queue) -> None:
+            self.insert_data(query, iter(queue.get, None))
+
+        def dispatch() -> None:
+            with ThreadPoolExecutor(max_concurrency) as pool:
+                futures = []
+                # (queue, future, lines sent, bytes sent) for each concurrent insert.
+                slots: list[tuple[Queue, Future, int, int]] = []
+
+                def open_slot(blocking: bool) -> tuple[Queue, Future, int, int] | None:
+                    # We only wait for the limiter when we have no open insert,
+                    # otherwise our inserts could starve while holding the slots.
+                    if not limiter.acquire(blocking):
+                        return None
+                    queue: Queue = Queue(
+                        self.settings.CLICKHOUSE_STREAMING_INSERT_BUFFER
+                    )
+                    futures.append(pool.submit(insert, queue))
+                    return queue, futures[-1], 0, 0
+
+                try:
+                    chunks = iter_compressed_file(
+                        str(csv_filepath),
+                        skip_lines=1,
+                        threads=self.settings.CLICKHOUSE_DECOMPRESSION_THREADS,
+                    )
+                    for i, chunk in enumerate(chunks):
+                        if not slots:
+                            slots.append(open_slot(blocking=True))  # type: ignore
+                        elif len(slots) < max_concurrency and (
+                            new_slot := open_slot(blocking=False)
+                        ):
+                            slots.append(new_slot)
+                        slot = i % len(slots)
+                        start = 0
+                        while start < len(chunk):
+                            queue, future, lines, size = slots[slot]
+                            end = split_offset(
+                                chunk,
+                                start,
+                                self.settings.CLICKHOUSE_PARALLEL_CSV_MAX_LINE,
+                                self.settings.CLICKHOUSE_PARALLEL_CSV_MAX_BYTES,
+                                lines,
+                                size,
+                            )
+                            if end > start:
+                                if not put_or_done(queue, chunk[start:end], future):
+                                    future.result()  # Re-raise the insert exception.
+                                lines += count_lines(chunk, start, end)
+                                size += end - start
+                                start = end
+                            if start < len(chunk):
+                                # The current insert is full.
+                                put_or_done(queue, None, future)
+                                if new_slot := open_slot(blocking=len(slots) == 1):
+                                    slots[slot] = new_slot
+                                else:
+                                    # Shrink to follow the limiter.
+                                    del slots[slot]
+                                    slot %= len(slots)
+                            else:
+                                slots[slot] = (queue, future, lines, size)
+                finally:
+                    for queue, future, _, _ in slots:
+                        put_or_done(queue, None, future)
+                self.logger.info("Number of inserts: %s", len(futures))
+                for future in futures:
+                    future.result()
+
+        await asyncio.get_running_loop().run_in_executor(None, dispatch)
+
+    async def insert_csv_split(
+        self,
+        measurement_uuid: str,
+        agent_uuid: str,
+        csv_filepath: Path,
+        *,
+        attempt: str | None = None,
+    ) -> None:
+        """Split CSV file on disk and insert the chunks into table."""
         split_dir = csv_filepath.with_suffix(".split")
         split_dir.mkdir(exist_ok=True)
 
@@ -98,68 +522,138 @@ class ClickHouse:
             str(csv_filepath),
             str(split_dir / "splitted_"),
             self.settings.CLICKHOUSE_PARALLEL_CSV_MAX_LINE,
-            max_estimate_lines=10_000,
+            bytes_per_file=self.settings.CLICKHOUSE_PARALLEL_CSV_MAX_BYTES,
             skip_lines=1,
+            threads=self.settings.CLICKHOUSE_DECOMPRESSION_THREADS,
         )
 
         files = list(split_dir.glob("*"))
         self.logger.info("Number of chunks: %s", len(files))
 
-        concurrency = (os.cpu_count() or 2) // 2
-        self.logger.info("Number of concurrent processes: %s", concurrency)
+        limiter = self.insert_limiter()
+        self.logger.info("Concurrency limit for inserts: %.1f", limiter.limit)
+
+        table = insert_table(measurement_uuid, agent_uuid, attempt)
+        query = f"INSERT INTO {table} FORMAT CSV"
 
         def insert(file):
-            with ClickHouseClient(**self.settings.clickhouse) as client:
-                table = results_table(measurement_id(measurement_uuid, agent_uuid))
-                query = f"INSERT INTO {table} FORMAT CSV"
-                try:
-                    client.execute(query, data=iter_file(file))
-                finally:
-                    os.remove(file)
+            try:
+                limiter.acquire()
+                self.insert_data(query, iter_file(file))
+            finally:
+                os.remove(file)
 
         loop = asyncio.get_running_loop()
-        with ThreadPoolExecutor(concurrency) as pool:
+        with ThreadPoolExecutor(
+            self.settings.CLICKHOUSE_INSERT_CONCURRENCY_MAX
+        ) as pool:
             await asyncio.gather(
                 *[loop.run_in_executor(pool, insert, file) for file in files]
             )
         os.rmdir(split_dir)
 
-    @fault_tolerant
-    async def insert_links(self, measurement_uuid: str, agent_uuid: str) -> None:
-        """Insert the links in the links' table from the flow view."""
+    async def insert_prefixes_and_links(
+        self, measurement_uuid: str, agent_uuid: str, round_: Round | None = None
+    ) -> None:
+        """
+        Insert the invalid prefixes and the links of the results.
+        If `CLICKHOUSE_INCREMENTAL_INSERT` is set, only the results of `round_` are
+        processed and appended to the tables, which then contain intra-round links
+        only (see the setting for the impact on the MDA).
+        Otherwise, the tables are recomputed from all the results.
+        """
         measurement_id_ = measurement_id(measurement_uuid, agent_uuid)
-        await self.call(
-            "TRUNCATE {table:Identifier}",
-            params={"table": links_table(measurement_id_)},
-        )
-        with ClickHouseClient(**self.settings.clickhouse) as client:
-            query = InsertLinks()
-            subsets = subsets_for(query, client, measurement_id_)
-            # We limit the number of concurrent requests since this query
-            # uses a lot of memory (aggregation of the flows table).
-            query.execute_concurrent(
-                client,
-                measurement_id_,
-                subsets=subsets,
-                concurrent_requests=8,
-            )
+        # The sub-rounds of the first round share the same round number.
+        if (
+            self.settings.CLICKHOUSE_INCREMENTAL_INSERT
+            and round_
+            and (round_.number > 1 or round_.offset == 0)
+        ):
+            try:
+                # Appending rows is not idempotent, so we do not retry it.
+                self.insert_prefixes_and_links_(measurement_id_, round_.number)
+                return
+            except Exception:
+                self.logger.exception(
+                    "Cannot insert the prefixes and links of %s", round_
+                )
+        await self.reinsert_prefixes_and_links(measurement_id_)
 
     @fault_tolerant
-    async def insert_prefixes(self, measurement_uuid: str, agent_uuid: str) -> None:
-        """Insert the invalid prefixes in the prefix table."""
-        measurement_id_ = measurement_id(measurement_uuid, agent_uuid)
-        await self.call(
-            "TRUNCATE {table:Identifier}",
-            params={"table": prefixes_table(measurement_id_)},
+    async def reinsert_prefixes_and_links(self, measurement_id_: str) -> None:
+        """Recompute the prefixes and links' tables from all the results."""
+        for table in [prefixes_table(measurement_id_), links_table(measurement_id_)]:
+            await self.call("TRUNCATE {table:Identifier}", params={"table": table})
+        self.insert_prefixes_and_links_(measurement_id_, None)
+
+    def insert_prefixes_and_links_(
+        self, measurement_id_: str, round_eq: int | None
+    ) -> None:
+        client = self.client()
+        prefixes_query = InsertPrefixes(round_eq=round_eq)
+        links_query = InsertLinks(round_eq=round_eq)
+
+        def insert(subset: IPv6Network) -> None:
+            # The links query excludes the invalid prefixes of the subset,
+            # so they must be inserted first. The other subsets are independent.
+            prefixes_query.execute(client, measurement_id_, subsets=(subset,))
+            links_query.execute(client, measurement_id_, subsets=(subset,))
+
+        plan = self.plan_subsets(links_query, measurement_id_)
+        self.execute_plan("prefixes_and_links", plan, insert)
+
+    def plan_subsets(
+        self, query: ResultsQuery, measurement_id_: str
+    ) -> list[tuple[IPv6Network, int]]:
+        """
+        Split the results in subsets of at most `CLICKHOUSE_SUBSET_MAX_ROWS` rows.
+        Return the subsets with their estimated number of rows, largest first.
+        """
+        count_query = CountResultsPerPrefix(**common_parameters(query, ResultsQuery))
+        counts = {
+            addr_to_network(
+                row["prefix"], count_query.prefix_len_v4, count_query.prefix_len_v6
+            ): row["count"]
+            for row in count_query.execute_iter(self.client(), measurement_id_)
+        }
+        subsets = split(counts, self.settings.CLICKHOUSE_SUBSET_MAX_ROWS)
+        plan = [(subset, n_items(counts, subset)) for subset in subsets]
+        return sorted(plan, key=lambda x: x[1], reverse=True)
+
+    def execute_plan(
+        self,
+        name: str,
+        plan: list[tuple[IPv6Network, int]],
+        func: Callable[[IPv6Network], None],
+    ) -> None:
+        """
+        Run `func` on each subset of the plan, concurrently, as long as the
+        estimated memory of the subsets in flight fits in `CLICKHOUSE_SUBSETS_MEMORY`.
+        """
+        row_size = self.settings.CLICKHOUSE_SUBSET_ROW_SIZE
+        semaphore = WeightedSemaphore(self.settings.CLICKHOUSE_SUBSETS_MEMORY)
+        self.logger.info(
+            "Subsets plan for %s: %s subsets, %s rows, largest subset: %s rows",
+            name,
+            len(plan),
+            sum(rows for _, rows in plan),
+            plan[0][1] if plan else 0,
         )
-        with ClickHouseClient(**self.settings.clickhouse) as client:
-            query = InsertPrefixes()
-            subsets = subsets_for(query, client, measurement_id_)
-            # We limit the number of concurrent requests since this query
-            # uses a lot of memory.
-            query.execute_concurrent(
-                client,
-                measurement_id_,
-                subsets=subsets,
-                concurrent_requests=8,
-            )
+        for subset, rows in plan:
+            self.logger.debug("Subset %s: %s rows", subset, rows)
+            clickhouse_subset_rows.labels(name).observe(rows)
+
+        def execute(subset: IPv6Network, rows: int) -> None:
+            memory = rows * row_size
+            semaphore.acquire(memory)
+            clickhouse_subsets_memory.labels(name).inc(memory)
+            try:
+                func(subset)
+            finally:
+                clickhouse_subsets_memory.labels(name).dec(memory)
+                semaphore.release(memory)
+
+        with ThreadPoolExecutor(self.settings.CLICKHOUSE_SUBSETS_CONCURRENCY) as pool:
+            futures = [pool.submit(execute, *x) for x in plan]
+            for future in as_completed(futures):
+                future.result()
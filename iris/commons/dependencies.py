@@ -1,19 +1,26 @@
+import asyncio
+import threading
 from contextlib import asynccontextmanager, contextmanager
+from weakref import WeakKeyDictionary, WeakSet
 
 from fastapi import Depends
 from fastapi_users.db import SQLAlchemyUserDatabase
 from fastapi_users_db_sqlalchemy.access_token import SQLAlchemyAccessTokenDatabase
 from redis import asyncio as aioredis
-from sqlalchemy import create_engine
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from iris.api.settings import APISettings
 from iris.commons.clickhouse import ClickHouse
 from iris.commons.logger import Adapter, base_logger
+from iris.commons.metrics import pool_connections
 from iris.commons.models import User
 from iris.commons.models.user import AccessToken
 from iris.commons.redis import Redis
+from iris.commons.settings import CommonSettings
 from iris.commons.storage import Storage
 from iris.commons.utils import json_serializer
 
@@ -26,42 +33,110 @@ def get_logger():
     return Adapter(base_logger, dict(component="commons"))
 
 
-def get_engine(settings=Depends(get_settings)):
-    # TODO: Connection pooling.
-    engine = create_engine(
-        settings.DATABASE_URL,
-        connect_args=dict(connect_timeout=5),
-        future=True,
-        json_serializer=json_serializer,
+# The sync engines are shared by all the threads of the process, while the async
+# engines and the Redis clients are bound to the event loop on which their
+# connections were opened.
+engines: dict[tuple, Engine] = {}
+async_engines: WeakKeyDictionary = WeakKeyDictionary()
+redis_clients: WeakKeyDictionary = WeakKeyDictionary()
+pools_lock = threading.Lock()
+
+
+def observe_pool(engine: Engine, name: str) -> None:
+    """Export the number of connections opened and in use by the engine pool."""
+    opened = pool_connections.labels(name, "open")
+    in_use = pool_connections.labels(name, "in_use")
+    event.listen(engine, "connect", lambda *_: opened.inc())
+    event.listen(engine, "close", lambda *_: opened.dec())
+    event.listen(engine, "checkout", lambda *_: in_use.inc())
+    event.listen(engine, "checkin", lambda *_: in_use.dec())
+
+
+class ObservedConnectionPool(aioredis.BlockingConnectionPool):
+    """Redis connection pool which keeps track of its connections for the metrics."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections: WeakSet = WeakSet()
+        self.connections_in_use: WeakSet = WeakSet()
+        redis_pools.add(self)
+
+    def make_connection(self):
+        connection = super().make_connection()
+        self.connections.add(connection)
+        return connection
+
+    async def get_connection(self, *args, **kwargs):
+        connection = await super().get_connection(*args, **kwargs)
+        self.connections_in_use.add(connection)
+        return connection
+
+    async def release(self, connection):
+        self.connections_in_use.discard(connection)
+        await super().release(connection)
+
+
+# The connections of the Redis pools are counted when the metrics are collected.
+redis_pools: WeakSet = WeakSet()
+pool_connections.labels("redis", "open").set_function(
+    lambda: sum(c.is_connected for p in list(redis_pools) for c in list(p.connections))
+)
+pool_connections.labels("redis", "in_use").set_function(
+    lambda: sum(len(p.connections_in_use) for p in list(redis_pools))
+)
+
+
+def pool_args(settings: CommonSettings) -> dict:
+    return dict(
+        pool_size=settings.DATABASE_POOL_SIZE,
+        max_overflow=settings.DATABASE_MAX_OVERFLOW,
+        # Discard the connections closed by the server (e.g. on restart).
+        pool_pre_ping=True,
     )
-    try:
-        yield engine
-    finally:
-        engine.dispose()
+
+
+def get_engine(settings=Depends(get_settings)):
+    """Return the SQLAlchemy engine shared by all the threads of the process."""
+    key = (settings.DATABASE_URL, *pool_args(settings).values())
+    with pools_lock:
+        if key not in engines:
+            engines[key] = create_engine(
+                settings.DATABASE_URL,
+                connect_args=dict(connect_timeout=5),
+                future=True,
+                json_serializer=json_serializer,
+                **pool_args(settings),
+            )
+            observe_pool(engines[key], "postgresql")
+        engine = engines[key]
+    yield engine
 
 
 async def get_async_engine(settings=Depends(get_settings)):
-    # TODO: Connection pooling.
-    engine = create_async_engine(
-        settings.DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://"),
-        connect_args=dict(command_timeout=5, timeout=5),
-        future=True,
-    )
-    try:
-        yield engine
-    finally:
-        await engine.dispose()
+    """Return the async SQLAlchemy engine shared by the current event loop."""
+    key = (settings.DATABASE_URL, *pool_args(settings).values())
+    with pools_lock:
+        loop_engines = async_engines.setdefault(asyncio.get_running_loop(), {})
+        if key not in loop_engines:
+            loop_engines[key] = create_async_engine(
+                settings.DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://"),
+                connect_args=dict(command_timeout=5, timeout=5),
+                future=True,
+                **pool_args(settings),
+            )
+            observe_pool(loop_engines[key].sync_engine, "postgresql_async")
+        engine: AsyncEngine = loop_engines[key]
+    yield engine
 
 
-# TODO: Use SQLAlchemy async engine/session for both FastAPI-Users and SQLModel.
-#   => Wait for FastAPI-Users support for SQLModel?
 def get_session(engine=Depends(get_engine)):
     with Session(engine) as session:
         yield session
 
 
 async def get_async_session(engine=Depends(get_async_engine)):
-    async with AsyncSession(engine) as session:
+    # The attributes cannot be lazy-loaded after a commit with an async session.
+    async with AsyncSession(engine, expire_on_commit=False) as session:
         yield session
 
 
@@ -78,18 +153,48 @@ def get_clickhouse(settings=Depends(get_settings), logger=Depends(get_logger)):
 
 
 async def get_redis(settings=Depends(get_settings), logger=Depends(get_logger)):
-    # TODO: Connection pooling.
-    client = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
-    try:
-        yield Redis(client, settings, logger)
-    finally:
+    """Return a Redis interface to the client shared by the current event loop."""
+    key = (settings.REDIS_URL, settings.REDIS_MAX_CONNECTIONS)
+    with pools_lock:
+        loop_clients = redis_clients.setdefault(asyncio.get_running_loop(), {})
+        if key not in loop_clients:
+            # The client closes the connections of the pool when it is closed.
+            loop_clients[key] = aioredis.Redis.from_pool(
+                ObservedConnectionPool.from_url(
+                    settings.REDIS_URL,
+                    decode_responses=True,
+                    max_connections=settings.REDIS_MAX_CONNECTIONS,
+                )
+            )
+        client = loop_clients[key]
+    yield Redis(client, settings, logger)
+
+
+async def close_pools() -> None:
+    """Close the Redis clients and the async engines of the current event loop."""
+    loop = asyncio.get_running_loop()
+    with pools_lock:
+        loop_clients = redis_clients.pop(loop, {})
+        loop_engines = async_engines.pop(loop, {})
+    for client in loop_clients.values():
         await client.aclose()
+    for engine in loop_engines.values():
+        await engine.dispose()
+
+
+def dispose_engines() -> None:
+    """Close the connections of the sync engines of the process."""
+    with pools_lock:
+        for engine in engines.values():
+            engine.dispose()
 
 
 def get_storage(settings=Depends(get_settings), logger=Depends(get_logger)):
     return Storage(settings, logger)
 
 
+get_async_engine_context = asynccontextmanager(get_async_engine)
+get_async_session_context = asynccontextmanager(get_async_session)
 get_engine_context = contextmanager(get_engine)
 get_redis_context = asynccontextmanager(get_redis)
 get_session_context = contextmanager(get_session)
@@ -1,74 +1,284 @@
-from collections.abc import Iterable
-from io import TextIOWrapper
-from math import ceil
-from typing import IO
+import mmap
+from collections import deque
+from collections.abc import AsyncIterable, AsyncIterator, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 
-from iris.commons.utils import zstd_stream_reader, zstd_stream_reader_text
+from zstandard import ZstdDecompressor, frame_header_size, get_frame_parameters
 
-DEFAULT_ESTIMATE_MAX_LINES = 1000
+from iris.commons.utils import zstd_stream_reader
 
+ZSTD_MAGIC_NUMBER = 0xFD2FB528
+ZSTD_SKIPPABLE_MAGIC_NUMBER = 0x184D2A50  # The 4 lower bits are user-defined.
 
-def estimate_line_size(f: IO[bytes], *, max_lines: int = DEFAULT_ESTIMATE_MAX_LINES):
+
+def zstd_frames(data: bytes | mmap.mmap) -> list[tuple[int, int]]:
+    """
+    Return the (offset, size) of the zstd frames in `data`, skipping the
+    skippable frames, by walking the frame and block headers only.
+    >>> from zstandard import ZstdCompressor
+    >>> frame = ZstdCompressor().compress(b"1234\\n")
+    >>> zstd_frames(frame + frame)
+    [(0, 14), (14, 14)]
+    >>> zstd_frames(b"")
+    []
+    >>> zstd_frames(frame + frame[:-1])
+    Traceback (most recent call last):
+    ...
+    ValueError: truncated zstd frame at offset 14
+    """
+    frames = []
+    offset = 0
+    while offset < len(data):
+        magic = int.from_bytes(data[offset : offset + 4], "little")
+        if magic & 0xFFFFFFF0 == ZSTD_SKIPPABLE_MAGIC_NUMBER:
+            offset += 8 + int.from_bytes(data[offset + 4 : offset + 8], "little")
+            continue
+        if magic != ZSTD_MAGIC_NUMBER:
+            raise ValueError(f"invalid zstd frame at offset {offset}")
+        header = data[offset : offset + 18]  # Maximum frame header size.
+        position = offset + frame_header_size(header)
+        while True:
+            if position + 3 > len(data):
+                raise ValueError(f"truncated zstd frame at offset {offset}")
+            block_header = int.from_bytes(data[position : position + 3], "little")
+            last_block = block_header & 1
+            block_type = (block_header >> 1) & 3
+            block_size = block_header >> 3
+            # RLE blocks store a single byte repeated `block_size` times.
+            position += 3 + (1 if block_type == 1 else block_size)
+            if last_block:
+                break
+        if get_frame_parameters(header).has_checksum:
+            position += 4
+        if position > len(data):
+            raise ValueError(f"truncated zstd frame at offset {offset}")
+        frames.append((offset, position - offset))
+        offset = position
+    return frames
+
+
+def iter_decompressed_file(
+    input_file: str, *, read_size: int = 2**20, threads: int = 1
+) -> Iterator[bytes]:
+    """
+    Yield the decompressed content of `input_file` as (non-aligned) chunks.
+    If the file contains several zstd frames (e.g. when written by `pzstd`),
+    up to `threads` frames are decompressed in parallel, in memory.
+    """
+    if threads > 1:
+        with open(input_file, "rb") as f:
+            # mmap does not support empty files.
+            if f.seek(0, 2) > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if len(frames := zstd_frames(data)) > 1:
+                        for frame in decompress_frames(data, frames, threads):
+                            # Keep the chunks small so that they fit in the CPU cache.
+                            view = memoryview(frame)
+                            for i in range(0, len(frame), read_size):
+                                yield bytes(view[i : i + read_size])
+                        return
+    with zstd_stream_reader(input_file) as f:
+        while chunk := f.read(read_size):
+            yield chunk
+
+
+def decompress_frames(
+    data: bytes | mmap.mmap, frames: list[tuple[int, int]], threads: int
+) -> Iterator[bytes]:
+    """Decompress the frames in parallel and yield them in order."""
+
+    def decompress(frame: tuple[int, int]) -> bytes:
+        offset, size = frame
+        # The frame content size is optional, so we cannot use `decompress`.
+        return (
+            ZstdDecompressor().decompressobj().decompress(data[offset : offset + size])
+        )
+
+    with ThreadPoolExecutor(threads) as pool:
+        # Bound the number of decompressed frames held in memory.
+        pending: deque = deque()
+        for frame in frames:
+            if len(pending) >= threads:
+                yield pending.popleft().result()
+            pending.append(pool.submit(decompress, frame))
+        while pending:
+            yield pending.popleft().result()
+
+
+def split_aligned(
+    chunks: Iterable[bytes], split_boundary: bytes = b"\n"
+) -> Iterator[bytes]:
+    """
+    Re-align arbitrary chunks of bytes on `split_boundary`.
+    >>> list(split_aligned([b"12\\n3", b"4\\n56"]))
+    [b'12\\n', b'34\\n', b'56']
+    >>> list(split_aligned([b"12", b"34", b"\\n5", b"678\\n"]))
+    [b'1234\\n', b'5678\\n']
+    >>> list(split_aligned([]))
+    []
+    """
+    leftover = b""
+    for chunk in chunks:
+        end = chunk.rfind(split_boundary)
+        if end < 0:
+            leftover += chunk
+            continue
+        end += len(split_boundary)
+        if leftover:
+            yield leftover + chunk[:end]
+        elif end == len(chunk):
+            yield chunk
+        else:
+            yield chunk[:end]
+        leftover = chunk[end:]
+    if leftover:
+        yield leftover
+
+
+async def split_lines(
+    stream: AsyncIterable[bytes], max_lines: int, *, header: bool = False
+) -> AsyncIterator[bytes]:
+    """
+    Re-split an (unaligned) stream of bytes in chunks of exactly `max_lines` lines,
+    except for the last chunk. Only the newlines of the data that completes
+    a chunk are searched one by one, the others are counted at once.
+    If `header` is set, the first line of the stream is not counted and is
+    repeated at the beginning of each chunk.
+    """
+    chunk = bytearray()
+    prefix = b""
+    lines = -1 if header else 0
+    async for data in stream:
+        start = 0
+        while lines + (n := data.count(b"\n", start)) >= max_lines:
+            end = start
+            for _ in range(max_lines - lines):
+                end = data.index(b"\n", end) + 1
+            chunk += data[start:end]
+            yield bytes(chunk)
+            if header and not prefix:
+                prefix = bytes(chunk[: chunk.find(b"\n") + 1])
+            chunk, lines, start = bytearray(prefix), 0, end
+        chunk += data[start:]
+        lines += n
+    if len(chunk) > len(prefix):
+        yield bytes(chunk)
+
+
+def iter_compressed_file(
+    input_file: str,
+    *,
+    read_size: int = 2**20,
+    skip_lines: int = 0,
+    threads: int = 1,
+) -> Iterator[bytes]:
+    """
+    Decompress `input_file` once and yield line-aligned chunks of bytes,
+    without writing anything to disk.
     """
-    >>> from io import BytesIO
-    >>> estimate_line_size(BytesIO(b""))
+    chunks = iter_decompressed_file(input_file, read_size=read_size, threads=threads)
+    for chunk in split_aligned(chunks, b"\n"):
+        # Chunks are line-aligned, so a line never spans two chunks.
+        while skip_lines and chunk:
+            end = chunk.find(b"\n")
+            chunk = chunk[end + 1 :] if end >= 0 else b""
+            skip_lines -= 1
+        if chunk:
+            yield chunk
+
+
+def count_lines(chunk: bytes, start: int = 0, end: int | None = None) -> int:
+    """
+    Count the lines in `chunk[start:end]`, including an unterminated last line.
+    >>> count_lines(b"1\\n2\\n3")
+    3
+    >>> count_lines(b"1\\n2\\n3\\n", 2)
+    2
+    >>> count_lines(b"")
     0
-    >>> estimate_line_size(BytesIO(b"1234"))
+    """
+    end = len(chunk) if end is None else end
+    if end <= start:
+        return 0
+    return chunk.count(b"\n", start, end) + (chunk[end - 1] != ord("\n"))
+
+
+def split_offset(
+    chunk: bytes,
+    start: int,
+    max_lines: int,
+    max_bytes: int | None = None,
+    lines: int = 0,
+    size: int = 0,
+) -> int:
+    """
+    Return the offset up to which the line-aligned `chunk[start:]` can be appended
+    to a split already containing `lines` lines and `size` bytes, without exceeding
+    `max_lines` lines or `max_bytes` bytes. If the returned offset is smaller than
+    `len(chunk)`, the split is full. A line larger than `max_bytes` is always
+    accepted in an empty split.
+    >>> split_offset(b"1\\n2\\n3\\n", 0, 2)
     4
-    >>> estimate_line_size(BytesIO(b"1234\\n"))
-    5
-    >>> estimate_line_size(BytesIO(b"1234\\n5678\\n"))
-    5
-    """
-    n_lines = 0
-    first_byte = f.tell()
-    wrapper = TextIOWrapper(f)
-    for _ in wrapper:
-        n_lines += 1
-        if n_lines >= max_lines:
-            break
-    bytes_read = f.tell() - first_byte
-    return int(ceil(bytes_read / (n_lines or 1)))
-
-
-def split_stream(
-    stream: IO[str], split_boundary: str, split_size: int, *, read_size: int = 2**20
-) -> Iterable[str | int]:
-    """
-    >>> from io import StringIO
-    >>> list(split_stream(StringIO("1234\\n5678\\n"), "\\n", 5, read_size=5)) # Aligned read
-    [0, '1234\\n', 1, '5678\\n', 2]
-    >>> list(split_stream(StringIO("1234\\n5678\\n"), "\\n", 5, read_size=2)) # Smaller unaligned read
-    [0, '12', '34', '\\n', 1, '5', '67', '8\\n', 2]
-    >>> list(split_stream(StringIO("1234\\n5678\\n"), "\\n", 5, read_size=8)) # Larger unaligned read
-    [0, '1234\\n', 1, '567', '8\\n', 2]
-    >>> list(split_stream(StringIO("1234\\n5678\\n"), "\\n", 2, read_size=3)) # Split and read size smaller than line size
-    [0, '123', '4\\n', 1, '5', '678', '\\n', 2]
-    """
-    bytes_read = 0
-    split_index = 0
+    >>> split_offset(b"1\\n2\\n3\\n", 4, 2)
+    6
+    >>> split_offset(b"1\\n2\\n3\\n", 0, 2, lines=2)
+    0
+    >>> split_offset(b"11\\n22\\n33\\n", 0, 10, max_bytes=7)
+    6
+    >>> split_offset(b"11\\n22\\n33\\n", 0, 10, max_bytes=2)
+    3
+    >>> split_offset(b"11\\n22\\n33\\n", 0, 10, max_bytes=3, size=1)
+    0
+    """
+    end = len(chunk)
+    if lines + count_lines(chunk, start) > max_lines:
+        end = start
+        for _ in range(max_lines - lines):
+            end = chunk.find(b"\n", end) + 1 or len(chunk)
+    if max_bytes and size + end - start > max_bytes:
+        # Cut after the last line that fits in the split.
+        end = chunk.rfind(b"\n", start, start + max_bytes - size) + 1
+        if end <= start and not size:
+            end = chunk.find(b"\n", start) + 1 or len(chunk)
+        end = max(end, start)
+    return end
+
+
+def split_chunks(
+    chunks: Iterable[bytes], max_lines: int, *, max_bytes: int | None = None
+) -> Iterator[int | memoryview]:
+    """
+    Split line-aligned chunks of bytes in splits of at most `max_lines` lines
+    and (optionally) `max_bytes` bytes. The index of each split is yielded before
+    its data.
+    >>> def f(*args, **kwargs):
+    ...     splits = split_chunks(*args, **kwargs)
+    ...     return [x if isinstance(x, int) else bytes(x) for x in splits]
+    >>> f([b"1\\n2\\n3\\n", b"4\\n"], 2)
+    [0, b'1\\n2\\n', 1, b'3\\n', b'4\\n']
+    >>> f([b"1\\n2\\n", b"3\\n4\\n"], 2)
+    [0, b'1\\n2\\n', 1, b'3\\n4\\n']
+    >>> f([b"1\\n22\\n", b"3\\n4"], 10, max_bytes=4)
+    [0, b'1\\n', 1, b'22\\n', 2, b'3\\n4']
+    >>> f([], 2)
+    [0]
+    """
+    split_index, lines, size = 0, 0, 0
     yield split_index
-    while True:
-        chunk = stream.read(read_size)
-        bytes_read += read_size
-        if not chunk:
-            break
-        if bytes_read < split_size:
-            yield chunk
-        else:
-            # The current split is larger than the desired size.
-            s = chunk.split(split_boundary, maxsplit=1)
-            if len(s) == 1:
-                # Boundary not found, continue to yield chunks on this split.
-                yield s[0]
-            else:
-                # Boundary found, increment the split and yield leftover data.
-                yield s[0] + split_boundary
-                bytes_read = len(s[1])
-                split_index += 1
+    for chunk in chunks:
+        view = memoryview(chunk)
+        start = 0
+        while start < len(chunk):
+            end = split_offset(chunk, start, max_lines, max_bytes, lines, size)
+            if end > start:
+                yield view[start:end]
+                lines += count_lines(chunk, start, end)
+                size += end - start
+                start = end
+            if start < len(chunk):
+                # The current split is full.
+                split_index, lines, size = split_index + 1, 0, 0
                 yield split_index
-                if s[1]:
-                    yield s[1]
 
 
 def split_compressed_file(
@@ -76,22 +286,25 @@ def split_compressed_file(
     output_prefix: str,
     lines_per_file: int,
     *,
-    max_estimate_lines: int = DEFAULT_ESTIMATE_MAX_LINES,
+    bytes_per_file: int | None = None,
     skip_lines: int = 0,
+    threads: int = 1,
 ):
-    with zstd_stream_reader(input_file) as f:
-        line_size = estimate_line_size(f, max_lines=max_estimate_lines)
-    split_size = lines_per_file * line_size
-    with zstd_stream_reader_text(input_file) as f:
-        outf = None
-        for _ in range(skip_lines):
-            next(f)
-        for chunk in split_stream(f, "\n", split_size):
+    """
+    Split `input_file` into uncompressed files of at most `lines_per_file` lines
+    (and optionally `bytes_per_file` bytes) named `{output_prefix}_{i}`.
+    The file is decompressed only once and the lines are never decoded.
+    """
+    outf = None
+    chunks = iter_compressed_file(input_file, skip_lines=skip_lines, threads=threads)
+    try:
+        for chunk in split_chunks(chunks, lines_per_file, max_bytes=bytes_per_file):
             if isinstance(chunk, int):
                 if outf:
                     outf.close()
-                outf = open(f"{output_prefix}_{chunk}", "w")
+                outf = open(f"{output_prefix}_{chunk}", "wb")
             else:
                 outf.write(chunk)  # type: ignore
+    finally:
         if outf:
             outf.close()
@@ -0,0 +1,153 @@
+import threading
+from collections import deque
+
+
+class ConcurrencyLimiter:
+    """
+    Thread-safe limit on the number of concurrent operations, adjusted with an
+    additive-increase/multiplicative-decrease (AIMD) policy:
+    - the limit increases by one every `limit` successful operations,
+    - the limit is halved when an operation is overloaded, or when its cost
+      (e.g. its duration per byte) exceeds `tolerance` times the lowest cost of
+      the last `window` operations. Older costs are forgotten, so that a single
+      fast operation does not lower the baseline forever.
+
+    >>> limiter = ConcurrencyLimiter(initial=2, minimum=1, maximum=4)
+    >>> limiter.acquire(), limiter.acquire(), limiter.acquire(blocking=False)
+    (True, True, False)
+    >>> limiter.release(cost=1.0)
+    >>> limiter.release(cost=1.0)
+    >>> limiter.limit
+    3.0
+    >>> limiter.acquire(); limiter.release(cost=10.0)
+    True
+    >>> limiter.limit
+    1.5
+    >>> limiter.acquire(); limiter.release(overloaded=True)
+    True
+    >>> limiter.limit
+    1.0
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int,
+        maximum: int,
+        *,
+        tolerance: float = 2.0,
+        window: int = 64,
+    ):
+        if not 1 <= minimum <= maximum:
+            raise ValueError("The limits must satisfy 1 <= minimum <= maximum")
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.costs: deque[float] = deque(maxlen=window)
+        self.condition = threading.Condition()
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Wait for a free slot, or return `False` if none is free and non-blocking."""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.in_flight += 1
+            return True
+
+    def release(self, *, cost: float | None = None, overloaded: bool = False) -> None:
+        """Release a slot and update the limit from the outcome of the operation."""
+        with self.condition:
+            self.in_flight -= 1
+            if cost is not None:
+                self.costs.append(cost)
+            if overloaded or (cost and cost > self.tolerance * min(self.costs)):
+                self.limit = max(float(self.minimum), self.limit / 2)
+            elif cost is not None:
+                self.limit = min(self.maximum, self.limit + 1 / int(self.limit))
+            self.condition.notify_all()
+
+
+class WeightedSemaphore:
+    """
+    Thread-safe semaphore where each operation acquires a different amount of
+    a shared capacity (e.g. its estimated memory usage). An operation larger than
+    the capacity is allowed when nothing else is in flight.
+
+    >>> semaphore = WeightedSemaphore(10)
+    >>> semaphore.acquire(6), semaphore.acquire(6, blocking=False)
+    (True, False)
+    >>> semaphore.acquire(4), semaphore.in_flight
+    (True, 10)
+    >>> semaphore.release(6); semaphore.release(4)
+    >>> semaphore.acquire(20), semaphore.in_flight
+    (True, 20)
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount: int, blocking: bool = True) -> bool:
+        """Wait for `amount` to be available, or return `False` if non-blocking."""
+        with self.condition:
+            while self.in_flight and self.in_flight + amount > self.capacity:
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.in_flight += amount
+            return True
+
+    def release(self, amount: int) -> None:
+        with self.condition:
+            self.in_flight -= amount
+            self.condition.notify_all()
+
+
+class RateBudget:
+    """
+    Thread-safe split of a total rate (e.g. packets per second) between at most
+    `slots` concurrent operations. Each operation gets the rate it asks for,
+    up to what remains once a fair share (`total / slots`) is kept for each of
+    the other free slots, and at least 1. Since there are at most `total` slots,
+    the sum of the rates in use never exceeds `total`.
+    The rate of an operation is fixed when it starts: the rate released by an
+    operation is only given to the next ones, and not to those in progress.
+
+    >>> budget = RateBudget(total=100, slots=2)
+    >>> budget.acquire(80), budget.acquire(80)
+    (50, 50)
+    >>> budget.release(50); budget.acquire(20)
+    20
+    >>> budget.release(50); budget.release(20); budget.acquire(10), budget.acquire(100)
+    (10, 90)
+    """
+
+    def __init__(self, total: int, slots: int):
+        if not 0 < slots <= total:
+            raise ValueError("The number of slots must be between 1 and the total")
+        self.total = total
+        self.slots = slots
+        self.active = 0
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, rate: int) -> int:
+        """Return the rate allotted to an operation asking for `rate`."""
+        with self.lock:
+            # Each free slot is left at least 1, so the `max` never exceeds `total`.
+            free_slots = max(self.slots - self.active - 1, 0)
+            reserved = free_slots * self.total // self.slots
+            allotted = max(min(rate, self.total - self.in_use - reserved), 1)
+            self.active += 1
+            self.in_use += allotted
+            return allotted
+
+    def release(self, rate: int) -> None:
+        with self.lock:
+            self.active -= 1
+            self.in_use -= rate
@@ -0,0 +1,22 @@
+from prometheus_client import Gauge, Histogram
+
+clickhouse_subset_rows = Histogram(
+    "iris_clickhouse_subset_rows",
+    "Estimated number of results rows per subset query.",
+    ["query"],
+    buckets=(1e4, 1e5, 1e6, 2e6, 4e6, 8e6, 16e6, float("inf")),
+)
+
+clickhouse_subsets_memory = Gauge(
+    "iris_clickhouse_subsets_memory_bytes",
+    "Estimated memory used by the subset queries in flight.",
+    ["query"],
+    multiprocess_mode="livesum",
+)
+
+pool_connections = Gauge(
+    "iris_pool_connections",
+    "Connections opened and in use by the PostgreSQL and Redis pools.",
+    ["pool", "state"],
+    multiprocess_mode="livesum",
+)
@@ -1,10 +1,12 @@
 # It is important for all the models depending on Base to be imported here,
 # so that they are properly registered and seen by alembic.
-from iris.commons.models.agent import Agent, AgentParameters, AgentState
+from iris.commons.models.agent import Agent, AgentParameters, AgentState, QueuePolicy
 from iris.commons.models.base import Base
 from iris.commons.models.diamond_miner import (
     FlowMapper,
+    ProbingProgress,
     ProbingStatistics,
+    ResultsFormat,
     Tool,
     ToolParameters,
 )
@@ -40,10 +42,13 @@ __all__ = (
     "AgentState",
     "AgentParameters",
     "Agent",
+    "QueuePolicy",
     "FlowMapper",
     "Tool",
     "ToolParameters",
+    "ProbingProgress",
     "ProbingStatistics",
+    "ResultsFormat",
     "MeasurementBase",
     "MeasurementCreate",
     "MeasurementPatch",
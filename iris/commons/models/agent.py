@@ -4,6 +4,7 @@ from ipaddress import IPv4Address, IPv6Address
 from pydantic import Field, NonNegativeInt
 
 from iris.commons.models.base import BaseModel
+from iris.commons.models.diamond_miner import ResultsFormat
 
 
 class AgentState(Enum):
@@ -12,6 +13,15 @@ class AgentState(Enum):
     Working = "working"
 
 
+class QueuePolicy(Enum):
+    """The order in which an agent picks the requests in its queue."""
+
+    Random = "random"
+    Priority = "priority"  # Highest measurement priority first, then oldest first.
+    Shortest = "shortest"  # Fewest probes first.
+    Fair = "fair"  # User with the fewest probes sent first, then oldest first.
+
+
 class AgentParameters(BaseModel):
     version: str
     hostname: str
@@ -31,6 +41,9 @@ class AgentParameters(BaseModel):
         description="Maximum Probing Rate allowed by the agent",
     )
     tags: list[str] = Field(default_factory=list)
+    results_formats: list[ResultsFormat] = Field(
+        [ResultsFormat.CSV], title="Results formats supported by the agent"
+    )
 
 
 class Agent(BaseModel):
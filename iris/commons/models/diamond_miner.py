@@ -2,7 +2,7 @@ from datetime import datetime
 from enum import Enum
 from typing import Any
 
-from pydantic import Field, NonNegativeInt
+from pydantic import Field, NonNegativeFloat, NonNegativeInt
 
 from iris.commons.models.base import BaseModel
 from iris.commons.models.round import Round
@@ -22,6 +22,11 @@ class Tool(Enum):
     Probes = "probes"
 
 
+class ResultsFormat(Enum):
+    CSV = "csv"
+    Parquet = "parquet"
+
+
 class ToolParameters(BaseModel):
     initial_source_port: int = Field(
         24000, title="Initial source port", gt=0, lt=65_536
@@ -39,6 +44,12 @@ class ToolParameters(BaseModel):
     )
     prefix_len_v4: int = Field(24, ge=0, le=32, title="Target prefix length (IPv4)")
     prefix_len_v6: int = Field(64, ge=0, le=128, title="Target prefix length (IPv6)")
+    results_format: ResultsFormat = Field(
+        ResultsFormat.CSV,
+        title="Results format",
+        description="Format of the results sent by the agent to the worker. "
+        "Falls back to CSV if the agent does not support it",
+    )
     global_min_ttl: int = Field(
         0,
         ge=0,
@@ -79,3 +90,15 @@ class ProbingStatistics(BaseModel):
     pcap_received: NonNegativeInt
     pcap_dropped: NonNegativeInt
     pcap_interface_dropped: NonNegativeInt
+
+
+class ProbingProgress(BaseModel):
+    round: Round
+    time: datetime
+    probing_rate: NonNegativeInt  # The maximum probing rate, in packets per second.
+    sending_rate: NonNegativeFloat  # Since the previous report.
+    packets_sent: NonNegativeInt
+    packets_failed: NonNegativeInt
+    packets_received: NonNegativeInt
+    pcap_dropped: NonNegativeInt
+    pcap_interface_dropped: NonNegativeInt
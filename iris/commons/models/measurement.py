@@ -3,9 +3,12 @@ from typing import Optional
 from uuid import uuid4
 
 from pydantic import root_validator
-from sqlalchemy import desc
+from sqlalchemy import case, desc, event, literal, update
 from sqlalchemy.dialects.postgresql import ARRAY
-from sqlmodel import Column, Enum, Field, Relationship, Session, String, func, select
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import Column, Enum, Field, Relationship, String, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from iris.commons.models.base import BaseSQLModel
 from iris.commons.models.diamond_miner import Tool
@@ -26,6 +29,15 @@ class MeasurementBase(BaseSQLModel):
     tags: list[str] = Field(
         default_factory=list, sa_column=Column(ARRAY(String)), title="Tags"
     )
+    priority: int = Field(
+        0,
+        ge=-10,
+        le=10,
+        title="Priority",
+        description="Rounds of measurements with a higher priority are probed first"
+        " by the agents using the `priority` queue policy"
+        " (only superusers can set a non-zero priority)",
+    )
 
 
 class MeasurementCreate(MeasurementBase):
@@ -79,9 +91,7 @@ class MeasurementRead(MeasurementBase):
 
     @classmethod
     def from_measurement(cls, m: "Measurement") -> "MeasurementRead":
-        # TODO: Try to get rid of this by having Pydantic/SQLModel take into account
-        # computed properties (@property).
-        return cast(cls, m, start_time=m.start_time, end_time=m.end_time, state=m.state)
+        return cast(cls, m)
 
     @classmethod
     def from_measurements(cls, ms: list["Measurement"]) -> list["MeasurementRead"]:
@@ -103,11 +113,19 @@ class Measurement(MeasurementBase, table=True):
     creation_time: datetime = Field(default_factory=datetime.utcnow, nullable=False)
     user_id: str  # TODO: FK constraint with UserTable?
     agents: list[MeasurementAgent] = Relationship(back_populates="measurement")
+    # NOTE: The state and times are aggregated from the agents on every flush,
+    # see `update_measurements`.
+    state: MeasurementAgentState = Field(
+        default=MeasurementAgentState.Created,
+        sa_column=Column(Enum(MeasurementAgentState), index=True, nullable=False),
+    )
+    start_time: datetime | None = Field(default=None)
+    end_time: datetime | None = Field(default=None)
 
     @classmethod
-    def all(
+    async def all(
         cls,
-        session: Session,
+        session: AsyncSession,
         *,
         state: MeasurementAgentState | None = None,
         tags: list[str] = None,
@@ -115,24 +133,32 @@ class Measurement(MeasurementBase, table=True):
         offset: int | None = None,
         limit: int | None = None,
     ) -> list["Measurement"]:
+        """
+        Return the measurements with their agents loaded in a single extra query.
+        Only the agents UUIDs are loaded, the other columns cannot be accessed
+        with an async session.
+        """
         query = (
             select(Measurement)
+            .options(
+                selectinload(Measurement.agents).load_only(MeasurementAgent.agent_uuid)
+            )
             .offset(offset)
             .limit(limit)
             .order_by(desc(Measurement.creation_time))
         )
         if state:
-            query = query.where(Measurement.agents.any(state=state))
+            query = query.where(Measurement.state == state)
         if tags:
             query = query.where(Measurement.tags.contains(tags))
         if user_id:
             query = query.where(Measurement.user_id == user_id)
-        return session.exec(query).all()
+        return (await session.exec(query)).all()
 
     @classmethod
-    def count(
+    async def count(
         cls,
-        session: Session,
+        session: AsyncSession,
         *,
         state: MeasurementAgentState | None = None,
         tags: list[str] = None,
@@ -140,50 +166,138 @@ class Measurement(MeasurementBase, table=True):
     ) -> int:
         query = select(func.count(Measurement.uuid))  # type: ignore
         if state:
-            query = query.where(Measurement.agents.any(state=state))
+            query = query.where(Measurement.state == state)
         if tags:
             query = query.where(Measurement.tags.contains(tags))
         if user_id:
             query = query.where(Measurement.user_id == user_id)
-        return int(session.exec(query).one())
+        return int((await session.exec(query)).one())
+
+    @classmethod
+    async def count_by_state(
+        cls, session: AsyncSession
+    ) -> dict[MeasurementAgentState, int]:
+        """Count the measurements in each state, with a single query."""
+        query = select(Measurement.state, func.count()).group_by(Measurement.state)
+        return {state: count for state, count in await session.execute(query)}
 
     @classmethod
-    def get(cls, session: Session, uuid: str) -> Optional["Measurement"]:
-        return session.get(Measurement, uuid)
-
-    @property
-    def start_time(self):
-        try:
-            return min(x.start_time for x in self.agents)
-        except (TypeError, ValueError):
-            return None
-
-    @property
-    def end_time(self):
-        try:
-            return max(x.end_time for x in self.agents)
-        except (TypeError, ValueError):
-            return None
-
-    @property
-    def state(self):
-        agents_state = {x.state for x in self.agents}
-        # If all the agents are in are the same state, return it.
-        if len(agents_state) == 1:
-            return agents_state.pop()
-        # If all the agents are in a terminal state, return Finished.
-        if agents_state.issubset(
-            {
-                MeasurementAgentState.AgentFailure,
-                MeasurementAgentState.Canceled,
-                MeasurementAgentState.Finished,
-            }
-        ):
-            return MeasurementAgentState.Finished
-        # Otherwise, return Ongoing.
-        return MeasurementAgentState.Ongoing
-
-    def set_tags(self, session: Session, tags: list[str]) -> None:
+    async def get(cls, session: AsyncSession, uuid: str) -> Optional["Measurement"]:
+        # The agents cannot be lazy-loaded with an async session,
+        # and they may have been added since the measurement was loaded.
+        query = (
+            select(Measurement)
+            .options(selectinload(Measurement.agents))
+            .where(Measurement.uuid == uuid)
+            .execution_options(populate_existing=True)
+        )
+        return (await session.exec(query)).first()
+
+    async def set_tags(self, session: AsyncSession, tags: list[str]) -> None:
         self.tags = tags
         session.add(self)
-        session.commit()
+        await session.commit()
+
+
+def update_measurements_query(uuids: list[str]):
+    """
+    Aggregate the state and times of the measurements from those of their agents:
+    - the state is the state of the agents if they are all in the same state,
+      `Finished` if they are all in a terminal state, `Ongoing` otherwise;
+    - the start (end) time is the earliest (latest) time of the agents,
+      if all of them have started (ended).
+    """
+    measurement = Measurement.__table__  # type: ignore
+    agent = MeasurementAgent.__table__  # type: ignore
+    terminal_states = [
+        MeasurementAgentState.AgentFailure,
+        MeasurementAgentState.Canceled,
+        MeasurementAgentState.Finished,
+    ]
+    n_agents = func.count(agent.c.agent_uuid)
+    aggregates = (
+        select(
+            measurement.c.uuid,
+            case(
+                (func.count(agent.c.state.distinct()) == 1, func.min(agent.c.state)),
+                (
+                    func.coalesce(
+                        func.bool_and(agent.c.state.in_(terminal_states)), True
+                    ),
+                    literal(MeasurementAgentState.Finished, measurement.c.state.type),
+                ),
+                else_=literal(MeasurementAgentState.Ongoing, measurement.c.state.type),
+            ).label("state"),
+            case(
+                (
+                    func.count(agent.c.start_time) == n_agents,
+                    func.min(agent.c.start_time),
+                )
+            ).label("start_time"),
+            case(
+                (func.count(agent.c.end_time) == n_agents, func.max(agent.c.end_time))
+            ).label("end_time"),
+        )
+        .select_from(measurement.outerjoin(agent))
+        .where(measurement.c.uuid.in_(uuids))
+        .group_by(measurement.c.uuid)
+        .subquery()
+    )
+    return (
+        update(measurement)
+        .where(measurement.c.uuid == aggregates.c.uuid)
+        .values(
+            state=aggregates.c.state,
+            start_time=aggregates.c.start_time,
+            end_time=aggregates.c.end_time,
+        )
+        .returning(
+            measurement.c.uuid,
+            measurement.c.state,
+            measurement.c.start_time,
+            measurement.c.end_time,
+        )
+    )
+
+
+def changed_measurements(session: Session) -> list[str]:
+    """Return the UUIDs of the measurements whose agents are added or modified."""
+    uuids = set()
+    for instance in (*session.new, *session.dirty):
+        if isinstance(instance, Measurement) and instance in session.new:
+            uuids.add(instance.uuid)
+        if isinstance(instance, MeasurementAgent) and instance.measurement_uuid:
+            uuids.add(instance.measurement_uuid)
+    # Sort the UUIDs so that the rows are always locked in the same order.
+    return sorted(uuids)
+
+
+@event.listens_for(Session, "before_flush")
+def lock_measurements(session: Session, flush_context, instances) -> None:
+    # Serialize the updates of the agents of a measurement, so that the
+    # aggregation always sees the latest state of the other agents.
+    if uuids := changed_measurements(session):
+        measurement = Measurement.__table__  # type: ignore
+        session.connection().execute(
+            select(measurement.c.uuid)
+            .where(measurement.c.uuid.in_(uuids))
+            .order_by(measurement.c.uuid)
+            .with_for_update()
+        )
+
+
+@event.listens_for(Session, "after_flush")
+def update_measurements(session: Session, flush_context) -> None:
+    if not (uuids := changed_measurements(session)):
+        return
+    measurements = {
+        instance.uuid: instance
+        for instance in (*session.identity_map.values(), *session.new)
+        if isinstance(instance, Measurement)
+    }
+    rows = session.connection().execute(update_measurements_query(uuids))
+    for uuid, state, start_time, end_time in rows:
+        if measurement := measurements.get(uuid):
+            set_committed_value(measurement, "state", state)
+            set_committed_value(measurement, "start_time", start_time)
+            set_committed_value(measurement, "end_time", end_time)
@@ -4,11 +4,17 @@ from typing import TYPE_CHECKING, Optional
 
 from pydantic import root_validator
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlmodel import Column, Enum, Field, Relationship, Session, update
+from sqlalchemy.orm import selectinload
+from sqlmodel import Column, Enum, Field, Relationship, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from iris.commons.models.agent import AgentParameters
 from iris.commons.models.base import BaseSQLModel, PydanticType
-from iris.commons.models.diamond_miner import ProbingStatistics, ToolParameters
+from iris.commons.models.diamond_miner import (
+    ProbingStatistics,
+    ResultsFormat,
+    ToolParameters,
+)
 
 if TYPE_CHECKING:
     from iris.commons.models.measurement import Measurement
@@ -93,13 +99,28 @@ class MeasurementAgent(MeasurementAgentBase, table=True):
     )
 
     @classmethod
-    def get(
-        cls, session: Session, measurement_uuid: str, agent_uuid: str
+    async def get(
+        cls, session: AsyncSession, measurement_uuid: str, agent_uuid: str
     ) -> Optional["MeasurementAgent"]:
-        return session.get(MeasurementAgent, (measurement_uuid, agent_uuid))
+        # The measurement cannot be lazy-loaded with an async session.
+        query = (
+            select(MeasurementAgent)
+            .options(selectinload(MeasurementAgent.measurement))
+            .where(MeasurementAgent.measurement_uuid == measurement_uuid)
+            .where(MeasurementAgent.agent_uuid == agent_uuid)
+            .execution_options(populate_existing=True)
+        )
+        return (await session.exec(query)).first()
+
+    @property
+    def results_format(self) -> ResultsFormat:
+        """The requested results format, if supported by the agent, CSV otherwise."""
+        if self.tool_parameters.results_format in self.agent_parameters.results_formats:
+            return self.tool_parameters.results_format
+        return ResultsFormat.CSV
 
-    def append_probing_statistics(
-        self, session: Session, statistics: ProbingStatistics
+    async def append_probing_statistics(
+        self, session: AsyncSession, statistics: ProbingStatistics
     ):
         # HACK: See comment on `probing_statistics` column.
         statistics_ = statistics.dict()
@@ -112,20 +133,20 @@ class MeasurementAgent(MeasurementAgentBase, table=True):
             .where(MeasurementAgent.agent_uuid == self.agent_uuid)
             .values(probing_statistics=self.probing_statistics)
         )
-        session.execute(query)
-        session.commit()
+        await session.execute(query)
+        await session.commit()
 
-    def set_state(self, session: Session, state: MeasurementAgentState):
+    async def set_state(self, session: AsyncSession, state: MeasurementAgentState):
         self.state = state
         session.add(self)
-        session.commit()
+        await session.commit()
 
-    def set_start_time(self, session: Session, t: datetime):
+    async def set_start_time(self, session: AsyncSession, t: datetime):
         self.start_time = t
         session.add(self)
-        session.commit()
+        await session.commit()
 
-    def set_end_time(self, session: Session, t: datetime):
+    async def set_end_time(self, session: AsyncSession, t: datetime):
         self.end_time = t
         session.add(self)
-        session.commit()
+        await session.commit()
@@ -1,4 +1,5 @@
 from iris.commons.models.base import BaseModel
+from iris.commons.models.diamond_miner import ResultsFormat
 from iris.commons.models.round import Round
 
 
@@ -8,3 +9,8 @@ class MeasurementRoundRequest(BaseModel):
     probing_rate: int | None
     batch_size: int | None
     round: Round
+    results_format: ResultsFormat = ResultsFormat.CSV
+    # Used to schedule the requests in the agent queue.
+    user_id: str | None = None
+    priority: int = 0
+    n_probes: int | None = None
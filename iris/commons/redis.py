@@ -1,22 +1,33 @@
-import asyncio
 import random
+import time
+from collections.abc import Container, Sized
 from dataclasses import dataclass
 from logging import LoggerAdapter
 
 from redis import asyncio as aioredis
+from redis.exceptions import WatchError
 
 from iris.commons.models import (
     Agent,
     AgentParameters,
     AgentState,
     MeasurementRoundRequest,
+    ProbingProgress,
     ProbingStatistics,
+    QueuePolicy,
+    Round,
 )
 from iris.commons.settings import CommonSettings, fault_tolerant
 
 
-def agent_heartbeat_key(uuid: str | None) -> str:
-    return f"agent_heartbeat:{uuid or '*'}"
+def agents_key() -> str:
+    # Set of the UUIDs of the agents registered at least once,
+    # the agents are alive as long as their heartbeat key exists.
+    return "agents"
+
+
+def agent_heartbeat_key(uuid: str) -> str:
+    return f"agent_heartbeat:{uuid}"
 
 
 def agent_parameters_key(uuid: str) -> str:
@@ -31,10 +42,68 @@ def agent_queue_key(uuid: str) -> str:
     return f"agent_queue:{uuid}"
 
 
+def agent_queue_order_key(uuid: str, policy: QueuePolicy) -> str:
+    # Sorted set of the measurement UUIDs in the queue, in the order of the policy.
+    return f"agent_queue_{policy.value}:{uuid}"
+
+
+def agent_queue_events_key(uuid: str) -> str:
+    # List of the measurement UUIDs of the requests added to the queue,
+    # used to wake up the agent.
+    return f"agent_queue_events:{uuid}"
+
+
+def agent_cancel_channel(uuid: str) -> str:
+    # Pub/sub channel of the measurement UUIDs of the requests deleted from the queue.
+    return f"agent_cancel:{uuid}"
+
+
+def agent_usage_key(uuid: str) -> str:
+    # Sorted set of the number of probes sent by the agent for each user.
+    return f"agent_usage:{uuid}"
+
+
+def agent_usage_decay_key(uuid: str) -> str:
+    # Time of the last decay of the agent usage.
+    return f"agent_usage_decay:{uuid}"
+
+
+def queue_user(request: MeasurementRoundRequest) -> str:
+    return request.user_id or ""
+
+
+# The policies which order the requests with a sorted set.
+QUEUE_ORDERS = (QueuePolicy.Priority, QueuePolicy.Shortest, QueuePolicy.Fair)
+
+
+def queue_scores(request: MeasurementRoundRequest) -> dict[QueuePolicy, float]:
+    # The request is indexed for every policy, so that the agents
+    # can change their policy without losing the requests in the queue.
+    now = time.time()
+    return {
+        # Highest priority first, then oldest first.
+        QueuePolicy.Priority: -request.priority * 2**32 + now,
+        QueuePolicy.Shortest: request.n_probes or 0,
+        QueuePolicy.Fair: now,
+    }
+
+
+def buckets_count_key() -> str:
+    return "buckets_count"
+
+
 def measurement_stats_key(measurement_uuid: str, agent_uuid: str) -> str:
     return f"measurement_stats:{measurement_uuid}:{agent_uuid}"
 
 
+def measurement_progress_key(measurement_uuid: str, agent_uuid: str) -> str:
+    return f"measurement_progress:{measurement_uuid}:{agent_uuid}"
+
+
+def results_ready_key(measurement_uuid: str, agent_uuid: str) -> str:
+    return f"results_ready:{measurement_uuid}:{agent_uuid}"
+
+
 @dataclass(frozen=True)
 class Redis:
     client: aioredis.Redis
@@ -45,6 +114,12 @@ class Redis:
     def ns(self) -> str:
         return self.settings.REDIS_NAMESPACE
 
+    @fault_tolerant
+    async def blpop(self, name: str, timeout: float) -> str | None:
+        if item := await self.client.blpop(f"{self.ns}:{name}", timeout):
+            return str(item[1])
+        return None
+
     @fault_tolerant
     async def delete(self, *names: str) -> None:
         names_ = [f"{self.ns}:{name}" for name in names]
@@ -61,6 +136,15 @@ class Redis:
         value: str = await self.client.get(f"{self.ns}:{name}")
         return value
 
+    @fault_tolerant
+    async def getset(self, name: str, value: str) -> str | None:
+        return await self.client.set(f"{self.ns}:{name}", value, get=True)
+
+    @fault_tolerant
+    async def mget(self, *names: str) -> list[str | None]:
+        names_ = [f"{self.ns}:{name}" for name in names]
+        return await self.client.mget(names_)
+
     @fault_tolerant
     async def hdel(self, name: str, *keys: str) -> None:
         await self.client.hdel(f"{self.ns}:{name}", *keys)
@@ -69,10 +153,18 @@ class Redis:
     async def hget(self, name: str, key: str) -> str | None:
         return await self.client.hget(f"{self.ns}:{name}", key)
 
+    @fault_tolerant
+    async def hgetall(self, name: str) -> dict[str, str]:
+        return await self.client.hgetall(f"{self.ns}:{name}")
+
     @fault_tolerant
     async def hkeys(self, name: str) -> list[str]:
         return await self.client.hkeys(f"{self.ns}:{name}")
 
+    @fault_tolerant
+    async def hmget(self, name: str, *keys: str) -> list[str | None]:
+        return await self.client.hmget(f"{self.ns}:{name}", keys)
+
     @fault_tolerant
     async def hset(self, name: str, key: str, value: str) -> None:
         await self.client.hset(f"{self.ns}:{name}", key, value)
@@ -82,17 +174,67 @@ class Redis:
         keys: list[str] = await self.client.keys(f"{self.ns}:{pattern}")
         return keys
 
+    @fault_tolerant
+    async def publish(self, channel: str, message: str) -> None:
+        await self.client.publish(f"{self.ns}:{channel}", message)
+
+    @fault_tolerant
+    async def rpush(self, name: str, *values: str) -> None:
+        await self.client.rpush(f"{self.ns}:{name}", *values)
+
     @fault_tolerant
     async def set(self, name: str, value: str, **kwargs) -> None:
         await self.client.set(f"{self.ns}:{name}", value, **kwargs)
 
+    @fault_tolerant
+    async def sadd(self, name: str, *values: str) -> None:
+        await self.client.sadd(f"{self.ns}:{name}", *values)
+
+    @fault_tolerant
+    async def smembers(self, name: str) -> list[str]:
+        return list(await self.client.smembers(f"{self.ns}:{name}"))
+
+    @fault_tolerant
+    async def srem(self, name: str, *values: str) -> None:
+        await self.client.srem(f"{self.ns}:{name}", *values)
+
+    @fault_tolerant
+    async def zadd(self, name: str, mapping: dict[str, float], **kwargs) -> None:
+        await self.client.zadd(f"{self.ns}:{name}", mapping, **kwargs)
+
+    @fault_tolerant
+    async def zincrby(self, name: str, amount: float, value: str) -> None:
+        await self.client.zincrby(f"{self.ns}:{name}", amount, value)
+
+    @fault_tolerant
+    async def zmscore(self, name: str, *values: str) -> list[float | None]:
+        return await self.client.zmscore(f"{self.ns}:{name}", list(values))
+
+    @fault_tolerant
+    async def zrange(
+        self, name: str, start: int, end: int, **kwargs
+    ) -> list[str] | list[tuple[str, float]]:
+        return await self.client.zrange(f"{self.ns}:{name}", start, end, **kwargs)
+
+    @fault_tolerant
+    async def zrem(self, name: str, *values: str) -> None:
+        await self.client.zrem(f"{self.ns}:{name}", *values)
+
+    @fault_tolerant
+    async def zunionstore(self, dest: str, keys: dict[str, float]) -> None:
+        await self.client.zunionstore(
+            f"{self.ns}:{dest}", {f"{self.ns}:{k}": v for k, v in keys.items()}
+        )
+
     async def register_agent(self, uuid: str, ttl_seconds: int) -> None:
         self.logger.info("Registering agent for %s seconds", ttl_seconds)
         await self.set(agent_heartbeat_key(uuid), "alive", ex=ttl_seconds)
+        await self.sadd(agents_key(), uuid)
 
     async def unregister_agent(self, uuid: str) -> None:
         self.logger.info("Unregistering agent")
         await self.delete(agent_heartbeat_key(uuid))
+        await self.srem(agents_key(), uuid)
 
     async def get_agent_state(self, uuid: str) -> AgentState:
         if v := await self.get(agent_state_key(uuid)):
@@ -123,40 +265,61 @@ class Redis:
         await self.delete(agent_parameters_key(uuid))
 
     async def get_agents(self) -> list[Agent]:
-        # TODO: Use SCAN instead of KEYS for better scaling?
-        alive = await self.keys(agent_heartbeat_key(None))
-        uuids = [str(key.split(":")[2]) for key in alive]
-        return [
-            Agent(
-                uuid=uuid,
-                parameters=await self.get_agent_parameters(uuid),
-                state=await self.get_agent_state(uuid),
-            )
-            for uuid in uuids
-        ]
+        uuids = sorted(await self.smembers(agents_key()))
+        agents = await self.get_agents_by_uuids(uuids)
+        # Forget the agents that are not alive (or not fully registered),
+        # they will be added again on their next heartbeat.
+        if expired := [uuid for uuid, agent in zip(uuids, agents) if not agent]:
+            await self.srem(agents_key(), *expired)
+        return [agent for agent in agents if agent]
 
     async def get_agents_by_uuid(self) -> dict[str, Agent]:
         agents = await self.get_agents()
         return {agent.uuid: agent for agent in agents}
 
     async def get_agent_by_uuid(self, uuid: str) -> Agent | None:
-        if await self.exists(agent_heartbeat_key(uuid)):
-            return Agent(
-                uuid=uuid,
-                parameters=await self.get_agent_parameters(uuid),
-                state=await self.get_agent_state(uuid),
+        return (await self.get_agents_by_uuids([uuid]))[0]
+
+    async def get_agents_by_uuids(self, uuids: list[str]) -> list[Agent | None]:
+        """
+        Return the agents in the same order as `uuids`, or `None` for the agents
+        that are not alive or not fully registered, with a single round trip.
+        """
+        if not uuids:
+            return []
+        keys = [
+            key(uuid)
+            for uuid in uuids
+            for key in (agent_heartbeat_key, agent_parameters_key, agent_state_key)
+        ]
+        values = await self.mget(*keys)
+        agents: list[Agent | None] = []
+        for uuid, i in zip(uuids, range(0, len(values), 3)):
+            heartbeat, parameters, state = values[i : i + 3]
+            if not heartbeat or not parameters:
+                agents.append(None)
+                continue
+            agents.append(
+                Agent(
+                    uuid=uuid,
+                    parameters=AgentParameters.parse_raw(parameters),
+                    state=AgentState(state) if state else AgentState.Unknown,
+                )
             )
-        return None
+        return agents
 
     @fault_tolerant
     async def check_agent(self, uuid: str) -> bool:
-        if not await self.exists(agent_heartbeat_key(uuid)):
-            return False
-        if not await self.get_agent_parameters(uuid):
-            return False
-        if await self.get_agent_state(uuid) == AgentState.Unknown:
-            return False
-        return True
+        agent = await self.get_agent_by_uuid(uuid)
+        return bool(agent and agent.state != AgentState.Unknown)
+
+    async def get_buckets_count(self) -> int | None:
+        if count := await self.get(buckets_count_key()):
+            return int(count)
+        return None
+
+    async def set_buckets_count(self, count: int, ttl_seconds: int) -> None:
+        await self.set(buckets_count_key(), str(count), ex=ttl_seconds)
 
     async def get_measurement_stats(
         self, measurement_uuid: str, agent_uuid: str
@@ -179,19 +342,179 @@ class Redis:
         self.logger.info("Deleting measurement statistics")
         await self.delete(measurement_stats_key(measurement_uuid, agent_uuid))
 
+    async def get_measurement_progress(
+        self, measurement_uuid: str, agent_uuid: str
+    ) -> ProbingProgress | None:
+        key = measurement_progress_key(measurement_uuid, agent_uuid)
+        if progress := await self.get(key):
+            return ProbingProgress.parse_raw(progress)
+        return None
+
+    async def set_measurement_progress(
+        self,
+        measurement_uuid: str,
+        agent_uuid: str,
+        progress: ProbingProgress,
+        ttl_seconds: int,
+    ) -> None:
+        """The progress expires after `ttl_seconds`, e.g. if the agent stops."""
+        await self.set(
+            measurement_progress_key(measurement_uuid, agent_uuid),
+            progress.json(),
+            ex=ttl_seconds,
+        )
+
+    async def notify_results(
+        self, measurement_uuid: str, agent_uuid: str, key: str
+    ) -> None:
+        """Notify the worker that a results file has been uploaded."""
+        self.logger.info("Notifying results %s", key)
+        await self.rpush(results_ready_key(measurement_uuid, agent_uuid), key)
+
+    async def wait_results(
+        self, measurement_uuid: str, agent_uuid: str, timeout: float
+    ) -> str | None:
+        """
+        Return the key of the next results file notified by the agent,
+        or `None` if no notification is received within `timeout` seconds.
+        """
+        return await self.blpop(
+            results_ready_key(measurement_uuid, agent_uuid), timeout
+        )
+
+    async def delete_results_notifications(
+        self, measurement_uuid: str, agent_uuid: str
+    ) -> None:
+        await self.delete(results_ready_key(measurement_uuid, agent_uuid))
+
     async def get_random_request(
-        self, uuid: str, *, interval: float = 1.0
+        self, uuid: str, *, interval: float = 1.0, exclude: Container[str] = ()
     ) -> MeasurementRoundRequest:
         """
-        Return a random request from the queue.
-        If the queue is empty, it will retry at the specified interval.
+        Return a random request from the queue, ignoring the requests of the
+        measurements in `exclude` (e.g. the measurements already running).
+        If the queue is empty, it waits for a new request, or retries after
+        the specified interval.
         """
         # TODO: Use HRANDFIELD when implemented by aioredis.
         while True:
-            if keys := await self.hkeys(agent_queue_key(uuid)):
-                value = await self.hget(agent_queue_key(uuid), random.choice(keys))
-                return MeasurementRoundRequest.parse_raw(value)
-            await asyncio.sleep(interval)
+            keys = await self.hkeys(agent_queue_key(uuid))
+            if keys := [key for key in keys if key not in exclude]:
+                # The request may have been deleted in the meantime.
+                if value := await self.hget(agent_queue_key(uuid), random.choice(keys)):
+                    return MeasurementRoundRequest.parse_raw(value)
+                continue
+            await self.wait_request(uuid, interval)
+
+    async def get_next_request(
+        self,
+        uuid: str,
+        policy: QueuePolicy,
+        *,
+        interval: float = 1.0,
+        exclude: Container[str] = (),
+        usage_half_life: float | None = None,
+    ) -> MeasurementRoundRequest:
+        """
+        Return the next request from the queue according to `policy`, ignoring
+        the requests of the measurements in `exclude`.
+        If the queue is empty, it waits for a new request, or retries after
+        the specified interval.
+        With the fair policy, the usage of the users is halved every
+        `usage_half_life` seconds, if specified.
+        """
+        if policy == QueuePolicy.Random:
+            return await self.get_random_request(
+                uuid, interval=interval, exclude=exclude
+            )
+        while True:
+            if policy == QueuePolicy.Fair:
+                request = await self.get_fair_request(uuid, exclude, usage_half_life)
+            else:
+                request = await self.get_ordered_request(uuid, policy, exclude)
+            if request:
+                return request
+            await self.wait_request(uuid, interval)
+
+    async def get_ordered_request(
+        self, uuid: str, policy: QueuePolicy, exclude: Container[str]
+    ) -> MeasurementRoundRequest | None:
+        """Return the first request of the queue sorted set, if any."""
+        # NOTE: The excluded measurements are the ones running on the agent,
+        # so fetching a few more members than the concurrency is enough.
+        end = len(exclude) if isinstance(exclude, Sized) else -1
+        while True:
+            keys = await self.zrange(agent_queue_order_key(uuid, policy), 0, end)
+            if not (keys := [key for key in keys if key not in exclude]):
+                return None
+            for key in keys:
+                if value := await self.hget(agent_queue_key(uuid), key):
+                    return MeasurementRoundRequest.parse_raw(value)
+                # The request was deleted in the meantime, or it was left in
+                # the sorted sets by an agent or a worker which crashed.
+                await self.unindex_deleted_request(uuid, key)
+
+    async def get_fair_request(
+        self, uuid: str, exclude: Container[str], usage_half_life: float | None = None
+    ) -> MeasurementRoundRequest | None:
+        """
+        Return the oldest request of the user for which the agent has sent
+        the fewest probes, and charge its probes to this user.
+        """
+        if usage_half_life:
+            await self.decay_usage(uuid, usage_half_life)
+        keys = await self.zrange(agent_queue_order_key(uuid, QueuePolicy.Fair), 0, -1)
+        if not (keys := [key for key in keys if key not in exclude]):
+            return None
+        values = await self.hmget(agent_queue_key(uuid), *keys)
+        requests = [MeasurementRoundRequest.parse_raw(v) for v in values if v]
+        if not requests:
+            return None
+        users = list({queue_user(request) for request in requests})
+        usage = dict(zip(users, await self.zmscore(agent_usage_key(uuid), *users)))
+        # `min` returns the first (i.e. oldest) request of the least served user.
+        request = min(requests, key=lambda r: usage[queue_user(r)] or 0)
+        await self.zincrby(
+            agent_usage_key(uuid), request.n_probes or 1, queue_user(request)
+        )
+        return request
+
+    async def decay_usage(self, uuid: str, half_life: float) -> None:
+        """
+        Scale the usage of the users by the time elapsed since the last decay,
+        so that the probes sent a long time ago weigh less than the recent ones.
+        """
+        now = time.time()
+        last = await self.getset(agent_usage_decay_key(uuid), str(now))
+        if last and (elapsed := now - float(last)) > 0:
+            factor = 0.5 ** (elapsed / half_life)
+            await self.zunionstore(
+                agent_usage_key(uuid), {agent_usage_key(uuid): factor}
+            )
+
+    async def wait_request(self, uuid: str, timeout: float) -> None:
+        """
+        Wait for a request to be added to the queue, for at most `timeout` seconds.
+        The requests added while the agent was busy are consumed immediately.
+        """
+        await self.blpop(agent_queue_events_key(uuid), timeout)
+
+    @fault_tolerant
+    async def wait_request_deletion(
+        self, measurement_uuid: str, agent_uuid: str
+    ) -> None:
+        """Wait for the measurement request to be deleted from the agent queue."""
+        pubsub = self.client.pubsub()
+        try:
+            await pubsub.subscribe(f"{self.ns}:{agent_cancel_channel(agent_uuid)}")
+            # The request may have been deleted before the subscription.
+            if not await self.get_request(measurement_uuid, agent_uuid):
+                return
+            async for message in pubsub.listen():
+                if message["type"] == "message" and message["data"] == measurement_uuid:
+                    return
+        finally:
+            await pubsub.aclose()
 
     async def get_request(
         self, measurement_uuid: str, agent_uuid: str
@@ -201,10 +524,106 @@ class Redis:
             return MeasurementRoundRequest.parse_raw(value)
         return None
 
+    @fault_tolerant
     async def set_request(self, uuid: str, request: MeasurementRoundRequest) -> None:
         """Set the measurement request for a specified agent and measurement."""
-        await self.hset(agent_queue_key(uuid), request.measurement_uuid, request.json())
+        # A new user starts with the usage of the least served user, so that it
+        # does not monopolize the agent until it catches up with the others.
+        usage = await self.zrange(agent_usage_key(uuid), 0, 0, withscores=True)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                f"{self.ns}:{agent_queue_key(uuid)}",
+                request.measurement_uuid,
+                request.json(),
+            )
+            for policy, score in queue_scores(request).items():
+                pipe.zadd(
+                    f"{self.ns}:{agent_queue_order_key(uuid, policy)}",
+                    {request.measurement_uuid: score},
+                )
+            pipe.zadd(
+                f"{self.ns}:{agent_usage_key(uuid)}",
+                {queue_user(request): usage[0][1] if usage else 0},  # type: ignore
+                nx=True,
+            )
+            # A single event is enough to wake up the agent, so we keep only
+            # the last one rather than one per request set while it was busy.
+            events = f"{self.ns}:{agent_queue_events_key(uuid)}"
+            pipe.rpush(events, request.measurement_uuid)
+            pipe.ltrim(events, -1, -1)
+            await pipe.execute()
+
+    async def index_request(self, uuid: str, request: MeasurementRoundRequest) -> None:
+        """Index the request for every policy, if it is not already indexed."""
+        for policy, score in queue_scores(request).items():
+            await self.zadd(
+                agent_queue_order_key(uuid, policy),
+                {request.measurement_uuid: score},
+                nx=True,
+            )
 
-    async def delete_request(self, measurement_uuid: str, agent_uuid: str) -> None:
-        """Delete the measurement request for a specified agent and measurement."""
-        await self.hdel(agent_queue_key(agent_uuid), measurement_uuid)
+    async def index_requests(self, uuid: str) -> None:
+        """
+        Index the requests of the queue which are not indexed yet,
+        e.g. the requests queued before the introduction of the policies.
+        """
+        for value in (await self.hgetall(agent_queue_key(uuid))).values():
+            request = MeasurementRoundRequest.parse_raw(value)
+            await self.index_request(uuid, request)
+
+    @fault_tolerant
+    async def delete_request(
+        self, measurement_uuid: str, agent_uuid: str, round_: Round | None = None
+    ) -> None:
+        """
+        Delete the measurement request for a specified agent and measurement.
+        If `round_` is specified, the request is deleted only if it is still for
+        this round, since the worker may have already requested the next round.
+        """
+        queue = f"{self.ns}:{agent_queue_key(agent_uuid)}"
+        async with self.client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    if round_:
+                        await pipe.watch(queue)
+                        value = await pipe.hget(queue, measurement_uuid)
+                        if not value:
+                            return
+                        if MeasurementRoundRequest.parse_raw(value).round != round_:
+                            return
+                        pipe.multi()
+                    pipe.hdel(queue, measurement_uuid)
+                    for policy in QUEUE_ORDERS:
+                        pipe.zrem(
+                            f"{self.ns}:{agent_queue_order_key(agent_uuid, policy)}",
+                            measurement_uuid,
+                        )
+                    pipe.publish(
+                        f"{self.ns}:{agent_cancel_channel(agent_uuid)}",
+                        measurement_uuid,
+                    )
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    # The queue was modified in the meantime, check the round again.
+                    continue
+
+    @fault_tolerant
+    async def unindex_deleted_request(self, uuid: str, measurement_uuid: str) -> None:
+        """Remove the request from the sorted sets if it is not in the queue."""
+        queue = f"{self.ns}:{agent_queue_key(uuid)}"
+        async with self.client.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(queue)
+                if await pipe.hexists(queue, measurement_uuid):
+                    return
+                pipe.multi()
+                for policy in QUEUE_ORDERS:
+                    pipe.zrem(
+                        f"{self.ns}:{agent_queue_order_key(uuid, policy)}",
+                        measurement_uuid,
+                    )
+                await pipe.execute()
+            except WatchError:
+                # The request was set again in the meantime.
+                pass
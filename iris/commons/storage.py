@@ -1,13 +1,81 @@
+import asyncio
 import datetime
+import json
+import os
+import threading
+from base64 import b64encode
+from collections import deque
+from collections.abc import AsyncIterable, AsyncIterator
+from contextlib import AsyncExitStack
 from dataclasses import dataclass
+from hashlib import md5
 from logging import LoggerAdapter
 from pathlib import Path
 from typing import Any
+from weakref import WeakKeyDictionary
 
 import aioboto3
+from aiobotocore.config import AioConfig
+from boto3.s3.transfer import TransferConfig
 
-from iris.commons.models import Round
+from iris.commons.models import ResultsFormat, Round
 from iris.commons.settings import CommonSettings, fault_tolerant
+from iris.commons.utils import gather_or_cancel
+
+# aiobotocore clients are bound to the event loop on which they were created.
+clients: WeakKeyDictionary = WeakKeyDictionary()
+clients_lock = threading.Lock()
+
+# S3 allows at most 10,000 parts per multipart upload.
+MAX_PARTS = 10_000
+
+
+@dataclass(frozen=True)
+class StreamUpload:
+    """A multipart upload whose parts are uploaded, but which is not complete."""
+
+    upload_id: str
+    parts: list[dict]
+    digests: list[bytes]
+
+
+def part_ranges(size: int, part_size: int) -> list[tuple[int, int]]:
+    """
+    Return the (offset, length) of the parts of a file of `size` bytes.
+    >>> part_ranges(10, 4)
+    [(0, 4), (4, 4), (8, 2)]
+    >>> part_ranges(0, 4)
+    []
+    """
+    return [
+        (offset, min(part_size, size - offset)) for offset in range(0, size, part_size)
+    ]
+
+
+def multipart_etag(digests: list[bytes]) -> str:
+    """
+    Return the S3 ETag of an object uploaded in parts, from the MD5 of its parts.
+    >>> multipart_etag([md5(b"ir").digest(), md5(b"is").digest()])
+    '4166e130947605908f417b49bd1b8670-2'
+    """
+    return f"{md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def file_etag(path: Path | str, part_size: int | None = None) -> str:
+    """
+    Return the S3 ETag of a file uploaded in a single part, or in parts of
+    `part_size` bytes.
+    """
+    digests = []
+    with Path(path).open("rb") as f:
+        if not part_size:
+            digest = md5()
+            while data := f.read(2**20):
+                digest.update(data)
+            return digest.hexdigest()
+        while data := f.read(part_size):
+            digests.append(md5(data).digest())
+    return multipart_etag(digests)
 
 
 def next_round_key(round_: Round) -> str:
@@ -15,11 +83,36 @@ def next_round_key(round_: Round) -> str:
     return f"next_round_{round_.encode()}.csv.zst"
 
 
-def results_key(round_: Round) -> str:
+def results_key(round_: Round, format_: ResultsFormat = ResultsFormat.CSV) -> str:
     """The name of the file containing the results of the probing round."""
+    if format_ == ResultsFormat.Parquet:
+        return f"results_{round_.encode()}.parquet"
     return f"results_{round_.encode()}.csv.zst"
 
 
+def results_chunk_key(round_: Round, attempt: str, index: int) -> str:
+    """
+    The name of a file containing a part of the results of the probing round.
+    The round is probed again if the agent fails, so the chunks of each attempt
+    are named differently.
+    """
+    return f"chunk_{round_.encode()}_{attempt}_{index}.csv.zst"
+
+
+def results_chunk_attempt(key: str) -> str:
+    """
+    The attempt of a results chunk.
+    >>> results_chunk_attempt("chunk_1:10:0_a1b2_3.csv.zst")
+    'a1b2'
+    """
+    return key.split("_")[2]
+
+
+def results_manifest_key(round_: Round) -> str:
+    """The name of the file listing the results chunks of the probing round."""
+    return f"manifest_{round_.encode()}.json"
+
+
 def targets_key(measurement_uuid: str, agent_uuid: str) -> str:
     """The name of the file containing the targets to probe."""
     return f"targets__{measurement_uuid}__{agent_uuid}.csv"
@@ -32,6 +125,38 @@ class Storage:
     settings: CommonSettings
     logger: LoggerAdapter
 
+    async def client(self) -> Any:
+        """
+        Return the S3 client shared by all the tasks of the current event loop.
+        It keeps up to `S3_MAX_CONNECTIONS` connections alive and is closed by `close`.
+        """
+        key = (*self.settings.s3.values(), self.settings.S3_MAX_CONNECTIONS)
+        with clients_lock:
+            lock, loop_clients = clients.setdefault(
+                asyncio.get_running_loop(), (asyncio.Lock(), {})
+            )
+        async with lock:
+            if key not in loop_clients:
+                stack = AsyncExitStack()
+                client = await stack.enter_async_context(
+                    aioboto3.Session().client(
+                        "s3",
+                        config=AioConfig(
+                            max_pool_connections=self.settings.S3_MAX_CONNECTIONS
+                        ),
+                        **self.settings.s3,
+                    )
+                )
+                loop_clients[key] = (stack, client)
+            return loop_clients[key][1]
+
+    async def close(self) -> None:
+        """Close the S3 clients opened on the current event loop."""
+        with clients_lock:
+            _, loop_clients = clients.pop(asyncio.get_running_loop(), (None, {}))
+        for stack, _ in loop_clients.values():
+            await stack.aclose()
+
     def archive_bucket(self, user_id: str) -> str:
         return f"{self.settings.S3_PREFIX}-archive-{user_id}"
 
@@ -43,73 +168,94 @@ class Storage:
 
     @fault_tolerant
     async def get_measurement_buckets(self) -> list[str]:
-        session = aioboto3.Session()
-        async with session.client("s3", **self.settings.s3) as s3:
-            response = await s3.list_buckets()
-            return [x["Name"] for x in response["Buckets"]]
+        s3 = await self.client()
+        response = await s3.list_buckets()
+        return [x["Name"] for x in response["Buckets"]]
 
     @fault_tolerant
     async def create_bucket(self, bucket: str) -> None:
         """Create a bucket."""
         self.logger.info("Creating bucket %s", bucket)
-        session = aioboto3.Session()
-        async with session.client("s3", **self.settings.s3) as s3:
-            try:
-                await s3.create_bucket(Bucket=bucket)
-            except s3.exceptions.BucketAlreadyOwnedByYou:
-                pass
+        s3 = await self.client()
+        try:
+            await s3.create_bucket(Bucket=bucket)
+        except s3.exceptions.BucketAlreadyOwnedByYou:
+            pass
 
     @fault_tolerant
     async def delete_bucket(self, bucket: str) -> None:
         """Delete a bucket."""
-        session = aioboto3.Session()
-        async with session.client("s3", **self.settings.s3) as s3:
-            await s3.delete_bucket(Bucket=bucket)
+        s3 = await self.client()
+        await s3.delete_bucket(Bucket=bucket)
 
     async def delete_bucket_with_files(self, bucket: str) -> None:
         await self.delete_all_files_from_bucket(bucket)
         await self.delete_bucket(bucket)
 
-    async def get_all_files_no_retry(self, bucket: str) -> list[dict]:
-        """Get all files inside a bucket."""
-        targets = []
-        session = aioboto3.Session()
-        async with session.resource("s3", **self.settings.s3) as s3:
-            b = await s3.Bucket(bucket)
-            async for obj_summary in b.objects.all():
-                obj = await obj_summary.Object()
-                targets.append(
+    async def list_files_no_retry(
+        self, bucket: str, prefix: str = "", *, with_metadata: bool = False
+    ) -> list[dict]:
+        """
+        List the files inside a bucket whose key starts with `prefix`.
+        The listing is paginated (1000 keys per request); the user-defined metadata
+        requires one more request per file, so it is only fetched if `with_metadata`
+        is set, with at most `S3_METADATA_CONCURRENCY` concurrent requests.
+        """
+        files = []
+        s3 = await self.client()
+        paginator = s3.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                files.append(
                     {
-                        "key": obj_summary.key,
-                        "size": await obj_summary.size,
-                        "metadata": await obj.metadata,
-                        "last_modified": datetime.datetime.fromisoformat(
-                            str(await obj_summary.last_modified)
-                        )
+                        "key": obj["Key"],
+                        "size": obj["Size"],
+                        "last_modified": obj["LastModified"]
                         .replace(microsecond=0)
-                        .replace(tzinfo=datetime.timezone.utc),
+                        .astimezone(datetime.timezone.utc),
                     }
                 )
-        return targets
+        if with_metadata:
+            semaphore = asyncio.Semaphore(self.settings.S3_METADATA_CONCURRENCY)
+
+            async def get_metadata(file: dict) -> None:
+                async with semaphore:
+                    obj = await s3.head_object(Bucket=bucket, Key=file["key"])
+                    file["metadata"] = obj["Metadata"]
+
+            await asyncio.gather(*[get_metadata(file) for file in files])
+        return files
+
+    @fault_tolerant
+    async def list_files(
+        self, bucket: str, prefix: str = "", *, with_metadata: bool = False
+    ) -> list[dict]:
+        """List the files inside a bucket whose key starts with `prefix`."""
+        return await self.list_files_no_retry(
+            bucket, prefix, with_metadata=with_metadata
+        )
+
+    async def get_all_files_no_retry(self, bucket: str) -> list[dict]:
+        """Get all files inside a bucket, with their metadata."""
+        return await self.list_files_no_retry(bucket, with_metadata=True)
 
     @fault_tolerant
     async def get_all_files(self, bucket: str) -> list[dict]:
-        """Get all files inside a bucket."""
+        """Get all files inside a bucket, with their metadata."""
         return await self.get_all_files_no_retry(bucket)
 
     async def get_file_no_retry(
         self, bucket: str, filename: str, retrieve_content: bool = True
     ) -> dict:
         """Get file information from a bucket."""
-        session = aioboto3.Session()
-        async with session.client("s3", **self.settings.s3) as s3:
-            file_object = await s3.get_object(Bucket=bucket, Key=filename)
+        s3 = await self.client()
+        file_object = await s3.get_object(Bucket=bucket, Key=filename)
 
-            content = None
-            if retrieve_content:
-                async with file_object["Body"] as stream:
-                    content = await stream.read()
-                content = content.decode("utf-8")
+        content = None
+        if retrieve_content:
+            async with file_object["Body"] as stream:
+                content = await stream.read()
+            content = content.decode("utf-8")
 
         return {
             "key": filename,
@@ -133,6 +279,10 @@ class Storage:
             bucket, filename, retrieve_content=retrieve_content
         )
 
+    def part_size(self, size: int) -> int:
+        """The size of the parts of a file of `size` bytes."""
+        return max(self.settings.S3_PART_SIZE, -(-size // MAX_PARTS))
+
     @fault_tolerant
     async def upload_file(
         self,
@@ -141,7 +291,14 @@ class Storage:
         filepath: Path | str,
         metadata: Any = None,
     ) -> None:
-        """Upload a file in a bucket."""
+        """
+        Upload a file in a bucket. Files larger than `S3_PART_SIZE` are uploaded
+        in parts, and an interrupted upload is resumed on retry.
+        """
+        if Path(filepath).stat().st_size > self.settings.S3_PART_SIZE:
+            return await self.upload_multipart_no_retry(
+                bucket, filename, filepath, metadata
+            )
         with Path(filepath).open("rb") as fd:
             return await self.upload_file_no_retry(bucket, filename, fd, metadata)
 
@@ -149,20 +306,384 @@ class Storage:
         self, bucket: str, filename: str, fd, metadata: Any = None
     ) -> None:
         """Upload a file in a bucket with no retry."""
-        session = aioboto3.Session()
-        async with session.client("s3", **self.settings.s3) as s3:
-            extraargs = {"Metadata": metadata} if metadata else None
-            await s3.upload_fileobj(fd, bucket, filename, ExtraArgs=extraargs)
+        s3 = await self.client()
+        extraargs = {"Metadata": metadata} if metadata else None
+        config = TransferConfig(
+            multipart_chunksize=self.settings.S3_PART_SIZE,
+            max_concurrency=self.settings.S3_TRANSFER_CONCURRENCY,
+        )
+        await s3.upload_fileobj(
+            fd, bucket, filename, ExtraArgs=extraargs, Config=config
+        )
+
+    async def find_multipart_upload(
+        self, bucket: str, filename: str
+    ) -> tuple[str | None, dict[int, str]]:
+        """
+        Return the id and the parts ETags of a pending upload of `filename`.
+        The pending uploads older than `S3_UPLOAD_EXPIRY` are aborted, since
+        their parts are billed until the upload is completed or aborted.
+        """
+        s3 = await self.client()
+        response = await s3.list_multipart_uploads(Bucket=bucket, Prefix=filename)
+        # If the file was uploaded several times, resume the latest upload.
+        uploads = sorted(response.get("Uploads", []), key=lambda x: x["Initiated"])
+        uploads = [upload for upload in uploads if upload["Key"] == filename]
+        expiry = datetime.datetime.now(datetime.timezone.utc)
+        expiry -= self.settings.S3_UPLOAD_EXPIRY
+        for upload in uploads:
+            if upload["Initiated"] < expiry:
+                self.logger.info("Aborting the stale upload of %s", filename)
+                await s3.abort_multipart_upload(
+                    Bucket=bucket, Key=filename, UploadId=upload["UploadId"]
+                )
+        uploads = [upload for upload in uploads if upload["Initiated"] >= expiry]
+        if not uploads:
+            return None, {}
+        upload_id = uploads[-1]["UploadId"]
+        parts = {}
+        paginator = s3.get_paginator("list_parts")
+        async for page in paginator.paginate(
+            Bucket=bucket, Key=filename, UploadId=upload_id
+        ):
+            for part in page.get("Parts", []):
+                parts[part["PartNumber"]] = part["ETag"].strip('"')
+        return upload_id, parts
+
+    async def upload_part_no_retry(
+        self,
+        bucket: str,
+        filename: str,
+        upload_id: str,
+        number: int,
+        data: bytes,
+        digest: bytes,
+    ) -> dict:
+        """Upload a part of a multipart upload, with its MD5 `digest`."""
+        s3 = await self.client()
+        checksum = {}
+        if self.settings.S3_TRANSFER_CHECKSUM:
+            checksum["ContentMD5"] = b64encode(digest).decode()
+        response = await s3.upload_part(
+            Bucket=bucket,
+            Key=filename,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=data,
+            **checksum,
+        )
+        return {"PartNumber": number, "ETag": response["ETag"].strip('"')}
+
+    @fault_tolerant
+    async def upload_part(
+        self,
+        bucket: str,
+        filename: str,
+        upload_id: str,
+        number: int,
+        data: bytes,
+        digest: bytes,
+    ) -> dict:
+        """Upload a part of a multipart upload, with its MD5 `digest`."""
+        return await self.upload_part_no_retry(
+            bucket, filename, upload_id, number, data, digest
+        )
+
+    async def upload_multipart_no_retry(
+        self,
+        bucket: str,
+        filename: str,
+        filepath: Path | str,
+        metadata: Any = None,
+    ) -> None:
+        """
+        Upload a file in parts of `S3_PART_SIZE` bytes, with at most
+        `S3_TRANSFER_CONCURRENCY` parts in flight. If a previous upload of the
+        same file was interrupted, the parts already uploaded are not sent again.
+        The upload is not aborted on error, so that it can be resumed.
+        """
+        s3 = await self.client()
+        loop = asyncio.get_running_loop()
+        size = Path(filepath).stat().st_size
+        ranges = part_ranges(size, self.part_size(size))
+        upload_id, uploaded = await self.find_multipart_upload(bucket, filename)
+        if upload_id:
+            self.logger.info(
+                "Resuming the upload of %s (%s parts uploaded)", filename, len(uploaded)
+            )
+        else:
+            extraargs = {"Metadata": metadata} if metadata else {}
+            response = await s3.create_multipart_upload(
+                Bucket=bucket, Key=filename, **extraargs
+            )
+            upload_id = response["UploadId"]
+
+        semaphore = asyncio.Semaphore(self.settings.S3_TRANSFER_CONCURRENCY)
+        digests: dict[int, bytes] = {}
+
+        def read_part(fd: int, offset: int, length: int) -> tuple[bytes, bytes]:
+            data = os.pread(fd, length, offset)
+            return data, md5(data).digest()
+
+        async def upload_part(fd: int, number: int, offset: int, length: int) -> dict:
+            async with semaphore:
+                data, digests[number] = await loop.run_in_executor(
+                    None, read_part, fd, offset, length
+                )
+                if uploaded.get(number) == digests[number].hex():
+                    return {"PartNumber": number, "ETag": uploaded[number]}
+                return await self.upload_part_no_retry(
+                    bucket, filename, upload_id, number, data, digests[number]
+                )
+
+        with Path(filepath).open("rb") as f:
+            parts = await gather_or_cancel(
+                *[
+                    upload_part(f.fileno(), number, *range_)
+                    for number, range_ in enumerate(ranges, start=1)
+                ]
+            )
+        response = await s3.complete_multipart_upload(
+            Bucket=bucket,
+            Key=filename,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        if self.settings.S3_TRANSFER_CHECKSUM:
+            expected = multipart_etag([digests[x] for x in sorted(digests)])
+            if (etag := response["ETag"].strip('"')) != expected:
+                raise ValueError(f"{filename}: ETag {etag} != {expected}")
+
+    async def upload_stream(
+        self,
+        bucket: str,
+        filename: str,
+        stream: AsyncIterable[bytes],
+        metadata: Any = None,
+    ) -> None:
+        """Upload the content of `stream` in a bucket as it is produced."""
+        upload = await self.upload_stream_parts(bucket, filename, stream, metadata)
+        await self.complete_stream_upload(bucket, filename, upload)
+
+    async def upload_stream_parts(
+        self,
+        bucket: str,
+        filename: str,
+        stream: AsyncIterable[bytes],
+        metadata: Any = None,
+    ) -> StreamUpload:
+        """
+        Upload the content of `stream` in parts of `S3_PART_SIZE` bytes, as it is
+        produced. The stream is not consumed while `S3_TRANSFER_CONCURRENCY` parts
+        are being uploaded. Each part is retried, but since the stream cannot be
+        read again, the upload is aborted on error.
+        The file appears in the bucket once `complete_stream_upload` is called.
+        """
+        s3 = await self.client()
+        # Since the size of the stream is unknown, we cannot use `part_size`.
+        part_size = self.settings.S3_PART_SIZE
+        extraargs = {"Metadata": metadata} if metadata else {}
+        response = await s3.create_multipart_upload(
+            Bucket=bucket, Key=filename, **extraargs
+        )
+        upload_id = response["UploadId"]
+        semaphore = asyncio.Semaphore(self.settings.S3_TRANSFER_CONCURRENCY)
+        digests: list[bytes] = []
+        tasks: list[asyncio.Future] = []
+
+        async def upload_part(number: int, data: bytes) -> dict:
+            try:
+                return await self.upload_part(
+                    bucket, filename, upload_id, number, data, digests[number - 1]
+                )
+            finally:
+                semaphore.release()
+
+        async def submit(data: bytes) -> None:
+            await semaphore.acquire()
+            digests.append(md5(data).digest())
+            tasks.append(asyncio.ensure_future(upload_part(len(digests), data)))
+
+        try:
+            buffer = bytearray()
+            async for chunk in stream:
+                buffer += chunk
+                while len(buffer) >= part_size:
+                    await submit(bytes(buffer[:part_size]))
+                    del buffer[:part_size]
+            # A multipart upload must contain at least one part,
+            # and only the last part can be smaller than 5 MiB.
+            if buffer or not tasks:
+                await submit(bytes(buffer))
+            parts = await gather_or_cancel(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await self.abort_stream_upload(
+                bucket, filename, StreamUpload(upload_id, [], digests)
+            )
+            raise
+        return StreamUpload(upload_id, parts, digests)
+
+    async def complete_stream_upload(
+        self, bucket: str, filename: str, upload: StreamUpload
+    ) -> None:
+        """Complete an upload started by `upload_stream_parts`, or abort it on error."""
+        s3 = await self.client()
+        try:
+            response = await s3.complete_multipart_upload(
+                Bucket=bucket,
+                Key=filename,
+                UploadId=upload.upload_id,
+                MultipartUpload={"Parts": upload.parts},
+            )
+        except BaseException:
+            await self.abort_stream_upload(bucket, filename, upload)
+            raise
+        if self.settings.S3_TRANSFER_CHECKSUM:
+            expected = multipart_etag(upload.digests)
+            if (etag := response["ETag"].strip('"')) != expected:
+                raise ValueError(f"{filename}: ETag {etag} != {expected}")
+
+    async def abort_stream_upload(
+        self, bucket: str, filename: str, upload: StreamUpload
+    ) -> None:
+        """Abort an upload started by `upload_stream_parts`."""
+        s3 = await self.client()
+        self.logger.info("Aborting the upload of %s", filename)
+        await s3.abort_multipart_upload(
+            Bucket=bucket, Key=filename, UploadId=upload.upload_id
+        )
 
     @fault_tolerant
     async def download_file(
         self, bucket: str, filename: str, output_path: Path | str
     ) -> None:
-        """Download a file in a bucket."""
-        session = aioboto3.Session()
-        async with session.client("s3", **self.settings.s3) as s3:
-            with Path(output_path).open("wb") as fd:
-                await s3.download_fileobj(bucket, filename, fd)
+        """
+        Download a file from a bucket, with parallel ranged requests of
+        `S3_PART_SIZE` bytes and at most `S3_TRANSFER_CONCURRENCY` requests in
+        flight. The parts already downloaded are recorded in `{output_path}.parts`
+        so that an interrupted download is resumed on retry.
+        """
+        s3 = await self.client()
+        loop = asyncio.get_running_loop()
+        head = await s3.head_object(Bucket=bucket, Key=filename)
+        size, etag = head["ContentLength"], head["ETag"]
+        part_size = self.part_size(size)
+        output_path = Path(output_path)
+        state_path = output_path.with_name(output_path.name + ".parts")
+
+        # Resume only if the object has not changed since the previous attempt.
+        done: set[int] = set()
+        if output_path.exists() and state_path.exists():
+            state = json.loads(state_path.read_text())
+            if state["etag"] == etag and state["part_size"] == part_size:
+                done = set(state["parts"])
+                self.logger.info(
+                    "Resuming the download of %s (%s parts downloaded)",
+                    filename,
+                    len(done),
+                )
+
+        def save_state() -> None:
+            state = {"etag": etag, "part_size": part_size, "parts": sorted(done)}
+            state_path.write_text(json.dumps(state))
+
+        semaphore = asyncio.Semaphore(self.settings.S3_TRANSFER_CONCURRENCY)
+
+        async def download_part(fd: int, number: int, offset: int, length: int):
+            async with semaphore:
+                data = await self.get_range_no_retry(
+                    bucket, filename, offset, length, etag
+                )
+                await loop.run_in_executor(None, os.pwrite, fd, data, offset)
+                done.add(number)
+                save_state()
+
+        with output_path.open("r+b" if done else "wb") as f:
+            f.truncate(size)
+            await gather_or_cancel(
+                *[
+                    download_part(f.fileno(), number, *range_)
+                    for number, range_ in enumerate(part_ranges(size, part_size))
+                    if number not in done
+                ]
+            )
+
+        if self.settings.S3_TRANSFER_CHECKSUM:
+            await self.verify_download(filename, output_path, etag, size)
+        state_path.unlink(missing_ok=True)
+
+    async def verify_download(
+        self, filename: str, output_path: Path, etag: str, size: int
+    ) -> None:
+        """
+        Compare the ETag of a downloaded file with the one of the object.
+        This is only possible if the object was uploaded in a single part, or
+        in parts of the size used by `upload_multipart_no_retry`.
+        """
+        etag = etag.strip('"')
+        part_size = None
+        if "-" in etag:
+            part_size = self.part_size(size)
+            if int(etag.split("-")[1]) != len(part_ranges(size, part_size)):
+                self.logger.debug("Cannot verify %s (unknown part size)", filename)
+                return
+        loop = asyncio.get_running_loop()
+        actual = await loop.run_in_executor(None, file_etag, output_path, part_size)
+        if actual != etag:
+            # Download the file again from scratch on retry.
+            output_path.with_name(output_path.name + ".parts").unlink(missing_ok=True)
+            raise ValueError(f"{filename}: ETag {actual} != {etag}")
+
+    async def get_range_no_retry(
+        self, bucket: str, filename: str, offset: int, length: int, etag: str
+    ) -> bytes:
+        """Get `length` bytes of a file, starting at `offset`."""
+        s3 = await self.client()
+        response = await s3.get_object(
+            Bucket=bucket,
+            Key=filename,
+            IfMatch=etag,
+            Range=f"bytes={offset}-{offset + length - 1}",
+        )
+        async with response["Body"] as stream:
+            data: bytes = await stream.read()
+        if len(data) != length:
+            raise ValueError(f"{filename}: short read at offset {offset}")
+        return data
+
+    @fault_tolerant
+    async def get_range(
+        self, bucket: str, filename: str, offset: int, length: int, etag: str
+    ) -> bytes:
+        """Get `length` bytes of a file, starting at `offset`."""
+        return await self.get_range_no_retry(bucket, filename, offset, length, etag)
+
+    async def iter_file(self, bucket: str, filename: str) -> AsyncIterator[bytes]:
+        """
+        Yield the content of a file in parts of `S3_PART_SIZE` bytes, in order.
+        At most `S3_TRANSFER_CONCURRENCY` parts are downloaded ahead of the consumer,
+        so a slow consumer bounds the memory usage and the download rate.
+        """
+        s3 = await self.client()
+        head = await s3.head_object(Bucket=bucket, Key=filename)
+        size, etag = head["ContentLength"], head["ETag"]
+        pending: deque[asyncio.Future] = deque()
+        try:
+            for offset, length in part_ranges(size, self.part_size(size)):
+                if len(pending) >= self.settings.S3_TRANSFER_CONCURRENCY:
+                    yield await pending.popleft()
+                pending.append(
+                    asyncio.ensure_future(
+                        self.get_range(bucket, filename, offset, length, etag)
+                    )
+                )
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
 
     async def download_file_to(self, bucket: str, filename: str, output_dir: Path):
         output_path = output_dir / filename
@@ -171,39 +692,36 @@ class Storage:
 
     async def delete_file_check_no_retry(self, bucket: str, filename: str) -> dict:
         """Delete a file with a check that it exists."""
-        session = aioboto3.Session()
-        async with session.client("s3", **self.settings.s3) as s3:
-            file_object = await s3.get_object(Bucket=bucket, Key=filename)
-            async with file_object["Body"] as stream:
-                await stream.read()
-            res: dict = await s3.delete_object(Bucket=bucket, Key=filename)
-            return res
+        s3 = await self.client()
+        file_object = await s3.get_object(Bucket=bucket, Key=filename)
+        async with file_object["Body"] as stream:
+            await stream.read()
+        res: dict = await s3.delete_object(Bucket=bucket, Key=filename)
+        return res
 
     @fault_tolerant
     async def delete_file_no_check(self, bucket: str, filename: str) -> bool:
         """Delete a file with no check that it exists."""
-        session = aioboto3.Session()
-        async with session.client("s3", **self.settings.s3) as s3:
-            response = await s3.delete_object(Bucket=bucket, Key=filename)
+        s3 = await self.client()
+        response = await s3.delete_object(Bucket=bucket, Key=filename)
         status_code: int = response["ResponseMetadata"]["HTTPStatusCode"]
         return status_code == 204
 
     @fault_tolerant
     async def delete_all_files_from_bucket(self, bucket: str) -> None:
         """Delete all files from a bucket."""
-        session = aioboto3.Session()
-        async with session.resource("s3", **self.settings.s3) as s3:
-            b = await s3.Bucket(bucket)
-            await b.objects.all().delete()
+        s3 = await self.client()
+        paginator = s3.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=bucket):
+            if objects := [{"Key": obj["Key"]} for obj in page.get("Contents", [])]:
+                await s3.delete_objects(Bucket=bucket, Delete={"Objects": objects})
 
     @fault_tolerant
     async def copy_file_to_bucket(
         self, bucket_src: str, bucket_dest: str, filename_src: str, filename_dst: str
     ) -> None:
         """Copy a file from a bucket to another."""
-        session = aioboto3.Session()
-        async with session.resource("s3", **self.settings.s3) as s3:
-            bucket_destination = await s3.Bucket(bucket_dest)
-            await bucket_destination.copy(
-                {"Bucket": bucket_src, "Key": filename_src}, filename_dst
-            )
+        s3 = await self.client()
+        await s3.copy(
+            {"Bucket": bucket_src, "Key": filename_src}, bucket_dest, filename_dst
+        )
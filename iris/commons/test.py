@@ -3,6 +3,17 @@ from pathlib import Path
 from pydantic import BaseModel
 from zstandard import ZstdCompressor, ZstdDecompressor
 
+from iris.agent.backend import RESULTS_COLUMNS
+
+RESULTS_HEADER = ",".join(RESULTS_COLUMNS)
+
+RESULTS_ROWS = [
+    "1640006077,1,::ffff:172.17.0.2,::ffff:62.40.124.69,24000,0,1,1,"
+    '::ffff:172.17.0.1,1,11,0,64,59,"[]",1,1',
+    "1640006077,1,::ffff:172.17.0.2,::,24000,0,64,0,"
+    '::ffff:62.40.124.69,1,0,0,254,94,"[(1234, 0, 0, 1)]",28524,1',
+]
+
 
 class TestModel(BaseModel):
     a: int
@@ -18,6 +29,12 @@ def compress_file(input_path, output_path=None):
     return Path(output_path)
 
 
+def write_results(path, rows=RESULTS_ROWS):
+    """Write a compressed results file, as produced by caracal."""
+    path.write_text("\n".join([RESULTS_HEADER, *rows]) + "\n")
+    return compress_file(path)
+
+
 def decompress_file(input_path, output_path=None):
     if not output_path:
         output_path = str(input_path).replace(".zst", "")
@@ -1,7 +1,7 @@
 import asyncio
 import json
 import socket
-from collections.abc import Callable, Iterator
+from collections.abc import Awaitable, Callable, Iterator
 from contextlib import contextmanager
 from io import TextIOWrapper
 from ipaddress import IPv4Address, IPv6Address
@@ -31,6 +31,18 @@ async def cancel_task(task: asyncio.Task):
         pass
 
 
+async def gather_or_cancel(*aws: Awaitable) -> list:
+    """Like `asyncio.gather`, but cancel the other tasks on the first error."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
 def cast(to: Callable[..., BaseModel], from_: BaseModel, **extra) -> T:
     """Convert an (SQL)Model to another, including extra fields."""
     data = {}
@@ -7,7 +7,6 @@ from diamond_miner.generators import probe_generator_parallel
 from diamond_miner.insert import insert_mda_probe_counts, insert_probe_counts
 from diamond_miner.queries import GetSlidingPrefixes
 from diamond_miner.typing import FlowMapper
-from pych_client import ClickHouseClient
 
 from iris.commons.clickhouse import ClickHouse
 from iris.commons.models import Round, ToolParameters
@@ -40,7 +39,7 @@ async def diamond_miner_inner_pipeline(
 
     :returns: The number of probes written.
     """
-    client = ClickHouseClient(**clickhouse.settings.clickhouse)
+    client = clickhouse.client()
     measurement_id = f"{measurement_uuid}__{agent_uuid}"
 
     flow_mapper_v4, flow_mapper_v6 = instantiate_flow_mappers(
@@ -58,9 +57,10 @@ async def diamond_miner_inner_pipeline(
     )
 
     if results_filepath:
-        await clickhouse.insert_csv(measurement_uuid, agent_uuid, results_filepath)
-        await clickhouse.insert_prefixes(measurement_uuid, agent_uuid)
-        await clickhouse.insert_links(measurement_uuid, agent_uuid)
+        await clickhouse.insert_results(measurement_uuid, agent_uuid, results_filepath)
+        await clickhouse.insert_prefixes_and_links(
+            measurement_uuid, agent_uuid, previous_round
+        )
 
     probe_ttl_geq = 0
     probe_ttl_leq = 255
@@ -3,7 +3,6 @@ from pathlib import Path
 
 from diamond_miner.generators import probe_generator_parallel
 from diamond_miner.insert import insert_probe_counts
-from pych_client import ClickHouseClient
 
 from iris.commons.clickhouse import ClickHouse
 from iris.commons.models import Round, ToolParameters
@@ -33,7 +32,7 @@ async def ping_inner_pipeline(
     """
     :returns: The number of probes written.
     """
-    client = ClickHouseClient(**clickhouse.settings.clickhouse)
+    client = clickhouse.client()
     measurement_id = f"{measurement_uuid}__{agent_uuid}"
 
     flow_mapper_v4, flow_mapper_v6 = instantiate_flow_mappers(
@@ -51,9 +50,10 @@ async def ping_inner_pipeline(
     )
 
     if results_filepath:
-        await clickhouse.insert_csv(measurement_uuid, agent_uuid, results_filepath)
-        await clickhouse.insert_prefixes(measurement_uuid, agent_uuid)
-        await clickhouse.insert_links(measurement_uuid, agent_uuid)
+        await clickhouse.insert_results(measurement_uuid, agent_uuid, results_filepath)
+        await clickhouse.insert_prefixes_and_links(
+            measurement_uuid, agent_uuid, previous_round
+        )
 
     if next_round.number > 1:
         # Ping tool has only one round.
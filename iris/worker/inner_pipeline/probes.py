@@ -39,9 +39,10 @@ async def probes_inner_pipeline(
     )
 
     if results_filepath:
-        await clickhouse.insert_csv(measurement_uuid, agent_uuid, results_filepath)
-        await clickhouse.insert_prefixes(measurement_uuid, agent_uuid)
-        await clickhouse.insert_links(measurement_uuid, agent_uuid)
+        await clickhouse.insert_results(measurement_uuid, agent_uuid, results_filepath)
+        await clickhouse.insert_prefixes_and_links(
+            measurement_uuid, agent_uuid, previous_round
+        )
 
     if previous_round:
         # Probes tool has only one round.
@@ -42,9 +42,10 @@ async def yarrp_inner_pipeline(
     )
 
     if results_filepath:
-        await clickhouse.insert_csv(measurement_uuid, agent_uuid, results_filepath)
-        await clickhouse.insert_prefixes(measurement_uuid, agent_uuid)
-        await clickhouse.insert_links(measurement_uuid, agent_uuid)
+        await clickhouse.insert_results(measurement_uuid, agent_uuid, results_filepath)
+        await clickhouse.insert_prefixes_and_links(
+            measurement_uuid, agent_uuid, previous_round
+        )
 
     if next_round.number > 1:
         # Yarrp has only one round.
@@ -1,4 +1,5 @@
 """Measurement pipeline."""
+import json
 from dataclasses import dataclass
 from logging import LoggerAdapter
 from pathlib import Path
@@ -6,7 +7,7 @@ from pathlib import Path
 from iris.commons.clickhouse import ClickHouse
 from iris.commons.models import Round, Tool, ToolParameters
 from iris.commons.redis import Redis
-from iris.commons.storage import Storage, next_round_key
+from iris.commons.storage import Storage, next_round_key, results_chunk_attempt
 from iris.commons.utils import unwrap
 from iris.worker.inner_pipeline import inner_pipeline_for_tool
 
@@ -15,6 +16,7 @@ from iris.worker.inner_pipeline import inner_pipeline_for_tool
 class OuterPipelineResult:
     next_round: Round
     probes_key: str
+    n_probes: int
 
 
 async def outer_pipeline(
@@ -49,15 +51,41 @@ async def outer_pipeline(
         storage.targets_bucket(user_id), targets_key, working_directory
     )
 
-    if results_key:
+    results_filepath = None
+    if results_key and is_results_manifest(results_key):
+        # The results chunks have been inserted in the staging table of their
+        # attempt as they were uploaded, except those that were not notified
+        # or whose insertion failed.
+        logger.info("Insert the remaining results chunks")
+        bucket = storage.measurement_agent_bucket(measurement_uuid, agent_uuid)
+        manifest = json.loads((await storage.get_file(bucket, results_key))["content"])
+        chunks = set(manifest["chunks"])
+        for file in await storage.list_files(bucket, "chunk_"):
+            if file["key"] in chunks:
+                await insert_results_chunk(
+                    clickhouse,
+                    storage,
+                    logger,
+                    measurement_uuid,
+                    agent_uuid,
+                    working_directory,
+                    file["key"],
+                )
+            else:
+                # The chunks of an attempt that failed before the end of the round.
+                logger.info("Delete results chunk %s", file["key"])
+                await storage.delete_file_no_check(bucket, file["key"])
+        logger.info("Move the results of attempt %s", manifest["attempt"])
+        await clickhouse.commit_staging_table(
+            measurement_uuid, agent_uuid, manifest["attempt"]
+        )
+    elif results_key:
         logger.info("Download results file from object storage")
         results_filepath = await storage.download_file_to(
             storage.measurement_agent_bucket(measurement_uuid, agent_uuid),
             results_key,
             working_directory,
         )
-    else:
-        results_filepath = None
 
     if results_key:
         previous_round = Round.decode(results_key)
@@ -73,6 +101,13 @@ async def outer_pipeline(
             next_round = next_round.next_round(tool_parameters.global_max_ttl)
     logger.info("%s => %s", previous_round, next_round)
 
+    if results_key and not results_filepath:
+        # The inner pipeline only computes the prefixes and the links
+        # of the results it inserts itself.
+        await clickhouse.insert_prefixes_and_links(
+            measurement_uuid, agent_uuid, previous_round
+        )
+
     probes_filepath = working_directory / next_round_key(next_round)
     inner_pipeline_kwargs = dict(
         clickhouse=clickhouse,
@@ -127,7 +162,9 @@ async def outer_pipeline(
             probes_filepath,
         )
         result = OuterPipelineResult(
-            next_round=next_round, probes_key=probes_filepath.name
+            next_round=next_round,
+            probes_key=probes_filepath.name,
+            n_probes=n_probes_to_send,
         )
 
     if targets_filepath:
@@ -141,3 +178,43 @@ async def outer_pipeline(
         probes_filepath.unlink(missing_ok=True)
 
     return result
+
+
+def is_results_chunk(key: str) -> bool:
+    return key.startswith("chunk_")
+
+
+def is_results_manifest(key: str) -> bool:
+    return key.startswith("manifest_")
+
+
+async def insert_results_chunk(
+    clickhouse: ClickHouse,
+    storage: Storage,
+    logger: LoggerAdapter,
+    measurement_uuid: str,
+    agent_uuid: str,
+    working_directory: Path,
+    key: str,
+) -> None:
+    """
+    Insert a chunk of the results of the current round in the staging table of its
+    attempt, while the agent is still probing. The chunks are moved to the results
+    table, and the prefixes and the links are computed, once the round is complete.
+    """
+    bucket = storage.measurement_agent_bucket(measurement_uuid, agent_uuid)
+    if not await storage.list_files(bucket, key):
+        # The chunk was found on S3 before its notification was received.
+        logger.info("Results chunk %s already inserted", key)
+        return
+    logger.info("Insert results chunk %s", key)
+    attempt = results_chunk_attempt(key)
+    filepath = await storage.download_file_to(bucket, key, working_directory)
+    await clickhouse.create_staging_table(measurement_uuid, agent_uuid, attempt)
+    await clickhouse.insert_results(
+        measurement_uuid, agent_uuid, filepath, attempt=attempt
+    )
+    # NOTE: As for the results file, we delete the chunk after its insertion,
+    # so that it is inserted again if the worker fails in between.
+    await storage.delete_file_no_check(bucket, key)
+    filepath.unlink(missing_ok=True)
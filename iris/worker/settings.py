@@ -16,6 +16,7 @@ class WorkerSettings(CommonSettings):
     WORKER_SANITY_CHECK_RETRIES: int = 300
     WORKER_SANITY_CHECK_INTERVAL: float = 1  # seconds
     WORKER_WATCH_INTERVAL: float = 2  # seconds
+    WORKER_RESULTS_POLL_INTERVAL: float = 60  # seconds, fallback when not notified
 
     WORKER_ROUND_1_SLIDING_WINDOW: int = 10  # put to 0 to deactivate sliding window
     WORKER_ROUND_1_STOPPING: int = (
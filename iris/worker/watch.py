@@ -1,15 +1,17 @@
 import asyncio
 import shutil
 from datetime import datetime
+from time import monotonic
 
 import dramatiq
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from iris.commons.clickhouse import ClickHouse
 from iris.commons.dependencies import (
-    get_engine_context,
+    close_pools,
+    get_async_engine_context,
+    get_async_session_context,
     get_redis_context,
-    get_session_context,
 )
 from iris.commons.logger import Adapter, base_logger
 from iris.commons.models import (
@@ -19,7 +21,11 @@ from iris.commons.models import (
 )
 from iris.commons.redis import Redis
 from iris.commons.storage import Storage
-from iris.worker.outer_pipeline import outer_pipeline
+from iris.worker.outer_pipeline import (
+    insert_results_chunk,
+    is_results_chunk,
+    outer_pipeline,
+)
 from iris.worker.settings import WorkerSettings
 
 default_settings = WorkerSettings()
@@ -46,19 +52,25 @@ async def watch_measurement_agent_(
     )
     clickhouse = ClickHouse(settings, logger)
     storage = Storage(settings, logger)
-    async with get_redis_context(settings, logger) as redis:
-        with get_engine_context(settings) as engine:
-            with get_session_context(engine) as session:
-                await watch_measurement_agent_with_deps(
-                    measurement_uuid,
-                    agent_uuid,
-                    clickhouse,
-                    logger,
-                    redis,
-                    settings,
-                    session,
-                    storage,
-                )
+    try:
+        async with get_redis_context(settings, logger) as redis:
+            async with get_async_engine_context(settings) as engine:
+                async with get_async_session_context(engine) as session:
+                    await watch_measurement_agent_with_deps(
+                        measurement_uuid,
+                        agent_uuid,
+                        clickhouse,
+                        logger,
+                        redis,
+                        settings,
+                        session,
+                        storage,
+                    )
+    finally:
+        # The event loop is closed at the end of the message.
+        await clickhouse.close()
+        await storage.close()
+        await close_pools()
 
 
 async def watch_measurement_agent_with_deps(
@@ -68,10 +80,10 @@ async def watch_measurement_agent_with_deps(
     logger: Adapter,
     redis: Redis,
     settings: WorkerSettings,
-    session: Session,
+    session: AsyncSession,
     storage: Storage,
 ):
-    ma = MeasurementAgent.get(session, measurement_uuid, agent_uuid)
+    ma = await MeasurementAgent.get(session, measurement_uuid, agent_uuid)
     if not ma:
         logger.error("Measurement not found")
         return
@@ -88,9 +100,10 @@ async def watch_measurement_agent_with_deps(
         storage.measurement_agent_bucket(measurement_uuid, agent_uuid)
     )
 
+    last_poll = float("-inf")
     while True:
         # 1. Ensure that the MeasurementAgent instance is up-to-date.
-        session.refresh(ma)
+        await session.refresh(ma)
 
         # 2. Ensure that the measurement is not already done.
         if ma.state not in {
@@ -107,27 +120,49 @@ async def watch_measurement_agent_with_deps(
             settings.WORKER_SANITY_CHECK_INTERVAL,
         )
         if not agent_ok:
-            ma.set_state(session, MeasurementAgentState.AgentFailure)
+            await ma.set_state(session, MeasurementAgentState.AgentFailure)
             break
 
         # 4. Find the results file.
         results_filename = None
         # 4.a. If the measurement was just created, do not wait for results.
         if ma.state == MeasurementAgentState.Created:
-            ma.set_state(session, MeasurementAgentState.Ongoing)
-            ma.set_start_time(session, datetime.utcnow())
-        # 4.b. Otherwise, check if a results file is available on S3.
+            await ma.set_state(session, MeasurementAgentState.Ongoing)
+            await ma.set_start_time(session, datetime.utcnow())
+        # 4.b. Otherwise, wait for the agent to notify a results file.
         elif ma.state == MeasurementAgentState.Ongoing:
-            results_filename = await find_results(storage, measurement_uuid, agent_uuid)
+            results_filename = await redis.wait_results(
+                measurement_uuid, agent_uuid, settings.WORKER_WATCH_INTERVAL
+            )
+            # 4.b.1. Look for the results file on S3, in case a notification was lost.
+            if (
+                not results_filename
+                and monotonic() - last_poll > settings.WORKER_RESULTS_POLL_INTERVAL
+            ):
+                results_filename = await find_results(
+                    storage, measurement_uuid, agent_uuid
+                )
+                last_poll = monotonic()
             if not results_filename:
-                # 4.b.1. If the results file is not present, try again later.
-                await asyncio.sleep(settings.WORKER_WATCH_INTERVAL)
+                # 4.b.2. If the results file is not present, try again later.
+                continue
+            # 4.b.3. Insert the partial results while the agent is still probing.
+            if is_results_chunk(results_filename):
+                await insert_results_chunk(
+                    clickhouse,
+                    storage,
+                    logger,
+                    measurement_uuid,
+                    agent_uuid,
+                    working_directory,
+                    results_filename,
+                )
                 continue
 
         if probing_statistics := await redis.get_measurement_stats(
             measurement_uuid, agent_uuid
         ):
-            ma.append_probing_statistics(session, probing_statistics)
+            await ma.append_probing_statistics(session, probing_statistics)
             await redis.delete_measurement_stats(measurement_uuid, agent_uuid)
 
         # TODO: Create a null tool that does nothing that would allow to test the full pipeline.
@@ -152,9 +187,11 @@ async def watch_measurement_agent_with_deps(
         )
 
         if not result:
-            ma.set_state(session, MeasurementAgentState.Finished)
+            await ma.set_state(session, MeasurementAgentState.Finished)
             break
 
+        # Discard the notification of a results file already found on S3.
+        await redis.delete_results_notifications(measurement_uuid, agent_uuid)
         await redis.set_request(
             agent_uuid,
             MeasurementRoundRequest(
@@ -163,17 +200,24 @@ async def watch_measurement_agent_with_deps(
                 probing_rate=ma.probing_rate,
                 batch_size=ma.batch_size,
                 round=result.next_round,
+                results_format=ma.results_format,
+                user_id=ma.measurement.user_id,
+                priority=ma.measurement.priority,
+                n_probes=result.n_probes,
             ),
         )
 
     logger.info("Done watching measurement agent in state %s, cleaning...", ma.state)
 
     if not ma.end_time:
-        ma.set_end_time(session, datetime.utcnow())
+        await ma.set_end_time(session, datetime.utcnow())
 
     await storage.delete_bucket_with_files(
         storage.measurement_agent_bucket(measurement_uuid, agent_uuid)
     )
+    # The results chunks of a canceled round are never moved to the results table.
+    await clickhouse.drop_staging_tables(measurement_uuid, agent_uuid)
+    await redis.delete_results_notifications(measurement_uuid, agent_uuid)
     shutil.rmtree(working_directory)
 
 
@@ -191,9 +235,13 @@ async def check_agent(
 async def find_results(
     storage: Storage, measurement_uuid: str, agent_uuid: str
 ) -> str | None:
+    """
+    Return the key of a complete results file (or of a results manifest),
+    or else of a results chunk.
+    """
     bucket = storage.measurement_agent_bucket(measurement_uuid, agent_uuid)
-    files = await storage.get_all_files(bucket)
-    for file in files:
-        if file["key"].startswith("results_"):
-            return str(file["key"])
+    # The bucket also contains the probes files, so we only list the results.
+    for prefix in ["results_", "manifest_", "chunk_"]:
+        if files := await storage.list_files(bucket, prefix):
+            return str(files[0]["key"])
     return None
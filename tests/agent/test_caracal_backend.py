@@ -1,4 +1,7 @@
-from iris.agent.backend import probe
+import pytest
+
+from iris.agent.backend import RESULTS_COLUMNS, csv_to_parquet, probe
+from iris.commons.test import write_results
 from tests.helpers import superuser
 
 
@@ -21,7 +24,47 @@ async def test_probe(agent_settings, logger, tmp_path):
         None,
         100,
     )
-    # TODO: Re-implement statistics, for now just check it didn't crash
-    assert "packets_sent" in prober_statistics
-    # assert prober_statistics["packets_sent"] == 1
-    # assert prober_statistics["filtered_prefix_excl"] == 1
+    assert prober_statistics["packets_sent"] == 1
+    assert prober_statistics["filtered_prefix_excl"] == 1
+
+
+@superuser
+async def test_probe_stream(agent_settings, logger, tmp_path):
+    async def probes_stream():
+        yield b"8.8.8.8,24000,33434,32,icmp\n"
+        yield b"8.8.4.4,24000,33434,32,icmp"
+
+    async def results_sink(stream):
+        results.extend([chunk async for chunk in stream])
+
+    results: list[bytes] = []
+    excluded_filepath = tmp_path / "excluded.csv"
+    excluded_filepath.write_text("8.8.4.4/32")
+    results_filepath = tmp_path / "results.csv"
+    agent_settings.AGENT_CARACAL_EXCLUDE_PATH = excluded_filepath
+    prober_statistics = await probe(
+        agent_settings,
+        logger,
+        tmp_path / "probes.csv",
+        results_filepath,
+        1,
+        None,
+        100,
+        probes_stream(),
+        results_sink,
+    )
+    assert prober_statistics["packets_sent"] == 1
+    assert not (tmp_path / "probes.csv").exists()
+    assert not results_filepath.exists()
+    assert b"".join(results).startswith(b"capture_timestamp,")
+
+
+def test_csv_to_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    csv_filepath = write_results(tmp_path / "results.csv")
+    parquet_filepath = tmp_path / "results.parquet"
+    csv_to_parquet(csv_filepath, parquet_filepath)
+    table = pq.read_table(parquet_filepath)
+    assert table.column_names == list(RESULTS_COLUMNS)
+    assert table.num_rows == 2
+    assert table["reply_mpls_labels"].to_pylist() == ["[]", "[(1234, 0, 0, 1)]"]
@@ -1,5 +1,10 @@
+from time import perf_counter
 from uuid import uuid4
 
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
 from iris.commons.models import Target
 from iris.commons.models.agent import AgentState
 from iris.commons.models.diamond_miner import Tool
@@ -54,6 +59,66 @@ def test_get_measurements(make_client, make_measurement, make_user, session):
     assert_response(client.get("/measurements"), expected)
 
 
+def get_measurements_statements(
+    client, make_measurement, make_measurement_agent, user, session, n, n_agents
+):
+    """Return the SQL statements executed by GET /measurements and its duration."""
+    measurements = [
+        make_measurement(
+            user_id=str(user.id),
+            agents=[make_measurement_agent() for _ in range(n_agents)],
+        )
+        for _ in range(n)
+    ]
+    session.add_all(measurements)
+    session.commit()
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", count_statement)
+    try:
+        start = perf_counter()
+        response = client.get("/measurements", params={"limit": n // 2})
+        duration = perf_counter() - start
+    finally:
+        event.remove(Engine, "before_cursor_execute", count_statement)
+
+    assert_status_code(response, 200)
+    assert len(response.json()["results"]) == n // 2
+    assert len(response.json()["results"][0]["agents"]) == n_agents
+    return statements, duration
+
+
+def test_get_measurements_queries(
+    make_client, make_measurement, make_measurement_agent, make_user, session
+):
+    # The number of queries must not depend on the number of measurements.
+    user = make_user()
+    client = make_client(user)
+    statements, _ = get_measurements_statements(
+        client, make_measurement, make_measurement_agent, user, session, 6, 3
+    )
+    # count, measurements, agents
+    assert len(statements) <= 3
+
+
+@pytest.mark.benchmark
+def test_get_measurements_benchmark(
+    make_client, make_measurement, make_measurement_agent, make_user, session, logger
+):
+    # Listing of measurements with many agents, run with `pytest -m benchmark`.
+    user = make_user()
+    client = make_client(user)
+    statements, duration = get_measurements_statements(
+        client, make_measurement, make_measurement_agent, user, session, 1000, 24
+    )
+    logger.info("GET /measurements: %.3fs (%s queries)", duration, len(statements))
+    assert len(statements) <= 3
+
+
 def test_get_measurements_with_state(
     make_client, make_measurement, make_measurement_agent, make_user, session
 ):
@@ -256,6 +321,24 @@ async def test_post_measurement_unknown_tag(make_client, make_user):
     assert "No agents associated with tag" in response.text
 
 
+async def test_post_measurement_priority(make_client, make_user):
+    client = make_client(make_user())
+    body = MeasurementCreate(
+        tool=Tool.DiamondMiner,
+        agents=[MeasurementAgentCreate(uuid=str(uuid4()), target_file="targets.csv")],
+        priority=1,
+    )
+    response = client.post("/measurements/", content=body.json())
+    assert_status_code(response, 403)
+    assert "Only superusers can set the priority" in response.text
+
+    client = make_client(make_user(is_superuser=True))
+    body = body.dict()
+    body["priority"] = 100
+    response = client.post("/measurements/", json=body)
+    assert_status_code(response, 422)
+
+
 # TODO: test_post_measurement_unknown_target_file
 
 
@@ -1,22 +1,36 @@
+from collections import Counter
 from datetime import datetime
 
-from iris.commons.models import MeasurementAgentState
+from iris.commons.models import Measurement, MeasurementAgent, MeasurementAgentState
 
 
-def test_start_end_time_no_agents(make_measurement, make_measurement_agent):
-    measurement = make_measurement(agents=[])
+async def add_measurement(async_session, make_measurement, **kwargs):
+    measurement = make_measurement(user_id="user", **kwargs)
+    async_session.add(measurement)
+    await async_session.commit()
+    return await Measurement.get(async_session, measurement.uuid)
+
+
+async def test_start_end_time_no_agents(async_session, make_measurement):
+    measurement = await add_measurement(async_session, make_measurement, agents=[])
     assert not measurement.start_time
     assert not measurement.end_time
 
 
-def test_start_end_time_none(make_measurement, make_measurement_agent):
-    measurement = make_measurement(agents=[make_measurement_agent()])
+async def test_start_end_time_none(
+    async_session, make_measurement, make_measurement_agent
+):
+    measurement = await add_measurement(
+        async_session, make_measurement, agents=[make_measurement_agent()]
+    )
     assert not measurement.start_time
     assert not measurement.end_time
 
 
-def test_start_end_time(make_measurement, make_measurement_agent):
-    measurement = make_measurement(
+async def test_start_end_time(async_session, make_measurement, make_measurement_agent):
+    measurement = await add_measurement(
+        async_session,
+        make_measurement,
         agents=[
             make_measurement_agent(
                 start_time=datetime(2020, 1, 1, 1), end_time=datetime(2020, 1, 1, 3)
@@ -24,32 +38,111 @@ def test_start_end_time(make_measurement, make_measurement_agent):
             make_measurement_agent(
                 start_time=datetime(2020, 1, 1, 2), end_time=datetime(2020, 1, 1, 4)
             ),
-        ]
+        ],
     )
     assert measurement.start_time == datetime(2020, 1, 1, 1)
     assert measurement.end_time == datetime(2020, 1, 1, 4)
 
 
-def test_state_no_agents(make_measurement, make_measurement_agent):
-    measurement = make_measurement(agents=[])
+async def test_state_no_agents(async_session, make_measurement):
+    measurement = await add_measurement(async_session, make_measurement, agents=[])
     assert measurement.state == MeasurementAgentState.Finished
 
 
-def test_state_different(make_measurement, make_measurement_agent):
-    measurement = make_measurement(
+async def test_state_different(async_session, make_measurement, make_measurement_agent):
+    measurement = await add_measurement(
+        async_session,
+        make_measurement,
         agents=[
             make_measurement_agent(state=MeasurementAgentState.Created),
             make_measurement_agent(state=MeasurementAgentState.Finished),
-        ]
+        ],
     )
     assert measurement.state == MeasurementAgentState.Ongoing
 
 
-def test_state_same(make_measurement, make_measurement_agent):
-    measurement = make_measurement(
+async def test_state_same(async_session, make_measurement, make_measurement_agent):
+    measurement = await add_measurement(
+        async_session,
+        make_measurement,
         agents=[
             make_measurement_agent(state=MeasurementAgentState.Created),
             make_measurement_agent(state=MeasurementAgentState.Created),
-        ]
+        ],
     )
     assert measurement.state == MeasurementAgentState.Created
+
+
+async def test_state_update(async_session, make_measurement, make_measurement_agent):
+    measurement = await add_measurement(
+        async_session,
+        make_measurement,
+        agents=[
+            make_measurement_agent(state=MeasurementAgentState.Created),
+            make_measurement_agent(state=MeasurementAgentState.Created),
+        ],
+    )
+    first, second = measurement.agents
+    await first.set_state(async_session, MeasurementAgentState.Finished)
+    await first.set_end_time(async_session, datetime(2020, 1, 1, 2))
+    assert measurement.state == MeasurementAgentState.Ongoing
+    assert not measurement.end_time
+    assert (
+        await Measurement.count(async_session, state=MeasurementAgentState.Ongoing) == 1
+    )
+
+    await second.set_state(async_session, MeasurementAgentState.Canceled)
+    await second.set_end_time(async_session, datetime(2020, 1, 1, 1))
+    assert measurement.state == MeasurementAgentState.Finished
+    assert measurement.end_time == datetime(2020, 1, 1, 2)
+
+
+async def test_async_helpers(async_session, make_measurement):
+    measurement = make_measurement(user_id="user", tags=["async"])
+    async_session.add(measurement)
+    await async_session.commit()
+
+    ma = await MeasurementAgent.get(
+        async_session, measurement.uuid, measurement.agents[0].agent_uuid
+    )
+    assert ma.measurement.uuid == measurement.uuid
+    await ma.set_state(async_session, MeasurementAgentState.Ongoing)
+    await ma.set_start_time(async_session, datetime(2020, 1, 1))
+
+    measurement = await Measurement.get(async_session, measurement.uuid)
+    assert measurement.state == MeasurementAgentState.Ongoing
+    assert measurement.start_time == datetime(2020, 1, 1)
+
+    await measurement.set_tags(async_session, ["async", "helpers"])
+    assert await Measurement.count(async_session, tags=["helpers"]) == 1
+    measurements = await Measurement.all(async_session, tags=["helpers"])
+    assert [m.uuid for m in measurements] == [measurement.uuid]
+    assert measurements[0].agents[0].state == MeasurementAgentState.Ongoing
+
+
+async def test_count_by_state(async_session, make_measurement, make_measurement_agent):
+    states = [
+        [MeasurementAgentState.Created],
+        [MeasurementAgentState.Created, MeasurementAgentState.Created],
+        [MeasurementAgentState.Created, MeasurementAgentState.Ongoing],
+        [MeasurementAgentState.Canceled, MeasurementAgentState.Finished],
+        [MeasurementAgentState.Finished, MeasurementAgentState.Ongoing],
+        [],
+    ]
+    measurements = [
+        make_measurement(
+            user_id="user",
+            agents=[make_measurement_agent(state=state) for state in agents_state],
+        )
+        for agents_state in states
+    ]
+    async_session.add_all(measurements)
+    await async_session.commit()
+
+    expected = {
+        MeasurementAgentState.Created: 2,
+        MeasurementAgentState.Ongoing: 2,
+        MeasurementAgentState.Finished: 2,
+    }
+    assert Counter(m.state for m in measurements) == expected
+    assert await Measurement.count_by_state(async_session) == expected
@@ -1,7 +1,7 @@
 import pytest
 from pydantic import ValidationError
 
-from iris.commons.models import MeasurementAgentCreate
+from iris.commons.models import MeasurementAgentCreate, ResultsFormat, ToolParameters
 
 
 def test_create_missing_tag_uuid():
@@ -12,3 +12,16 @@ def test_create_missing_tag_uuid():
 def test_create_tag_and_uuid():
     with pytest.raises(ValidationError, match="one of `uuid` or `tag`"):
         MeasurementAgentCreate(tag="tag", uuid="uuid")
+
+
+def test_results_format(make_agent_parameters, make_measurement_agent):
+    tool_parameters = ToolParameters(results_format=ResultsFormat.Parquet)
+    ma = make_measurement_agent(tool_parameters=tool_parameters)
+    assert ma.results_format == ResultsFormat.CSV
+    agent_parameters = make_agent_parameters(
+        results_formats=[ResultsFormat.CSV, ResultsFormat.Parquet]
+    )
+    ma = make_measurement_agent(
+        agent_parameters=agent_parameters, tool_parameters=tool_parameters
+    )
+    assert ma.results_format == ResultsFormat.Parquet
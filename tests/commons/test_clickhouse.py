@@ -1,9 +1,17 @@
+import threading
+import time
+from ipaddress import IPv6Network
 from uuid import uuid4
 
 import pytest
+from diamond_miner.queries import links_table, results_table
 from pych_client.exceptions import ClickHouseException
 
-from iris.commons.test import compress_file
+from iris.agent.backend import csv_to_parquet
+from iris.commons import clickhouse as clickhouse_module
+from iris.commons.clickhouse import ClickHouse, is_overloaded, measurement_id
+from iris.commons.models import Round
+from iris.commons.test import RESULTS_ROWS, compress_file, write_results
 
 
 async def test_call(clickhouse):
@@ -16,19 +24,87 @@ async def test_call_error(clickhouse):
         await clickhouse.call("SELECT invalid")
 
 
-async def test_insert_results(clickhouse, tmp_path):
+async def test_client_pool(clickhouse):
+    assert clickhouse.client() is clickhouse.client()
+    assert await clickhouse.async_client() is await clickhouse.async_client()
+    rows = await clickhouse.call("SELECT 1 AS one", timeout=10)
+    assert rows == [{"one": 1}]
+    await clickhouse.close()
+
+
+def test_is_overloaded():
+    assert is_overloaded(ClickHouseException(500, "Code: 252. Too many parts", ""))
+    assert not is_overloaded(ClickHouseException(500, "Code: 47. Missing columns", ""))
+    assert not is_overloaded(ValueError())
+
+
+def test_insert_data_waiting(settings, logger, monkeypatch):
+    class Client:
+        def execute(self, query, data):
+            for _ in data:
+                pass
+
+    monkeypatch.setattr(clickhouse_module, "MIN_COST_SIZE", 1)
+    monkeypatch.setattr(ClickHouse, "client", lambda self: Client())
+    clickhouse = ClickHouse(
+        settings.copy(
+            update={
+                "CLICKHOUSE_INSERT_CONCURRENCY_INITIAL": 5,
+                "CLICKHOUSE_INSERT_CONCURRENCY_MIN": 5,
+                "CLICKHOUSE_INSERT_CONCURRENCY_MAX": 5,
+            }
+        ),
+        logger,
+    )
+
+    def data():
+        # The dispatcher is slow, not the server.
+        time.sleep(0.2)
+        yield b"x" * 10
+
+    limiter = clickhouse.insert_limiter()
+    limiter.acquire()
+    clickhouse.insert_data("INSERT", data())
+    assert limiter.in_flight == 0
+    assert limiter.costs[-1] < 0.1 / 10
+
+
+def test_execute_plan(settings, logger):
+    clickhouse = ClickHouse(
+        settings.copy(
+            update={"CLICKHOUSE_SUBSET_ROW_SIZE": 1, "CLICKHOUSE_SUBSETS_MEMORY": 10}
+        ),
+        logger,
+    )
+    plan = [(IPv6Network(f"::ffff:{i}.0.0.0/104"), 20 - i) for i in range(1, 10)]
+    lock = threading.Lock()
+    executed, in_flight, max_in_flight = [], [0], [0]
+
+    def func(subset):
+        rows = dict(plan)[subset]
+        with lock:
+            in_flight[0] += rows
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= rows
+            executed.append(subset)
+
+    clickhouse.execute_plan("test", plan, func)
+    assert sorted(executed) == [subset for subset, _ in plan]
+    # Each subset is larger than the budget, so they must run one at a time.
+    assert max_in_flight[0] == 19
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+async def test_insert_results(settings, logger, tmp_path, streaming):
+    clickhouse = ClickHouse(
+        settings.copy(update={"CLICKHOUSE_STREAMING_INSERT": streaming}), logger
+    )
     measurement_uuid = str(uuid4())
     agent_uuid = str(uuid4())
 
-    results_file = tmp_path / "results.csv"
-    results_file.write_text(
-        """capture_timestamp,probe_protocol,probe_src_addr,probe_dst_addr,probe_src_port,probe_dst_port,probe_ttl,quoted_ttl,reply_src_addr,reply_protocol,reply_icmp_type,reply_icmp_code,reply_ttl,reply_size,reply_mpls_labels,rtt,round
-1640006077,1,::ffff:172.17.0.2,::ffff:62.40.124.69,24000,0,1,1,::ffff:172.17.0.1,1,11,0,64,59,"[]",1,1
-1640006077,1,::ffff:172.17.0.2,::,24000,0,64,0,::ffff:62.40.124.69,1,0,0,254,94,"[]",28524,1
-1640006077,1,::ffff:172.17.0.2,::,24000,0,5,0,::ffff:62.40.124.69,1,0,0,254,35,"[]",28524,1
-"""
-    )
-    results_file = compress_file(results_file)
+    results_file = write_results(tmp_path / "results.csv")
 
     assert (
         await clickhouse.create_tables(measurement_uuid, agent_uuid, 24, 64, drop=True)
@@ -37,8 +113,113 @@ async def test_insert_results(clickhouse, tmp_path):
     assert (
         await clickhouse.insert_csv(measurement_uuid, agent_uuid, results_file) is None
     )
-    assert await clickhouse.insert_prefixes(measurement_uuid, agent_uuid) is None
-    assert await clickhouse.insert_links(measurement_uuid, agent_uuid) is None
+    assert (
+        await clickhouse.insert_prefixes_and_links(measurement_uuid, agent_uuid) is None
+    )
+
+
+async def test_insert_prefixes_and_links_incremental(settings, logger, tmp_path):
+    clickhouse = ClickHouse(
+        settings.copy(update={"CLICKHOUSE_INCREMENTAL_INSERT": True}), logger
+    )
+    measurement_uuid = str(uuid4())
+    agent_uuid = str(uuid4())
+    measurement_id_ = measurement_id(measurement_uuid, agent_uuid)
+    await clickhouse.create_tables(measurement_uuid, agent_uuid, 24, 64, drop=True)
+
+    for round_ in [1, 2]:
+        results_file = write_results(
+            tmp_path / f"results_{round_}.csv",
+            [
+                f"1640006077,1,::ffff:172.17.0.2,::ffff:62.40.124.69,2400{round_},0,"
+                f'{ttl},{ttl},{reply},1,11,0,64,59,"[]",1,{round_}'
+                for ttl, reply in [(1, "::ffff:8.8.8.8"), (2, "::ffff:8.8.4.4")]
+            ],
+        )
+        await clickhouse.insert_csv(measurement_uuid, agent_uuid, results_file)
+        await clickhouse.insert_prefixes_and_links(
+            measurement_uuid, agent_uuid, Round(number=round_, limit=0, offset=0)
+        )
+
+    rows = await clickhouse.call(
+        "SELECT near_round, far_round FROM {table:Identifier} ORDER BY near_round",
+        params={"table": links_table(measurement_id_)},
+    )
+    assert rows == [
+        {"near_round": 1, "far_round": 1},
+        {"near_round": 2, "far_round": 2},
+    ]
+
+
+async def test_insert_results_parquet(clickhouse, tmp_path):
+    pytest.importorskip("pyarrow")
+    measurement_uuid = str(uuid4())
+    agent_uuid = str(uuid4())
+
+    results_file = write_results(tmp_path / "results.csv")
+    parquet_file = tmp_path / "results.parquet"
+    csv_to_parquet(results_file, parquet_file)
+
+    await clickhouse.create_tables(measurement_uuid, agent_uuid, 24, 64, drop=True)
+    await clickhouse.insert_results(measurement_uuid, agent_uuid, parquet_file)
+    # The addresses and the MPLS labels are strings in the Parquet file,
+    # they are cast by ClickHouse to the types of the results table.
+    rows = await clickhouse.call(
+        """
+        SELECT
+            toString(probe_dst_addr) AS probe_dst_addr,
+            toString(reply_src_addr) AS reply_src_addr,
+            toString(reply_mpls_labels) AS reply_mpls_labels,
+            toString(probe_dst_prefix) AS probe_dst_prefix
+        FROM {table:Identifier}
+        ORDER BY probe_ttl
+        """,
+        params={"table": results_table(f"{measurement_uuid}__{agent_uuid}")},
+    )
+    assert rows == [
+        {
+            "probe_dst_addr": "::ffff:62.40.124.69",
+            "reply_src_addr": "::ffff:172.17.0.1",
+            "reply_mpls_labels": "[]",
+            "probe_dst_prefix": "::ffff:62.40.124.0",
+        },
+        {
+            "probe_dst_addr": "::",
+            "reply_src_addr": "::ffff:62.40.124.69",
+            "reply_mpls_labels": "[(1234,0,0,1)]",
+            "probe_dst_prefix": "::",
+        },
+    ]
+
+
+async def test_insert_results_staging(clickhouse, tmp_path):
+    measurement_uuid = str(uuid4())
+    agent_uuid = str(uuid4())
+    measurement_id_ = measurement_id(measurement_uuid, agent_uuid)
+    await clickhouse.create_tables(measurement_uuid, agent_uuid, 24, 64, drop=True)
+
+    results_file = write_results(tmp_path / "results.csv", RESULTS_ROWS[:1])
+
+    # The first attempt fails after uploading a chunk, the second one completes.
+    for attempt in ["first", "second", "second"]:
+        await clickhouse.create_staging_table(measurement_uuid, agent_uuid, attempt)
+        await clickhouse.insert_results(
+            measurement_uuid, agent_uuid, results_file, attempt=attempt
+        )
+    # The commit is idempotent.
+    for _ in range(2):
+        await clickhouse.commit_staging_table(measurement_uuid, agent_uuid, "second")
+
+    rows = await clickhouse.call(
+        "SELECT count() AS count FROM {table:Identifier}",
+        params={"table": results_table(measurement_id_)},
+    )
+    assert rows == [{"count": 2}]
+    rows = await clickhouse.call(
+        "SELECT name FROM system.tables WHERE startsWith(name, {prefix:String})",
+        params={"prefix": results_table(measurement_id_)},
+    )
+    assert rows == [{"name": results_table(measurement_id_)}]
 
 
 async def test_insert_results_invalid(clickhouse, tmp_path):
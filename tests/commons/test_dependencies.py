@@ -0,0 +1,50 @@
+from prometheus_client import REGISTRY
+
+from iris.commons.dependencies import (
+    close_pools,
+    get_engine_context,
+    get_redis_context,
+)
+
+
+def test_get_engine_shared(settings):
+    with get_engine_context(settings) as engine_1:
+        pass
+    with get_engine_context(settings) as engine_2:
+        pass
+    assert engine_1 is engine_2
+    assert engine_1.pool.size() == settings.DATABASE_POOL_SIZE
+
+
+async def test_get_redis_shared(settings, logger):
+    async with get_redis_context(settings, logger) as redis_1:
+        pass
+    async with get_redis_context(settings, logger) as redis_2:
+        pass
+    assert redis_1.client is redis_2.client
+    await close_pools()
+    async with get_redis_context(settings, logger) as redis_3:
+        pass
+    assert redis_3.client is not redis_1.client
+    await close_pools()
+
+
+async def test_redis_pool_metrics(settings, logger):
+    # The pools of the other tests may still be open.
+    def connections(state):
+        labels = {"pool": "redis", "state": state}
+        return REGISTRY.get_sample_value("iris_pool_connections", labels)
+
+    await close_pools()
+    opened, in_use = connections("open"), connections("in_use")
+    async with get_redis_context(settings, logger) as redis:
+        await redis.client.ping()
+        assert connections("open") == opened + 1
+        assert connections("in_use") == in_use
+        pool = redis.client.connection_pool
+        connection = await pool.get_connection("PING")
+        assert connections("in_use") == in_use + 1
+        await pool.release(connection)
+        assert connections("in_use") == in_use
+    await close_pools()
+    assert connections("open") == opened
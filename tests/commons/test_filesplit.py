@@ -1,7 +1,14 @@
 import secrets
 from uuid import uuid4
 
-from iris.commons.filesplit import split_compressed_file
+from zstandard import ZstdCompressor
+
+from iris.commons.filesplit import (
+    iter_compressed_file,
+    split_compressed_file,
+    split_lines,
+    zstd_frames,
+)
 from iris.commons.test import compress_file
 
 
@@ -31,3 +38,91 @@ def test_split_compressed_file_skip_lines(tmp_path):
     for file in sorted(tmp_path.glob("split_*")):
         actual += file.read_text()
     assert actual == expected[(256 + 1) * 10 :]
+
+
+def test_iter_compressed_file(tmp_path):
+    file = tmp_path / str(uuid4())
+    compressed_file = file.with_suffix(".csv.zst")
+    expected = "\n".join(secrets.token_hex(128) for _ in range(1000))
+    file.write_text(expected)
+    compress_file(file, compressed_file)
+    chunks = list(iter_compressed_file(compressed_file, read_size=1000, skip_lines=10))
+    assert all(chunk.endswith(b"\n") for chunk in chunks[:-1])
+    assert b"".join(chunks).decode() == expected[(256 + 1) * 10 :]
+
+
+def test_split_compressed_file_multi_frames(tmp_path):
+    file = tmp_path / str(uuid4())
+    compressed_file = file.with_suffix(".csv.zst")
+    lines = [secrets.token_hex(128) + "\n" for _ in range(1000)]
+    expected = "".join(lines)
+    ctx = ZstdCompressor()
+    with compressed_file.open("wb") as f:
+        # Frame boundaries are not aligned on lines.
+        for i in range(0, len(expected), 10_000):
+            f.write(ctx.compress(expected[i : i + 10_000].encode()))
+    assert len(zstd_frames(compressed_file.read_bytes())) == 26
+    split_compressed_file(
+        compressed_file, tmp_path / "split_", lines_per_file=100, threads=4
+    )
+    actual = ""
+    for file in sorted(tmp_path.glob("split_*")):
+        actual += file.read_text()
+    assert actual == expected
+
+
+def test_split_compressed_file_exact_lines(tmp_path):
+    file = tmp_path / str(uuid4())
+    compressed_file = file.with_suffix(".csv.zst")
+    # Lines of different sizes, e.g. IPv4 and IPv6 replies.
+    lines = [secrets.token_hex(secrets.choice((8, 128))) + "\n" for _ in range(1000)]
+    file.write_text("".join(lines))
+    compress_file(file, compressed_file)
+    split_compressed_file(compressed_file, tmp_path / "split_", lines_per_file=90)
+    files = sorted(tmp_path.glob("split_*"), key=lambda f: int(f.name.split("_")[-1]))
+    assert len(files) == 12
+    assert [len(f.read_text().splitlines()) for f in files] == [90] * 11 + [10]
+    assert "".join(f.read_text() for f in files) == "".join(lines)
+
+
+def test_split_compressed_file_max_bytes(tmp_path):
+    file = tmp_path / str(uuid4())
+    compressed_file = file.with_suffix(".csv.zst")
+    lines = [secrets.token_hex(secrets.choice((8, 128))) + "\n" for _ in range(1000)]
+    file.write_text("".join(lines))
+    compress_file(file, compressed_file)
+    split_compressed_file(
+        compressed_file, tmp_path / "split_", lines_per_file=100, bytes_per_file=4096
+    )
+    files = sorted(tmp_path.glob("split_*"), key=lambda f: int(f.name.split("_")[-1]))
+    assert all(f.stat().st_size <= 4096 for f in files)
+    assert all(len(f.read_text().splitlines()) <= 100 for f in files)
+    assert "".join(f.read_text() for f in files) == "".join(lines)
+
+
+async def test_split_lines():
+    async def stream():
+        yield b"1\n2"
+        yield b"\n3\n4\n5\n6"
+        yield b"\n"
+        yield b"7"
+
+    chunks = [chunk async for chunk in split_lines(stream(), 2)]
+    assert chunks == [b"1\n2\n", b"3\n4\n", b"5\n6\n", b"7"]
+
+
+async def test_split_lines_header():
+    async def stream():
+        yield b"header\n1\n2"
+        yield b"\n3\n4\n5"
+
+    chunks = [chunk async for chunk in split_lines(stream(), 2, header=True)]
+    assert chunks == [b"header\n1\n2\n", b"header\n3\n4\n", b"header\n5"]
+    # Each chunk contains exactly `max_lines` rows, except for the last one.
+    assert [chunk.count(b"\n") for chunk in chunks] == [3, 3, 1]
+
+    async def header_only():
+        yield b"header\n"
+
+    chunks = [chunk async for chunk in split_lines(header_only(), 2, header=True)]
+    assert chunks == [b"header\n"]
@@ -0,0 +1,102 @@
+import random
+import threading
+import time
+
+import pytest
+
+from iris.commons.limiter import ConcurrencyLimiter, RateBudget
+from iris.commons.settings import CommonSettings
+
+
+def test_concurrency_limiter_increase():
+    limiter = ConcurrencyLimiter(initial=2, minimum=1, maximum=3)
+    # The limit increases by one every `limit` successful operations.
+    for expected in [2.5, 3.0, 3.0]:
+        assert limiter.acquire(blocking=False)
+        limiter.release(cost=1.0)
+        assert limiter.limit == expected
+    # Operations whose cost is unknown do not change the limit.
+    limiter = ConcurrencyLimiter(initial=2, minimum=1, maximum=3)
+    limiter.acquire()
+    limiter.release()
+    assert limiter.limit == 2.0
+
+
+def test_concurrency_limiter_decrease():
+    limiter = ConcurrencyLimiter(initial=8, minimum=2, maximum=8, tolerance=2.0)
+    limiter.acquire()
+    limiter.release(cost=1.0)
+    # A cost below `tolerance` times the baseline is not a slowdown.
+    limiter.acquire()
+    limiter.release(cost=1.9)
+    assert limiter.limit > 8 - 1
+    limiter.acquire()
+    limiter.release(cost=2.1)
+    assert limiter.limit == 4.0
+    limiter.acquire()
+    limiter.release(overloaded=True)
+    assert limiter.limit == 2.0
+    # The limit never goes below the minimum.
+    limiter.acquire()
+    limiter.release(overloaded=True)
+    assert limiter.limit == 2.0
+
+
+def test_concurrency_limiter_bounds():
+    with pytest.raises(ValueError):
+        ConcurrencyLimiter(initial=1, minimum=0, maximum=4)
+    with pytest.raises(ValueError):
+        CommonSettings(CLICKHOUSE_INSERT_CONCURRENCY_MIN=0)
+    with pytest.raises(ValueError):
+        CommonSettings(
+            CLICKHOUSE_INSERT_CONCURRENCY_INITIAL=8,
+            CLICKHOUSE_INSERT_CONCURRENCY_MAX=4,
+        )
+
+
+def test_concurrency_limiter_window():
+    limiter = ConcurrencyLimiter(initial=8, minimum=1, maximum=8, window=2)
+    for cost in [1.0, 10.0]:
+        limiter.acquire()
+        limiter.release(cost=cost)
+    assert limiter.limit == 4.0
+    # The fast operation is now out of the window, so the baseline is 10.
+    limiter.acquire()
+    limiter.release(cost=10.0)
+    assert limiter.limit == 4.25
+
+
+def test_concurrency_limiter_blocking():
+    limiter = ConcurrencyLimiter(initial=1, minimum=1, maximum=1)
+    assert limiter.acquire()
+    assert not limiter.acquire(blocking=False)
+
+    acquired = threading.Event()
+    thread = threading.Thread(
+        target=lambda: limiter.acquire() and acquired.set(), daemon=True
+    )
+    thread.start()
+    time.sleep(0.05)
+    assert not acquired.is_set()
+    limiter.release()
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_rate_budget_total():
+    # The rates in use never exceed the total, even with very low totals.
+    rng = random.Random(42)
+    for _ in range(1000):
+        slots = rng.randint(1, 6)
+        budget = RateBudget(total=rng.randint(slots, 40), slots=slots)
+        rates = []
+        for _ in range(30):
+            if rates and (len(rates) == slots or rng.random() < 0.5):
+                budget.release(rates.pop(rng.randrange(len(rates))))
+            else:
+                rates.append(budget.acquire(rng.randint(1, 60)))
+                assert min(rates) >= 1
+                assert sum(rates) <= budget.total
+
+    with pytest.raises(ValueError):
+        RateBudget(total=2, slots=3)
@@ -1,11 +1,20 @@
 import asyncio
+from datetime import datetime
 from uuid import uuid4
 
 import pytest
 
+from iris.commons.models import ProbingProgress, QueuePolicy
 from iris.commons.models.agent import Agent, AgentState
 from iris.commons.models.measurement_round_request import MeasurementRoundRequest
 from iris.commons.models.round import Round
+from iris.commons.redis import (
+    agent_queue_events_key,
+    agent_queue_key,
+    agent_queue_order_key,
+    agent_usage_decay_key,
+    agent_usage_key,
+)
 
 
 async def test_get_agents_empty(redis):
@@ -39,6 +48,10 @@ async def test_get_agent(redis, make_agent_parameters):
     assert await redis.get_agent_by_uuid(agent_uuid) == Agent(
         uuid=agent_uuid, state=AgentState.Idle, parameters=agent_parameters
     )
+    assert await redis.get_agents_by_uuids([str(uuid4()), agent_uuid]) == [
+        None,
+        Agent(uuid=agent_uuid, state=AgentState.Idle, parameters=agent_parameters),
+    ]
 
 
 async def test_get_agent_expired(redis, make_agent_parameters):
@@ -122,6 +135,39 @@ async def test_set_measurement_stats(redis, make_probing_statistics):
     assert await redis.get_measurement_stats(measurement_uuid, agent_uuid) is None
 
 
+async def test_set_measurement_progress(redis):
+    agent_uuid = str(uuid4())
+    measurement_uuid = str(uuid4())
+    progress = ProbingProgress(
+        round=Round(number=1, limit=10, offset=0),
+        time=datetime.utcnow(),
+        probing_rate=100,
+        sending_rate=99.5,
+        packets_sent=1000,
+        packets_failed=0,
+        packets_received=900,
+        pcap_dropped=0,
+        pcap_interface_dropped=0,
+    )
+    await redis.set_measurement_progress(measurement_uuid, agent_uuid, progress, 1)
+    assert (
+        await redis.get_measurement_progress(measurement_uuid, agent_uuid) == progress
+    )
+    await asyncio.sleep(1.5)
+    assert await redis.get_measurement_progress(measurement_uuid, agent_uuid) is None
+
+
+async def test_notify_results(redis):
+    measurement_uuid = str(uuid4())
+    agent_uuid = str(uuid4())
+    assert await redis.wait_results(measurement_uuid, agent_uuid, 0.1) is None
+    await redis.notify_results(measurement_uuid, agent_uuid, "results_1")
+    await redis.notify_results(measurement_uuid, agent_uuid, "results_2")
+    assert await redis.wait_results(measurement_uuid, agent_uuid, 0.1) == "results_1"
+    await redis.delete_results_notifications(measurement_uuid, agent_uuid)
+    assert await redis.wait_results(measurement_uuid, agent_uuid, 0.1) is None
+
+
 async def test_get_random_request_empty(redis):
     with pytest.raises(asyncio.TimeoutError):
         await asyncio.wait_for(
@@ -147,6 +193,10 @@ async def test_get_random_request(redis):
     await redis.set_request(agent_uuid, request_1)
     await redis.set_request(agent_uuid, request_2)
     assert await redis.get_random_request(agent_uuid) in (request_1, request_2)
+    assert (
+        await redis.get_random_request(agent_uuid, exclude={request_1.measurement_uuid})
+        == request_2
+    )
 
     await redis.delete_request(request_1.measurement_uuid, agent_uuid)
     assert await redis.get_random_request(agent_uuid) == request_2
@@ -154,3 +204,175 @@ async def test_get_random_request(redis):
     await redis.delete_request(request_2.measurement_uuid, agent_uuid)
     with pytest.raises(asyncio.TimeoutError):
         await asyncio.wait_for(redis.get_random_request(agent_uuid, interval=0.1), 0.5)
+
+
+async def test_get_random_request_wait(redis):
+    agent_uuid = str(uuid4())
+    request = MeasurementRoundRequest(
+        measurement_uuid=str(uuid4()),
+        probe_filename="request",
+        probing_rate=100,
+        round=Round(number=1, limit=10, offset=0),
+    )
+    # The agent must be woken up well before the interval.
+    task = asyncio.create_task(redis.get_random_request(agent_uuid, interval=60))
+    await asyncio.sleep(0.1)
+    await redis.set_request(agent_uuid, request)
+    assert await asyncio.wait_for(task, 1) == request
+
+
+async def test_wait_request_deletion(redis):
+    agent_uuid = str(uuid4())
+    request = MeasurementRoundRequest(
+        measurement_uuid=str(uuid4()),
+        probe_filename="request",
+        probing_rate=100,
+        round=Round(number=1, limit=10, offset=0),
+    )
+    # The request does not exist.
+    await asyncio.wait_for(
+        redis.wait_request_deletion(request.measurement_uuid, agent_uuid), 1
+    )
+
+    await redis.set_request(agent_uuid, request)
+    task = asyncio.create_task(
+        redis.wait_request_deletion(request.measurement_uuid, agent_uuid)
+    )
+    await asyncio.sleep(0.1)
+    assert not task.done()
+    await redis.delete_request(request.measurement_uuid, agent_uuid)
+    await asyncio.wait_for(task, 1)
+
+
+async def test_delete_request_round(redis):
+    agent_uuid = str(uuid4())
+    request = MeasurementRoundRequest(
+        measurement_uuid=str(uuid4()),
+        probe_filename="request",
+        probing_rate=100,
+        round=Round(number=1, limit=10, offset=0),
+    )
+    next_request = request.copy(update={"round": Round(number=2, limit=0, offset=0)})
+    await redis.set_request(agent_uuid, request)
+    await redis.set_request(agent_uuid, next_request)
+    # The request of the next round is kept.
+    await redis.delete_request(request.measurement_uuid, agent_uuid, request.round)
+    assert await redis.get_request(request.measurement_uuid, agent_uuid) == next_request
+    await redis.delete_request(request.measurement_uuid, agent_uuid, next_request.round)
+    assert not await redis.get_request(request.measurement_uuid, agent_uuid)
+
+
+async def test_set_request_events(redis):
+    agent_uuid = str(uuid4())
+    for _ in range(3):
+        request = MeasurementRoundRequest(
+            measurement_uuid=str(uuid4()),
+            probe_filename="request",
+            probing_rate=100,
+            round=Round(number=1, limit=10, offset=0),
+        )
+        await redis.set_request(agent_uuid, request)
+    events = f"{redis.ns}:{agent_queue_events_key(agent_uuid)}"
+    assert await redis.client.lrange(events, 0, -1) == [request.measurement_uuid]
+
+
+async def test_get_next_request(redis):
+    agent_uuid = str(uuid4())
+
+    def make_request(user_id, priority, n_probes):
+        return MeasurementRoundRequest(
+            measurement_uuid=str(uuid4()),
+            probe_filename="probes",
+            probing_rate=100,
+            round=Round(number=1, limit=10, offset=0),
+            user_id=user_id,
+            priority=priority,
+            n_probes=n_probes,
+        )
+
+    request_1 = make_request("user_1", 0, 300)
+    request_2 = make_request("user_1", 1, 200)
+    request_3 = make_request("user_2", 0, 100)
+    for request in (request_1, request_2, request_3):
+        await redis.set_request(agent_uuid, request)
+
+    async def get_next_request(policy, exclude=()):
+        return await redis.get_next_request(agent_uuid, policy, exclude=exclude)
+
+    assert await get_next_request(QueuePolicy.Priority) == request_2
+    assert (
+        await get_next_request(QueuePolicy.Priority, {request_2.measurement_uuid})
+        == request_1
+    )
+    assert await get_next_request(QueuePolicy.Shortest) == request_3
+
+    # user_1 is charged 300 probes, then user_2 and user_1 are served in turn.
+    assert await get_next_request(QueuePolicy.Fair) == request_1
+    assert await get_next_request(QueuePolicy.Fair) == request_3
+    assert await get_next_request(QueuePolicy.Fair) == request_3
+    await redis.delete_request(request_3.measurement_uuid, agent_uuid)
+    assert await get_next_request(QueuePolicy.Fair) == request_1
+
+    await redis.delete_request(request_1.measurement_uuid, agent_uuid)
+    await redis.delete_request(request_2.measurement_uuid, agent_uuid)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(
+            redis.get_next_request(agent_uuid, QueuePolicy.Priority, interval=0.1),
+            0.5,
+        )
+
+
+async def test_index_requests(redis):
+    agent_uuid = str(uuid4())
+    request = MeasurementRoundRequest(
+        measurement_uuid=str(uuid4()),
+        probe_filename="probes",
+        probing_rate=100,
+        round=Round(number=1, limit=10, offset=0),
+    )
+    await redis.set_request(agent_uuid, request)
+    # Simulate a request queued before the introduction of the policies.
+    for policy in (QueuePolicy.Priority, QueuePolicy.Shortest, QueuePolicy.Fair):
+        await redis.delete(agent_queue_order_key(agent_uuid, policy))
+    assert not await redis.get_ordered_request(agent_uuid, QueuePolicy.Priority, ())
+
+    await redis.index_requests(agent_uuid)
+    for policy in (QueuePolicy.Priority, QueuePolicy.Shortest, QueuePolicy.Fair):
+        assert await redis.get_next_request(agent_uuid, policy) == request
+
+
+async def test_get_ordered_request_deleted(redis):
+    agent_uuid = str(uuid4())
+    requests = [
+        MeasurementRoundRequest(
+            measurement_uuid=str(uuid4()),
+            probe_filename="probes",
+            probing_rate=100,
+            round=Round(number=1, limit=10, offset=0),
+            n_probes=n_probes,
+        )
+        for n_probes in (100, 200)
+    ]
+    for request in requests:
+        await redis.set_request(agent_uuid, request)
+    # Simulate a crash between the deletion of the request and of its indexes.
+    await redis.hdel(agent_queue_key(agent_uuid), requests[0].measurement_uuid)
+
+    assert await redis.get_next_request(agent_uuid, QueuePolicy.Shortest) == requests[1]
+    for policy in (QueuePolicy.Priority, QueuePolicy.Shortest, QueuePolicy.Fair):
+        keys = await redis.zrange(agent_queue_order_key(agent_uuid, policy), 0, -1)
+        assert keys == [requests[1].measurement_uuid]
+
+
+async def test_decay_usage(redis):
+    agent_uuid = str(uuid4())
+    await redis.zadd(agent_usage_key(agent_uuid), {"user_1": 1000, "user_2": 100})
+    # The first call only records the time of the decay.
+    await redis.decay_usage(agent_uuid, 60)
+    assert await redis.zmscore(agent_usage_key(agent_uuid), "user_1") == [1000]
+
+    last = float(await redis.get(agent_usage_decay_key(agent_uuid)))
+    await redis.set(agent_usage_decay_key(agent_uuid), str(last - 60))
+    await redis.decay_usage(agent_uuid, 60)
+    usage = await redis.zmscore(agent_usage_key(agent_uuid), "user_1", "user_2")
+    assert usage == [pytest.approx(500, rel=0.01), pytest.approx(50, rel=0.01)]
@@ -1,3 +1,6 @@
+import json
+import os
+from datetime import timedelta
 from uuid import uuid4
 
 import pytest
@@ -49,6 +52,87 @@ async def test_download_file(storage, make_bucket, make_tmp_file, tmp_path):
     assert download_path.read_text() == tmp_file["content"]
 
 
+async def test_multipart_transfer(storage, make_bucket, tmp_path):
+    storage.settings.S3_PART_SIZE = 5 * 2**20  # S3 minimum part size
+    bucket = make_bucket()
+    filename = str(uuid4())
+    upload_path = tmp_path / "upload"
+    upload_path.write_bytes(os.urandom(12 * 2**20))
+    await storage.create_bucket(bucket)
+
+    # Simulate an interrupted upload with the first part already sent.
+    s3 = await storage.client()
+    response = await s3.create_multipart_upload(Bucket=bucket, Key=filename)
+    with upload_path.open("rb") as f:
+        await s3.upload_part(
+            Bucket=bucket,
+            Key=filename,
+            UploadId=response["UploadId"],
+            PartNumber=1,
+            Body=f.read(storage.settings.S3_PART_SIZE),
+        )
+    assert (await storage.find_multipart_upload(bucket, filename))[0]
+    await storage.upload_file(bucket, filename, upload_path)
+    assert (await storage.find_multipart_upload(bucket, filename))[0] is None
+
+    # Stale uploads are aborted instead of being resumed.
+    await s3.create_multipart_upload(Bucket=bucket, Key=filename)
+    storage.settings.S3_UPLOAD_EXPIRY = timedelta(0)
+    assert (await storage.find_multipart_upload(bucket, filename))[0] is None
+    response = await s3.list_multipart_uploads(Bucket=bucket, Prefix=filename)
+    assert not response.get("Uploads")
+
+    # Simulate an interrupted download with the second part already written.
+    download_path = tmp_path / "download"
+    download_path.write_bytes(upload_path.read_bytes()[: 10 * 2**20])
+    head = await s3.head_object(Bucket=bucket, Key=filename)
+    (tmp_path / "download.parts").write_text(
+        json.dumps({"etag": head["ETag"], "part_size": 5 * 2**20, "parts": [1]})
+    )
+    await storage.download_file(bucket, filename, download_path)
+    assert download_path.read_bytes() == upload_path.read_bytes()
+    assert not (tmp_path / "download.parts").exists()
+
+
+async def test_iter_file(storage, make_bucket, tmp_path):
+    bucket = make_bucket()
+    filepath = tmp_path / "file"
+    filepath.write_bytes(b"0123456789")
+    await storage.create_bucket(bucket)
+    await storage.upload_file(bucket, "file", filepath)
+    storage.settings.S3_PART_SIZE = 4
+    storage.settings.S3_TRANSFER_CONCURRENCY = 2
+    chunks = [chunk async for chunk in storage.iter_file(bucket, "file")]
+    assert chunks == [b"0123", b"4567", b"89"]
+
+
+async def test_upload_stream(storage, make_bucket):
+    async def stream():
+        yield b"0123"
+        yield b"4567"
+
+    bucket = make_bucket()
+    await storage.create_bucket(bucket)
+    await storage.upload_stream(bucket, "file", stream(), {"key": "value"})
+    file = await storage.get_file(bucket, "file")
+    assert file["content"] == "01234567"
+    assert file["metadata"] == {"key": "value"}
+
+
+async def test_upload_stream_parts(storage, make_bucket):
+    async def stream():
+        yield b"0123"
+
+    bucket = make_bucket()
+    await storage.create_bucket(bucket)
+    upload = await storage.upload_stream_parts(bucket, "file", stream())
+    # The file appears only once the upload is complete.
+    assert await storage.list_files(bucket) == []
+    await storage.complete_stream_upload(bucket, "file", upload)
+    file = await storage.get_file(bucket, "file")
+    assert file["content"] == "0123"
+
+
 async def test_download_file_to(storage, make_bucket, make_tmp_file, tmp_path):
     bucket = make_bucket()
     tmp_file = make_tmp_file()
@@ -96,6 +180,24 @@ async def test_get_all_files(storage, make_bucket, make_tmp_file):
         assert file["size"] == len(tmp_file["content"])
 
 
+async def test_list_files(storage, make_bucket, make_tmp_file):
+    bucket = make_bucket()
+    await storage.create_bucket(bucket)
+
+    tmp_files = [make_tmp_file("results_1"), make_tmp_file("next_round_1")]
+    for tmp_file in tmp_files:
+        await upload_file(storage, bucket, tmp_file)
+
+    files = await storage.list_files(bucket, "results_")
+    assert len(files) == 1
+    assert files[0]["key"] == "results_1"
+    assert files[0]["size"] == len(tmp_files[0]["content"])
+    assert "metadata" not in files[0]
+
+    files = await storage.list_files(bucket, "results_", with_metadata=True)
+    assert files[0]["metadata"] == tmp_files[0]["metadata"]
+
+
 async def test_delete_file_check(storage, make_bucket, make_tmp_file):
     bucket = make_bucket()
     tmp_file = make_tmp_file()
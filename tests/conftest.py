@@ -16,7 +16,12 @@ from iris.api.authentication import current_active_user, current_superuser
 from iris.api.main import make_app
 from iris.api.settings import APISettings
 from iris.commons.clickhouse import ClickHouse
-from iris.commons.dependencies import get_settings
+from iris.commons.dependencies import (
+    close_pools,
+    get_async_engine_context,
+    get_async_session_context,
+    get_settings,
+)
 from iris.commons.models.base import Base
 from iris.commons.redis import Redis
 from iris.commons.settings import CommonSettings
@@ -107,12 +112,24 @@ def session(engine):
 
 
 @pytest.fixture
-def storage(settings, logger):
-    return Storage(settings, logger)
+async def async_session(engine, settings):
+    async with get_async_engine_context(settings) as async_engine:
+        async with get_async_session_context(async_engine) as session:
+            yield session
+    await close_pools()
+
+
+@pytest.fixture
+async def storage(settings, logger):
+    storage = Storage(settings, logger)
+    yield storage
+    await storage.close()
 
 
 @pytest.fixture
 def make_client(engine, api_settings):
+    clients = []
+
     def _make_client(user=None):
         app = make_app(settings=api_settings)
         if user and user.is_active:
@@ -120,9 +137,16 @@ def make_client(engine, api_settings):
         if user and user.is_active and user.is_superuser:
             app.dependency_overrides[current_superuser] = lambda: user
         app.dependency_overrides[get_settings] = lambda: api_settings
-        return TestClient(app)
+        # Run all the requests on the same event loop, so that they share
+        # the connection pools, and close them on exit.
+        client = TestClient(app)
+        client.__enter__()
+        clients.append(client)
+        return client
 
     yield _make_client
+    for client in clients:
+        client.__exit__()
 
 
 @pytest.fixture(autouse=True, scope="session")
@@ -2,7 +2,7 @@ from uuid import uuid4
 
 from iris.commons.models.agent import AgentState
 from iris.commons.models.round import Round
-from iris.commons.storage import results_key
+from iris.commons.storage import results_chunk_key, results_key, results_manifest_key
 from iris.worker.watch import check_agent, find_results, watch_measurement_agent_
 from tests.helpers import register_agent, upload_file
 
@@ -36,6 +36,29 @@ async def test_find_results(storage, make_tmp_file):
     assert filename == tmp_filename
 
 
+async def test_find_results_chunks(storage, make_tmp_file):
+    measurement_uuid = str(uuid4())
+    agent_uuid = str(uuid4())
+    bucket = storage.measurement_agent_bucket(measurement_uuid, agent_uuid)
+    await storage.create_bucket(bucket)
+
+    round_ = Round(number=1, limit=10, offset=0)
+    await upload_file(
+        storage, bucket, make_tmp_file(results_chunk_key(round_, "attempt", 0))
+    )
+    filename = await find_results(
+        storage=storage, measurement_uuid=measurement_uuid, agent_uuid=agent_uuid
+    )
+    assert filename == results_chunk_key(round_, "attempt", 0)
+
+    # The manifest is returned first, since it completes the round.
+    await upload_file(storage, bucket, make_tmp_file(results_manifest_key(round_)))
+    filename = await find_results(
+        storage=storage, measurement_uuid=measurement_uuid, agent_uuid=agent_uuid
+    )
+    assert filename == results_manifest_key(round_)
+
+
 async def test_find_results_not_found(storage, make_tmp_file):
     measurement_uuid = str(uuid4())
     agent_uuid = str(uuid4())